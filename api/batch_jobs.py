@@ -0,0 +1,128 @@
+import asyncio
+import json
+import time
+import uuid
+from collections import OrderedDict
+
+from config import BATCH_MAX_IN_FLIGHT, BATCH_MAX_JOBS, RETRY_AFTER_SECONDS
+from scheduler import generation_scheduler, QueueFullError
+
+
+# ================= 批量生成 =================
+# 离线任务 (评测、数据生成) 一次提交几百条对话，复用已经加载好的模型和连续批处理调度器：
+# - 按 prompt 长度排序后依次提交 (分桶)，同一批次内的序列长度接近，左侧 padding 更少
+# - 同时在调度器里的条目不超过 max_in_flight，不会挤满等待队列、影响在线聊天请求
+# - 谁先生成完谁先返回，每条结果一行 JSON (JSONL)
+
+
+def result_line(result):
+    return json.dumps(result, ensure_ascii=False) + "\n"
+
+
+async def _generate(index, request, stop):
+    """提交单条请求并收集完整回复；等待队列满时稍后重试"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            stream = generation_scheduler.submit(request, loop=loop)
+            break
+        except QueueFullError:
+            await asyncio.sleep(RETRY_AFTER_SECONDS)
+    try:
+        text = ""
+        async for piece in stream:
+            text += piece
+        return {"index": index, "content": text, "usage": {
+            "prompt_tokens": len(request.input_ids), "completion_tokens": request.num_generated}}
+    finally:
+        # 任务被取消 (客户端断开 / 删除任务) 时让调度器停止解码
+        stop.cancel()
+
+
+async def run_bucketed(entries, max_in_flight=BATCH_MAX_IN_FLIGHT):
+    """
+    entries: [(index, GenerationRequest, DisconnectStoppingCriteria), ...]
+    按完成顺序逐条产出结果 dict；生成器被关闭时取消所有还没完成的条目
+    """
+    semaphore = asyncio.Semaphore(max_in_flight)
+    results = asyncio.Queue()
+
+    async def worker(index, request, stop):
+        # Semaphore 按先来先得放行，任务按长度顺序创建，提交顺序也就是长度顺序
+        async with semaphore:
+            try:
+                result = await _generate(index, request, stop)
+            except Exception as e:
+                result = {"index": index, "error": str(e)}
+        await results.put(result)
+
+    ordered = sorted(entries, key=lambda entry: len(entry[1].input_ids))
+    tasks = [asyncio.create_task(worker(*entry)) for entry in ordered]
+    try:
+        for _ in tasks:
+            yield await results.get()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class BatchJob:
+    """以任务句柄方式运行的批量生成：结果保存在内存里，可以分次查询"""
+
+    def __init__(self, total):
+        self.id = uuid.uuid4().hex
+        self.total = total
+        self.results = []
+        self.status = "running"
+        self.created = time.time()
+        self.finished = None
+        self.task = None
+
+    def status_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "total": self.total,
+            "completed": len(self.results),
+            "errors": sum(1 for result in self.results if "error" in result),
+            "elapsed": (self.finished or time.time()) - self.created,
+        }
+
+    async def run(self, results):
+        try:
+            async for result in results:
+                self.results.append(result)
+            self.status = "done"
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+        finally:
+            self.finished = time.time()
+
+
+class BatchJobStore:
+    def __init__(self, max_jobs):
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+
+    def start(self, job, results):
+        job.task = asyncio.create_task(job.run(results))
+        self.jobs[job.id] = job
+        # 只淘汰已经结束的任务，正在运行的任务不受影响
+        for job_id in [job_id for job_id, old in self.jobs.items() if old.status != "running"]:
+            if len(self.jobs) <= self.max_jobs:
+                break
+            del self.jobs[job_id]
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is not None and job.task is not None and not job.task.done():
+            job.task.cancel()
+        return job
+
+
+# 全局单例
+batch_jobs = BatchJobStore(BATCH_MAX_JOBS)
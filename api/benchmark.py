@@ -0,0 +1,905 @@
+"""
+推理服务性能基准测试 (在 api 目录下运行)
+
+    # 连续批处理调度器 vs 原来的“每个请求一个线程”，统计不同并发下的总吞吐 (tokens/s)
+    python benchmark.py scheduler --concurrency 1 2 4 8 --max-new-tokens 64
+
+    # 角色 System Prompt 前缀 KV Cache 对首 token 延迟 (TTFT) 的影响
+    python benchmark.py prefix --repeats 20
+
+    # 并发检查：多个 SSE 流是否交错输出，流式生成期间事件循环是否还能及时响应其他请求
+    python benchmark.py interleave --concurrency 4
+
+    # PEFT (LoRA 旁路) vs 合并权重：加载耗时与不同 batch size 下的解码吞吐
+    python benchmark.py merged --batch-size 1 4 8 --max-new-tokens 128
+
+    # CPU 推理配置对比：bf16/fp32、int8 量化、torch.compile 的解码吞吐与峰值内存 (--tiny 使用随机初始化的小模型)
+    python benchmark.py cpu --variants fp32 bf16 int8 bf16+compile --threads 8
+
+    # 语义回复缓存：用训练集建索引，回放测试集每段对话的第一句，统计不同阈值下的命中率和查询延迟 (不需要加载模型)
+    python benchmark.py semantic --thresholds 0.5 0.6 0.7 0.8 0.9
+
+    # 投机解码：单请求下开/关投机、不同草稿长度的每 token 延迟与接受率
+    python benchmark.py speculative --draft ../models/Qwen/Qwen2.5-0.5B-Instruct --speculative-tokens 2 4 6
+
+    # 多副本压测：用 launcher.py 分别启动 1/2/4 个 worker，经路由器压测总吞吐，并统计 worker 的 RSS 与 PSS (共享权重只算一份)
+    python benchmark.py replicas --workers 1 2 4 --concurrency 16 --requests 64
+
+    # 按角色的生成长度：用训练集统计各角色的长度预算，回放测试集开场白，对比固定 max_new_tokens 与按角色预算 + 句末停止
+    python benchmark.py profiles --samples 100 --batch-size 8
+
+    # 优先级调度：批量任务 (285 条) 占满批次时，在线聊天请求的首 token 延迟；对比不分优先级 / 只分优先级 / 可暂停 bulk
+    python benchmark.py priority --bulk 285 --batch-size 8
+
+    # 冷启动：分别以 from_pretrained / mmap / mmap + 预热启动服务进程，统计进程启动到 /readyz 就绪的时间、各阶段耗时，
+    # 以及就绪后第一个真实请求的首 token 延迟
+    python benchmark.py startup --variants copy mmap mmap+warmup
+
+    # KV Cache 内存预算：不同预算 (MB，-1 不限制，0 自动) 下同时解码的最大行数、预估峰值、吞吐与 OOM 拆分次数
+    python benchmark.py memory --budgets -1 0 64 16 --requests 16 --max-new-tokens 128
+"""
+import argparse
+import asyncio
+import gc
+import json
+import multiprocessing
+import os
+import resource
+import signal
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from threading import Thread
+
+import torch
+
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+from model_loader import model_service, DEVICE, BASE_MODEL_PATH, ADAPTER_PATH, load_peft_model, load_merged_model
+from cpu_profile import CPU_DTYPES, model_dtype, setup_threads, prepare_cpu_model
+from semantic_cache import SemanticCache, embed, opening_turns
+from config import SEMANTIC_CACHE_CAPACITY, SEMANTIC_CACHE_SEED, DRAFT_MODEL_PATH, GENERATION_PROFILE_DATA
+from config import MAX_NEW_TOKENS, BATCH_MAX_IN_FLIGHT
+from generation_profiles import GenerationProfiles
+from stopping import SENTENCE_ENDINGS
+from scheduler import GenerationScheduler, GenerationRequest
+from roles import ROLE_PROMPTS
+from startup import startup_progress
+
+# 压测用的用户输入，取自 scene/*.txt 中的常见话题
+BENCH_PROMPTS = [
+    "有对象了吗?",
+    "小伙子一年挣多少钱呀",
+    "你是不是在想前女友呢？",
+    "你干什么吃的，这都不会？",
+    "唉，你看那个人穿得好奇怪啊。",
+    "我看你这就是懒，这点家务都不想做！",
+]
+
+
+def build_input_ids(tokenizer, user_input, role_name="长辈"):
+    messages = [
+        {"role": "system", "content": ROLE_PROMPTS[role_name]},
+        {"role": "user", "content": user_input},
+    ]
+    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return tokenizer(text, add_special_tokens=False).input_ids
+
+
+def print_table(title, rows):
+    print(f"\n===== {title} =====")
+    print(f"{'模式':<18}{'并发':>6}{'总tokens':>10}{'耗时(s)':>10}{'tokens/s':>12}{'平均延迟(s)':>14}")
+    for row in rows:
+        print(f"{row['mode']:<18}{row['concurrency']:>6}{row['tokens']:>10}{row['elapsed']:>10.2f}"
+              f"{row['tokens'] / row['elapsed']:>12.1f}{row['latency']:>14.2f}")
+
+
+# ================= 1. 连续批处理 vs 每请求一个线程 =================
+def run_thread_per_request(tokenizer, model, concurrency, max_new_tokens):
+    """旧实现：每个请求单独起一个线程调用 model.generate (batch size = 1)"""
+    latencies = []
+
+    def worker(prompt):
+        input_ids = torch.tensor([build_input_ids(tokenizer, prompt)], device=DEVICE)
+        begin = time.time()
+        with torch.no_grad():
+            model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=max_new_tokens,
+                do_sample=True,
+                temperature=0.85,
+                top_p=0.95,
+                top_k=50,
+                repetition_penalty=1.1,
+                pad_token_id=tokenizer.pad_token_id,
+            )
+        latencies.append(time.time() - begin)
+
+    start = time.time()
+    threads = [Thread(target=worker, args=(BENCH_PROMPTS[i % len(BENCH_PROMPTS)],)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    return {"mode": "thread-per-request", "concurrency": concurrency, "tokens": concurrency * max_new_tokens,
+            "elapsed": elapsed, "latency": sum(latencies) / len(latencies)}
+
+
+def run_scheduler(scheduler, tokenizer, concurrency, max_new_tokens):
+    """新实现：全部请求提交给同一个连续批处理调度器"""
+    latencies = []
+
+    def consume(stream, begin):
+        for _ in stream:
+            pass
+        latencies.append(time.time() - begin)
+
+    start = time.time()
+    requests, consumers = [], []
+    for i in range(concurrency):
+        request = GenerationRequest(
+            build_input_ids(tokenizer, BENCH_PROMPTS[i % len(BENCH_PROMPTS)]),
+            max_new_tokens=max_new_tokens,
+            eos_token_ids=[],  # 固定生成长度，和线程模式保持一致
+        )
+        requests.append(request)
+        consumers.append(Thread(target=consume, args=(scheduler.submit(request), time.time())))
+    for t in consumers:
+        t.start()
+    for t in consumers:
+        t.join()
+    elapsed = time.time() - start
+    return {"mode": "scheduler", "concurrency": concurrency, "tokens": sum(r.num_generated for r in requests),
+            "elapsed": elapsed, "latency": sum(latencies) / len(latencies)}
+
+
+def bench_scheduler(args):
+    model_service.load_model(args.base, args.adapter)
+    tokenizer, model = model_service.get_model()
+
+    scheduler = GenerationScheduler()
+    scheduler.start(tokenizer, model, DEVICE, max_batch_size=max(args.concurrency))
+
+    rows = []
+    for concurrency in args.concurrency:
+        rows.append(run_thread_per_request(tokenizer, model, concurrency, args.max_new_tokens))
+        rows.append(run_scheduler(scheduler, tokenizer, concurrency, args.max_new_tokens))
+    print_table("连续批处理 vs 每请求一个线程", rows)
+
+
+# ================= 2. 角色前缀 KV Cache 对 TTFT 的影响 =================
+def measure_ttft(scheduler, request):
+    begin = time.time()
+    stream = scheduler.submit(request)
+    next(stream, None)
+    ttft = time.time() - begin
+    for _ in stream:
+        pass
+    return ttft
+
+
+def bench_prefix(args):
+    model_service.load_model(args.base, args.adapter)
+    tokenizer, model = model_service.get_model()
+
+    scheduler = GenerationScheduler()
+    scheduler.start(tokenizer, model, DEVICE, max_batch_size=1)
+
+    print(f"\n===== 角色前缀 KV Cache: 平均 TTFT (ms), 每个角色 {args.repeats} 次 =====")
+    print(f"{'角色':<8}{'前缀tokens':>12}{'无前缀':>10}{'有前缀':>10}")
+    for role_name in ROLE_PROMPTS:
+        prefix = model_service.get_role_prefix(role_name)
+        cost = {False: [], True: []}
+        for i in range(args.repeats):
+            input_ids = build_input_ids(tokenizer, BENCH_PROMPTS[i % len(BENCH_PROMPTS)], role_name)
+            for use_prefix in (False, True):
+                request = GenerationRequest(input_ids, max_new_tokens=1, eos_token_ids=[],
+                                            prefix=prefix if use_prefix else None)
+                cost[use_prefix].append(measure_ttft(scheduler, request))
+        print(f"{role_name:<8}{len(prefix):>12}{sum(cost[False]) / args.repeats * 1000:>10.1f}"
+              f"{sum(cost[True]) / args.repeats * 1000:>10.1f}")
+
+
+# ================= 3. 并发 SSE 流交错检查 =================
+def start_server(port):
+    """在后台线程里启动真实的 uvicorn 服务 (复用已加载的模型)"""
+    import uvicorn
+    from main import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    Thread(target=server.run, daemon=True).start()
+    # 模型在服务的后台线程里完成启动 (调度器、预热) 后才接收请求
+    while not server.started or not startup_progress.ready:
+        if startup_progress.error is not None:
+            raise RuntimeError(startup_progress.error)
+        time.sleep(0.1)
+    return server
+
+
+async def stream_chat(client, base_url, idx, events):
+    payload = {"role": 1, "messages": [{"role": "user", "content": BENCH_PROMPTS[idx % len(BENCH_PROMPTS)]}]}
+    async with client.stream("POST", f"{base_url}/chat/completions", json=payload) as response:
+        async for line in response.aiter_lines():
+            if line.startswith("data: ") and line != "data: [DONE]":
+                events.append((time.time(), idx))
+
+
+async def probe_loop(client, base_url, stop, latencies):
+    """流式生成期间不断请求一个轻量接口，如果事件循环被阻塞，这里的延迟会明显变大"""
+    while not stop.is_set():
+        begin = time.time()
+        await client.get(f"{base_url}/openapi.json")
+        latencies.append(time.time() - begin)
+        await asyncio.sleep(0.05)
+
+
+async def run_interleave(base_url, concurrency):
+    import httpx
+
+    events, latencies = [], []
+    async with httpx.AsyncClient(timeout=None) as client:
+        stop = asyncio.Event()
+        probe = asyncio.create_task(probe_loop(client, base_url, stop, latencies))
+        await asyncio.gather(*[stream_chat(client, base_url, i, events) for i in range(concurrency)])
+        stop.set()
+        await probe
+    return events, latencies
+
+
+def bench_interleave(args):
+    model_service.load_model(args.base, args.adapter)
+    server = start_server(args.port)
+    events, latencies = asyncio.run(run_interleave(f"http://127.0.0.1:{args.port}", args.concurrency))
+    server.should_exit = True
+
+    order = [idx for _, idx in sorted(events)]
+    switches = sum(1 for a, b in zip(order, order[1:]) if a != b)
+    first = {i: min(t for t, j in events if j == i) for i in set(order)}
+    last = {i: max(t for t, j in events if j == i) for i in set(order)}
+    # 每个流的第一个片段都早于其他所有流的最后一个片段，说明各个流是同时推进而不是排队串行
+    interleaved = len(first) == args.concurrency and all(
+        first[i] < last[j] for i in first for j in last if i != j
+    )
+
+    print(f"\n===== 并发 SSE 流交错检查 (并发 {args.concurrency}) =====")
+    print(f"总片段数: {len(events)}  相邻片段来自不同流的次数: {switches}")
+    print(f"探测请求 {len(latencies)} 次  平均延迟: {sum(latencies) / max(len(latencies), 1) * 1000:.1f} ms"
+          f"  最大延迟: {max(latencies, default=0) * 1000:.1f} ms")
+    print("✅ 各请求的流式输出交错进行" if interleaved else "❌ 流式输出没有交错，存在串行/阻塞")
+    if not interleaved:
+        sys.exit(1)
+
+
+# ================= 4. PEFT vs 合并权重 =================
+@torch.no_grad()
+def measure_decode(model, tokenizer, batch_size, max_new_tokens):
+    """贪心解码固定长度，返回 (tokens/s, 第一条的输出 token)"""
+    prompts = [build_input_ids(tokenizer, BENCH_PROMPTS[i % len(BENCH_PROMPTS)]) for i in range(batch_size)]
+    batch = tokenizer.pad({"input_ids": prompts}, padding=True, return_tensors="pt").to(model.device)
+    if DEVICE == "cuda":
+        torch.cuda.synchronize()
+    begin = time.time()
+    output = model.generate(
+        **batch,
+        max_new_tokens=max_new_tokens,
+        min_new_tokens=max_new_tokens,
+        do_sample=False,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    if DEVICE == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.time() - begin
+    return batch_size * max_new_tokens / elapsed, output[0, batch["input_ids"].shape[1]:].tolist()
+
+
+def bench_merged(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.base, trust_remote_code=True, padding_side="left")
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    results, outputs = {}, {}
+    for mode, loader in (("peft", load_peft_model), ("merged", load_merged_model)):
+        begin = time.time()
+        model = loader(args.base, args.adapter)
+        load_time = time.time() - begin
+        measure_decode(model, tokenizer, 1, 8)  # 预热
+        speeds = {}
+        for batch_size in args.batch_size:
+            speeds[batch_size], tokens = measure_decode(model, tokenizer, batch_size, args.max_new_tokens)
+            outputs.setdefault(mode, tokens)
+        results[mode] = (load_time, speeds)
+        # 两个模型不同时驻留，避免显存翻倍
+        del model
+        gc.collect()
+        if DEVICE == "cuda":
+            torch.cuda.empty_cache()
+
+    print(f"\n===== PEFT vs 合并权重: 解码吞吐 (tokens/s), 每条 {args.max_new_tokens} tokens =====")
+    print(f"{'模式':<10}{'加载(s)':>10}" + "".join(f"{'bs=' + str(b):>12}" for b in args.batch_size))
+    for mode, (load_time, speeds) in results.items():
+        print(f"{mode:<10}{load_time:>10.2f}" + "".join(f"{speeds[b]:>12.1f}" for b in args.batch_size))
+    print(f"{'加速比':<10}{'':>10}" + "".join(
+        f"{results['merged'][1][b] / results['peft'][1][b]:>11.2f}x" for b in args.batch_size))
+
+    # 合并后是数值等价的同一个模型，fp16 舍入可能让贪心输出在很靠后的位置出现分歧
+    same = 0
+    for a, b in zip(outputs["peft"], outputs["merged"]):
+        if a != b:
+            break
+        same += 1
+    print(f"贪心输出一致的前缀长度: {same}/{len(outputs['peft'])} tokens")
+
+
+# ================= 5. CPU 推理配置对比 =================
+def parse_variant(variant):
+    """fp32 / bf16 / int8 / int8-weight，可以用 + 组合 compile，例如 bf16+compile"""
+    parts = variant.split("+")
+    cpu_dtype = next((p for p in parts if p in CPU_DTYPES), "fp32")
+    quantize = next((p for p in parts if p in ("int8", "int8-weight")), "none")
+    return cpu_dtype, quantize, "compile" in parts
+
+
+def build_tiny_model(base_model_path, dtype):
+    """沿用基座的词表和结构，只保留 2 层、hidden 256 的随机初始化模型，用于快速冒烟测试"""
+    config = AutoConfig.from_pretrained(base_model_path, trust_remote_code=True)
+    config.num_hidden_layers = 2
+    config.hidden_size = 256
+    config.intermediate_size = 512
+    config.num_attention_heads = 4
+    config.num_key_value_heads = 2
+    if hasattr(config, "head_dim"):
+        config.head_dim = 64
+    return AutoModelForCausalLM.from_config(config, dtype=dtype).eval()
+
+
+def run_cpu_variant(variant, base, adapter, tiny, threads, batch_sizes, max_new_tokens):
+    """在独立的子进程里运行，保证峰值 RSS 只统计当前配置"""
+    cpu_dtype, quantize, compile_model = parse_variant(variant)
+    setup_threads(threads)
+    tokenizer = AutoTokenizer.from_pretrained(base, trust_remote_code=True, padding_side="left")
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    dtype = model_dtype("cpu", cpu_dtype, quantize)
+    begin = time.time()
+    model = build_tiny_model(base, dtype) if tiny else load_merged_model(base, adapter, dtype)
+    model = prepare_cpu_model(model, quantize, compile_model)
+    load_time = time.time() - begin
+
+    # 每个 batch size 各预热一次 (torch.compile 在这里完成各种形状的编译)
+    begin = time.time()
+    for batch_size in batch_sizes:
+        measure_decode(model, tokenizer, batch_size, 8)
+    warmup = time.time() - begin
+
+    speeds = {b: measure_decode(model, tokenizer, b, max_new_tokens)[0] for b in batch_sizes}
+    # Linux 上 ru_maxrss 的单位是 KB
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {"variant": variant, "load": load_time, "warmup": warmup, "speeds": speeds, "rss": peak_rss}
+
+
+def bench_cpu(args):
+    # 子进程看不到 GPU，DEVICE 自动变成 cpu
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    threads = args.threads or os.cpu_count()
+    rows = []
+    for variant in args.variants:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            rows.append(pool.submit(run_cpu_variant, variant, args.base, args.adapter, args.tiny, threads,
+                                    args.batch_size, args.max_new_tokens).result())
+
+    model_name = "tiny (随机初始化)" if args.tiny else os.path.basename(os.path.normpath(args.base))
+    print(f"\n===== CPU 推理: {model_name}, {threads} 线程, 每条 {args.max_new_tokens} tokens =====")
+    print(f"{'配置':<16}{'加载(s)':>10}{'预热(s)':>10}{'峰值RSS(MB)':>14}"
+          + "".join(f"{'bs=' + str(b) + ' tok/s':>14}" for b in args.batch_size))
+    for row in rows:
+        print(f"{row['variant']:<16}{row['load']:>10.2f}{row['warmup']:>10.2f}{row['rss']:>14.0f}"
+              + "".join(f"{row['speeds'][b]:>14.1f}" for b in args.batch_size))
+
+
+# ================= 6. 语义回复缓存回放 =================
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def bench_semantic(args):
+    cache = SemanticCache(threshold=1.0, capacity=SEMANTIC_CACHE_CAPACITY)
+    begin = time.time()
+    count = cache.load_dataset(args.seed)
+    print(f"\n收录 {count} 条开场问答，耗时 {time.time() - begin:.2f}s")
+
+    with open(args.replay, "r", encoding="utf-8") as f:
+        turns = list(opening_turns(json.load(f)))
+
+    print(f"\n===== 语义回复缓存: 回放 {len(turns)} 条测试集开场白 =====")
+    print(f"{'阈值':<8}{'命中率':>10}{'命中回复与参考回复相似度':>26}{'p50(us)':>10}{'p99(us)':>10}")
+    for threshold in args.thresholds:
+        hits, quality, latencies = 0, [], []
+        for role_name, question, reference in turns:
+            begin = time.perf_counter()
+            result = cache.lookup(role_name, question, threshold=threshold)
+            latencies.append((time.perf_counter() - begin) * 1e6)
+            if result is not None:
+                hits += 1
+                # 粗略的质量参考：返回的回复与测试集参考回复的 n-gram 余弦相似度
+                quality.append(float(embed(result["reply"]) @ embed(reference)))
+        avg_quality = sum(quality) / len(quality) if quality else 0.0
+        print(f"{threshold:<8}{hits / len(turns):>10.1%}{avg_quality:>26.3f}"
+              f"{percentile(latencies, 0.5):>10.0f}{percentile(latencies, 0.99):>10.0f}")
+
+
+# ================= 7. 投机解码 =================
+def run_speculative(scheduler, tokenizer, args, speculative):
+    tokens, elapsed, token_latency, drafted, accepted = 0, 0.0, [], 0, 0
+    for i in range(args.repeats):
+        request = GenerationRequest(
+            build_input_ids(tokenizer, BENCH_PROMPTS[i % len(BENCH_PROMPTS)]),
+            max_new_tokens=args.max_new_tokens,
+            temperature=args.temperature,
+            eos_token_ids=[],  # 固定生成长度，方便对比
+            speculative=speculative,
+        )
+        begin = time.time()
+        stream = scheduler.submit(request)
+        next(stream, None)
+        first = time.time()
+        for _ in stream:
+            pass
+        end = time.time()
+        tokens += request.num_generated
+        elapsed += end - begin
+        # 首 token 之后平均每个 token 的间隔，即聊天界面里感受到的“打字速度”
+        token_latency.append((end - first) / max(request.num_generated - 1, 1))
+        drafted += request.num_drafted
+        accepted += request.num_accepted
+    return tokens / elapsed, sum(token_latency) / len(token_latency) * 1000, accepted / drafted if drafted else 0.0
+
+
+def bench_speculative(args):
+    model_service.load_model(args.base, args.adapter, draft_model_path=args.draft)
+    tokenizer, model = model_service.get_model()
+    draft_model = model_service.get_draft_model()
+    if draft_model is None:
+        print("❌ 没有可用的草稿模型，请通过 --draft 指定")
+        sys.exit(1)
+
+    scheduler = GenerationScheduler()
+    scheduler.start(tokenizer, model, DEVICE, max_batch_size=1, draft_model=draft_model)
+
+    print(f"\n===== 投机解码: 单请求, 每条 {args.max_new_tokens} tokens, temperature={args.temperature} =====")
+    print(f"{'模式':<16}{'tokens/s':>10}{'ms/token':>10}{'接受率':>10}")
+    speed, latency, _ = run_speculative(scheduler, tokenizer, args, speculative=False)
+    print(f"{'off':<16}{speed:>10.1f}{latency:>10.1f}{'-':>10}")
+    for k in args.speculative_tokens:
+        scheduler.speculative_tokens = k
+        speed, latency, rate = run_speculative(scheduler, tokenizer, args, speculative=True)
+        print(f"{'k=' + str(k):<16}{speed:>10.1f}{latency:>10.1f}{rate:>10.1%}")
+
+
+# ================= 8. 多副本 =================
+def launch_replicas(args, num_workers):
+    """启动 launcher.py 子进程，等路由器和所有 worker 就绪"""
+    import httpx
+
+    env = dict(os.environ, BASE_MODEL_PATH=args.base, ADAPTER_PATH=args.adapter)
+    process = subprocess.Popen(
+        [sys.executable, "launcher.py", "--workers", str(num_workers), "--router-host", "127.0.0.1",
+         "--port", str(args.port), "--worker-port", str(args.worker_port)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+    )
+    deadline = time.time() + args.timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"launcher 退出 (退出码 {process.returncode})")
+        try:
+            workers = httpx.get(f"http://127.0.0.1:{args.port}/router/status", timeout=2).json()["workers"]
+            if len(workers) == num_workers:
+                return process
+        except (httpx.HTTPError, ValueError):
+            pass
+        time.sleep(0.5)
+    process.kill()
+    raise RuntimeError("等待多副本启动超时")
+
+
+def replica_memory(process):
+    """worker 进程的 RSS 总和与 PSS 总和 (MB)：共享的 mmap 权重在 PSS 里按进程数平摊，只算一份"""
+    import psutil
+
+    rss = pss = 0
+    for child in psutil.Process(process.pid).children(recursive=True):
+        try:
+            info = child.memory_full_info()
+        except psutil.Error:
+            continue
+        rss += info.rss
+        pss += getattr(info, "pss", info.rss)
+    return rss / 2 ** 20, pss / 2 ** 20
+
+
+async def run_replica_load(base_url, concurrency, num_requests, max_tokens):
+    import httpx
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, tokens = [], []
+
+    async def one(client, i):
+        payload = {
+            "model": "qwen-social-elder",
+            "messages": [{"role": "user", "content": BENCH_PROMPTS[i % len(BENCH_PROMPTS)]}],
+            "max_tokens": max_tokens,
+        }
+        async with semaphore:
+            begin = time.time()
+            response = await client.post(f"{base_url}/v1/chat/completions", json=payload)
+            latencies.append(time.time() - begin)
+            tokens.append(response.json()["usage"]["completion_tokens"])
+
+    async with httpx.AsyncClient(timeout=None) as client:
+        begin = time.time()
+        await asyncio.gather(*[one(client, i) for i in range(num_requests)])
+        elapsed = time.time() - begin
+    return sum(tokens), elapsed, sum(latencies) / len(latencies)
+
+
+def bench_replicas(args):
+    print(f"\n===== 多副本压测 (并发 {args.concurrency}，{args.requests} 个请求，每个最多 {args.max_new_tokens} tokens) =====")
+    print(f"{'worker 数':<10}{'总tokens':>10}{'耗时(s)':>10}{'tokens/s':>12}{'平均延迟(s)':>14}"
+          f"{'RSS(MB)':>12}{'PSS(MB)':>12}")
+    for num_workers in args.workers:
+        process = launch_replicas(args, num_workers)
+        try:
+            base_url = f"http://127.0.0.1:{args.port}"
+            # 预热：每个 worker 至少跑过一次
+            asyncio.run(run_replica_load(base_url, num_workers, num_workers, 4))
+            total, elapsed, latency = asyncio.run(
+                run_replica_load(base_url, args.concurrency, args.requests, args.max_new_tokens))
+            rss, pss = replica_memory(process)
+        finally:
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+        print(f"{num_workers:<10}{total:>10}{elapsed:>10.2f}{total / elapsed:>12.1f}{latency:>14.2f}"
+              f"{rss:>12.0f}{pss:>12.0f}")
+
+
+# ================= 9. 按角色的生成长度 =================
+def run_profile_mode(scheduler, tokenizer, turns, profiles, max_new_tokens):
+    """一次性提交全部请求 (调度器按 batch size 连续批处理)，统计生成长度、截断比例和总耗时"""
+    requests = []
+    begin = time.time()
+    for i, (role_name, question, _) in enumerate(turns):
+        input_ids = build_input_ids(tokenizer, question, role_name)
+        limit, criteria = max_new_tokens, []
+        if profiles is not None:
+            limit = min(profiles.max_new_tokens(role_name), max_new_tokens)
+            criteria = profiles.stopping_criteria(role_name, len(input_ids))
+        request = GenerationRequest(input_ids, max_new_tokens=limit, seed=i, stopping_criteria=criteria)
+        requests.append((request, scheduler.submit(request)))
+
+    lengths, chars, cut = [], [], 0
+    for request, stream in requests:
+        text = "".join(stream)
+        lengths.append(request.num_generated)
+        chars.append(len(text))
+        # 用满 max_new_tokens 且最后不是句末标点：一句话说到一半被截断
+        if request.num_generated >= request.max_new_tokens and not text.rstrip(" ").endswith(SENTENCE_ENDINGS):
+            cut += 1
+    elapsed = time.time() - begin
+    return {
+        "tokens": sum(lengths),
+        "p50": percentile(lengths, 0.5),
+        "p90": percentile(lengths, 0.9),
+        "chars": sum(chars) / len(chars),
+        "cut": cut / len(turns),
+        "elapsed": elapsed,
+    }
+
+
+def bench_profiles(args):
+    model_service.load_model(args.base, args.adapter)
+    tokenizer, model = model_service.get_model()
+
+    profiles = GenerationProfiles(enabled=True)
+    profiles.build(tokenizer, args.train)
+    print("\n===== 各角色参考回复长度 (训练集，token) =====")
+    print(f"{'角色':<8}{'样本数':>8}{'p50':>6}{'p90':>6}{'p99':>6}{'软预算':>8}{'硬预算':>8}")
+    for role_name, profile in profiles.profiles.items():
+        print(f"{role_name:<8}{profile.samples:>8}{profile.p50:>6}{profile.p90:>6}{profile.p99:>6}"
+              f"{profile.soft_budget:>8}{profile.max_new_tokens:>8}")
+
+    with open(args.test, "r", encoding="utf-8") as f:
+        turns = list(opening_turns(json.load(f)))[:args.samples]
+    references = [len(reference) for _, _, reference in turns]
+
+    scheduler = GenerationScheduler()
+    scheduler.start(tokenizer, model, DEVICE, max_batch_size=args.batch_size)
+    print(f"\n===== 测试集回放: {len(turns)} 条开场白, batch size {args.batch_size}, "
+          f"参考回复平均 {sum(references) / len(references):.1f} 字 =====")
+    print(f"{'模式':<20}{'总tokens':>10}{'p50':>6}{'p90':>6}{'平均字数':>10}{'截断率':>8}{'耗时(s)':>10}{'条/s':>8}")
+    for mode, mode_profiles in ((f"固定 {args.max_new_tokens}", None), ("按角色 + 句末停止", profiles)):
+        row = run_profile_mode(scheduler, tokenizer, turns, mode_profiles, args.max_new_tokens)
+        print(f"{mode:<20}{row['tokens']:>10}{row['p50']:>6}{row['p90']:>6}{row['chars']:>10.1f}{row['cut']:>8.1%}"
+              f"{row['elapsed']:>10.2f}{len(turns) / row['elapsed']:>8.2f}")
+
+
+# ================= 10. 优先级调度 =================
+def run_priority_mode(scheduler, tokenizer, args, bulk_priority):
+    """后台按 BATCH_MAX_IN_FLIGHT 持续提交 bulk 请求 (与 /chat/batch 一致)，同时每隔一段时间发一条交互请求，统计其 TTFT"""
+    bulk_done, ttfts = [], []
+    finished = False
+
+    def bulk_worker(indices):
+        for i in indices:
+            request = GenerationRequest(build_input_ids(tokenizer, BENCH_PROMPTS[i % len(BENCH_PROMPTS)]),
+                                        max_new_tokens=args.max_new_tokens, eos_token_ids=[], priority=bulk_priority)
+            for _ in scheduler.submit(request):
+                pass
+            bulk_done.append(i)
+
+    def interactive_probe():
+        while not finished:
+            request = GenerationRequest(build_input_ids(tokenizer, BENCH_PROMPTS[len(ttfts) % len(BENCH_PROMPTS)]),
+                                        max_new_tokens=16, eos_token_ids=[])
+            begin = time.time()
+            stream = scheduler.submit(request)
+            next(stream, None)
+            ttfts.append(time.time() - begin)
+            for _ in stream:
+                pass
+            time.sleep(args.interval)
+
+    preemptions = scheduler.preemptions
+    begin = time.time()
+    workers = [Thread(target=bulk_worker, args=(range(w, args.bulk, BATCH_MAX_IN_FLIGHT),))
+               for w in range(BATCH_MAX_IN_FLIGHT)]
+    for worker in workers:
+        worker.start()
+    probe = Thread(target=interactive_probe)
+    probe.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - begin
+    finished = True
+    probe.join()
+    return {
+        "bulk_rate": len(bulk_done) / elapsed,
+        "p50": percentile(ttfts, 0.5),
+        "p90": percentile(ttfts, 0.9),
+        "max": max(ttfts),
+        "probes": len(ttfts),
+        "preemptions": scheduler.preemptions - preemptions,
+    }
+
+
+def bench_priority(args):
+    model_service.load_model(args.base, args.adapter)
+    tokenizer, model = model_service.get_model()
+    scheduler = GenerationScheduler()
+    scheduler.start(tokenizer, model, DEVICE, max_batch_size=args.batch_size)
+
+    print(f"\n===== 优先级调度: {args.bulk} 条 bulk (每条 {args.max_new_tokens} tokens, 同时 {BATCH_MAX_IN_FLIGHT} 条), "
+          f"batch size {args.batch_size}, 每 {args.interval}s 一条交互请求 =====")
+    print(f"{'模式':<22}{'bulk 条/s':>10}{'TTFT p50(s)':>13}{'p90(s)':>9}{'max(s)':>9}{'交互请求':>8}{'暂停次数':>8}")
+    modes = (
+        ("不分优先级 (FIFO)", "interactive", False),
+        ("分优先级", "bulk", False),
+        ("分优先级 + 暂停 bulk", "bulk", True),
+    )
+    for name, bulk_priority, preempt in modes:
+        scheduler.preempt_bulk = preempt
+        row = run_priority_mode(scheduler, tokenizer, args, bulk_priority)
+        print(f"{name:<22}{row['bulk_rate']:>10.2f}{row['p50']:>13.3f}{row['p90']:>9.3f}{row['max']:>9.3f}"
+              f"{row['probes']:>8}{row['preemptions']:>8}")
+
+
+# ================= 11. 冷启动 =================
+STARTUP_VARIANTS = {
+    "copy": {"MMAP_WEIGHTS": "0", "WARMUP_TOKENS": "0"},
+    "mmap": {"MMAP_WEIGHTS": "1", "WARMUP_TOKENS": "0"},
+    "mmap+warmup": {"MMAP_WEIGHTS": "1"},
+}
+
+
+def run_startup_variant(args, variant):
+    """启动一个 uvicorn 服务进程，轮询 /readyz 直到就绪，再发一个真实请求测首 token 延迟"""
+    import httpx
+
+    env = dict(os.environ, BASE_MODEL_PATH=args.base, ADAPTER_PATH=args.adapter, **STARTUP_VARIANTS[variant])
+    url = f"http://127.0.0.1:{args.port}"
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.port),
+         "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.time() + args.timeout
+        status = None
+        while time.time() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"服务进程退出 (退出码 {process.returncode})")
+            try:
+                response = httpx.get(url + "/readyz", timeout=2)
+                status = response.json()
+                if response.status_code == 200 or status["status"] == "failed":
+                    break
+            except (httpx.HTTPError, ValueError):
+                pass
+            time.sleep(0.1)
+        if status is None or status["status"] != "ready":
+            raise RuntimeError(f"服务没有就绪: {status}")
+
+        payload = {"role": 1, "messages": [{"role": "user", "content": BENCH_PROMPTS[0]}], "seed": 0}
+        begin = time.time()
+        with httpx.stream("POST", url + "/chat/completions", json=payload, timeout=args.timeout) as response:
+            first_token = None
+            for _ in response.iter_bytes():
+                if first_token is None:
+                    first_token = time.time() - begin
+        return status, first_token
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def bench_startup(args):
+    print(f"\n===== 冷启动: {', '.join(args.variants)} =====")
+    for variant in args.variants:
+        status, first_token = run_startup_variant(args, variant)
+        phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in status["phases"].items())
+        print(f"{variant:<14} 冷启动 {status['cold_start_seconds']:>7.2f}s  首个请求 TTFT {first_token:>6.3f}s  ({phases})")
+
+
+# ================= 12. KV Cache 内存预算 =================
+def run_memory_budget(scheduler, tokenizer, args):
+    """同时提交 args.requests 条请求，后台按 GET /queue 同样的数据采样批次行数与预估峰值"""
+    samples = []
+    finished = False
+
+    def sampler():
+        while not finished:
+            status = scheduler.queue_status()
+            samples.append((status["active"], status["memory"]["projected_peak_mb"]))
+            time.sleep(0.01)
+
+    splits = scheduler.memory.oom_splits
+    if DEVICE == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    requests = [GenerationRequest(build_input_ids(tokenizer, BENCH_PROMPTS[i % len(BENCH_PROMPTS)]),
+                                  max_new_tokens=args.max_new_tokens, eos_token_ids=[])
+                for i in range(args.requests)]
+    watcher = Thread(target=sampler)
+    watcher.start()
+    begin = time.time()
+    streams = [scheduler.submit(request) for request in requests]
+    for stream in streams:
+        for _ in stream:
+            pass
+    elapsed = time.time() - begin
+    finished = True
+    watcher.join()
+    return {
+        "max_active": max(active for active, _ in samples),
+        "projected_peak_mb": max(peak for _, peak in samples),
+        "allocated_mb": torch.cuda.max_memory_allocated() / 1024 ** 2 if DEVICE == "cuda" else None,
+        "tokens_per_second": sum(request.num_generated for request in requests) / elapsed,
+        "oom_splits": scheduler.memory.oom_splits - splits,
+    }
+
+
+def bench_memory(args):
+    model_service.load_model(args.base, args.adapter)
+    tokenizer, model = model_service.get_model()
+    scheduler = GenerationScheduler()
+    scheduler.start(tokenizer, model, DEVICE, max_batch_size=args.batch_size, max_queue_depth=0)
+
+    print(f"\n===== KV Cache 内存预算: {args.requests} 条请求同时提交, 每条 {args.max_new_tokens} tokens, "
+          f"batch size {args.batch_size}, 每 token {scheduler.memory.bytes_per_token} 字节 =====")
+    print(f"{'预算(MB)':>10}{'最多同时解码':>12}{'预估峰值(MB)':>14}{'实际峰值(MB)':>14}{'tokens/s':>10}{'OOM 拆分':>9}")
+    for budget_mb in args.budgets:
+        scheduler.memory.configure(model, DEVICE, budget_mb)
+        label = "不限制" if budget_mb < 0 else f"{scheduler.memory.budget / 1024 ** 2:.0f}"
+        row = run_memory_budget(scheduler, tokenizer, args)
+        allocated = "-" if row["allocated_mb"] is None else f"{row['allocated_mb']:.0f}"
+        print(f"{label:>10}{row['max_active']:>12}{row['projected_peak_mb']:>14.1f}{allocated:>14}"
+              f"{row['tokens_per_second']:>10.1f}{row['oom_splits']:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="推理服务性能基准测试")
+    parser.add_argument("--base", default=BASE_MODEL_PATH, help="基座模型路径")
+    parser.add_argument("--adapter", default=ADAPTER_PATH, help="LoRA 适配器路径")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("scheduler", help="连续批处理调度器 vs 每请求一个线程")
+    p.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    p.add_argument("--max-new-tokens", type=int, default=64)
+    p.set_defaults(func=bench_scheduler)
+
+    p = sub.add_parser("prefix", help="角色前缀 KV Cache 对首 token 延迟的影响")
+    p.add_argument("--repeats", type=int, default=20)
+    p.set_defaults(func=bench_prefix)
+
+    p = sub.add_parser("interleave", help="检查并发 SSE 流是否交错输出、事件循环是否被阻塞")
+    p.add_argument("--concurrency", type=int, default=4)
+    p.add_argument("--port", type=int, default=8765)
+    p.set_defaults(func=bench_interleave)
+
+    p = sub.add_parser("merged", help="PEFT (LoRA 旁路) vs 合并权重的解码吞吐")
+    p.add_argument("--batch-size", type=int, nargs="+", default=[1, 4, 8])
+    p.add_argument("--max-new-tokens", type=int, default=128)
+    p.set_defaults(func=bench_merged)
+
+    p = sub.add_parser("cpu", help="CPU 推理配置 (精度/量化/compile) 的解码吞吐与峰值内存")
+    p.add_argument("--variants", nargs="+", default=["fp32", "bf16", "int8", "bf16+compile"])
+    p.add_argument("--threads", type=int, default=0, help="推理线程数，0 表示 CPU 核数")
+    p.add_argument("--batch-size", type=int, nargs="+", default=[1, 4])
+    p.add_argument("--max-new-tokens", type=int, default=32)
+    p.add_argument("--tiny", action="store_true", help="使用随机初始化的 2 层小模型 (不需要适配器)")
+    p.set_defaults(func=bench_cpu)
+
+    p = sub.add_parser("semantic", help="语义回复缓存在测试集回放上的命中率与查询延迟")
+    p.add_argument("--seed", default=SEMANTIC_CACHE_SEED, help="建索引用的数据集")
+    p.add_argument("--replay", default="../data/train_test/test_cleaned.json", help="回放的数据集")
+    p.add_argument("--thresholds", type=float, nargs="+", default=[0.5, 0.6, 0.7, 0.8, 0.9])
+    p.set_defaults(func=bench_semantic)
+
+    p = sub.add_parser("speculative", help="投机解码对单请求每 token 延迟的影响")
+    p.add_argument("--draft", default=DRAFT_MODEL_PATH, help="草稿模型路径")
+    p.add_argument("--speculative-tokens", type=int, nargs="+", default=[2, 4, 6])
+    p.add_argument("--max-new-tokens", type=int, default=64)
+    p.add_argument("--temperature", type=float, default=0.85)
+    p.add_argument("--repeats", type=int, default=6)
+    p.set_defaults(func=bench_speculative)
+
+    p = sub.add_parser("replicas", help="多副本 (launcher + router) 的吞吐随 worker 数的变化与内存占用")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--requests", type=int, default=64)
+    p.add_argument("--max-new-tokens", type=int, default=64)
+    p.add_argument("--port", type=int, default=8800)
+    p.add_argument("--worker-port", type=int, default=8810)
+    p.add_argument("--timeout", type=float, default=600)
+    p.set_defaults(func=bench_replicas)
+
+    p = sub.add_parser("profiles", help="按角色的生成长度 + 句末停止 vs 固定 max_new_tokens (测试集回放)")
+    p.add_argument("--train", default=GENERATION_PROFILE_DATA, help="统计长度分布用的训练集")
+    p.add_argument("--test", default="../data/train_test/test_cleaned.json", help="回放的测试集")
+    p.add_argument("--samples", type=int, default=100)
+    p.add_argument("--batch-size", type=int, default=8)
+    p.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS, help="固定模式的生成上限 (服务默认值)")
+    p.set_defaults(func=bench_profiles)
+
+    p = sub.add_parser("priority", help="批量任务运行期间交互请求的首 token 延迟 (优先级 / 暂停 bulk)")
+    p.add_argument("--bulk", type=int, default=285, help="bulk 请求条数")
+    p.add_argument("--batch-size", type=int, default=8)
+    p.add_argument("--max-new-tokens", type=int, default=64, help="每条 bulk 请求生成的 token 数")
+    p.add_argument("--interval", type=float, default=0.2, help="两条交互请求之间的间隔 (秒)")
+    p.set_defaults(func=bench_priority)
+
+    p = sub.add_parser("startup", help="服务冷启动耗时 (进程启动到 /readyz 就绪) 与就绪后第一个请求的首 token 延迟")
+    p.add_argument("--variants", nargs="+", default=list(STARTUP_VARIANTS), choices=list(STARTUP_VARIANTS))
+    p.add_argument("--port", type=int, default=8890)
+    p.add_argument("--timeout", type=float, default=600)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("memory", help="KV Cache 内存预算对同时解码行数、峰值与吞吐的影响")
+    p.add_argument("--budgets", type=int, nargs="+", default=[-1, 0, 64, 16], help="预算 (MB)，-1 不限制，0 自动")
+    p.add_argument("--requests", type=int, default=16)
+    p.add_argument("--batch-size", type=int, default=8)
+    p.add_argument("--max-new-tokens", type=int, default=128)
+    p.set_defaults(func=bench_memory)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import os
+
+# ================= 推理服务配置区域 =================
+# 所有参数都可以通过同名环境变量覆盖，方便在不同机器上部署
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+# 1. 连续批处理：同一批次内最多同时解码的序列数
+MAX_BATCH_SIZE = _env_int("MAX_BATCH_SIZE", 8)
+
+# 2. 多轮对话 KV Cache 的总预算 (MB)，超出后按 LRU 淘汰
+CONVERSATION_CACHE_MB = _env_int("CONVERSATION_CACHE_MB", 512)
+
+# 3. SSE 推送节奏：none / human / coalesce (请求里可以用 pacing 字段单独指定)
+SSE_PACING = os.environ.get("SSE_PACING", "coalesce")
+# coalesce 模式下，一帧最多攒多久 (毫秒) / 最多攒多少字符
+COALESCE_WINDOW_MS = _env_int("COALESCE_WINDOW_MS", 80)
+COALESCE_MAX_CHARS = _env_int("COALESCE_MAX_CHARS", 64)
+
+# 4. 上下文窗口：prompt + max_new_tokens 不超过该值，超出时从最早的对话开始成对截断
+CONTEXT_WINDOW = _env_int("CONTEXT_WINDOW", 2048)
+# 单次回复最多生成的 token 数
+MAX_NEW_TOKENS = _env_int("MAX_NEW_TOKENS", 512)
+
+# 5. 准入控制：等待调度的请求最多排队多少个，队列满时返回 503 + Retry-After
+MAX_QUEUE_DEPTH = _env_int("MAX_QUEUE_DEPTH", 32)
+RETRY_AFTER_SECONDS = _env_int("RETRY_AFTER_SECONDS", 2)
+
+# 6. 多角色 LoRA：ROLE_ADAPTER_DIR/<角色英文标识> (如 elder、mentor) 下有适配器时启动自动加载，
+#    所有适配器共享同一份基座权重；没有专属适配器的角色继续使用通用适配器
+ROLE_ADAPTER_DIR = os.environ.get("ROLE_ADAPTER_DIR", "../models/role_adapters")
+# 管理接口 (/admin/*) 的访问令牌，通过请求头 X-Admin-Token 传入；为空时不校验
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# 7. 合并权重快速路径：没有角色专属适配器时，把 LoRA 合并进基座权重，省掉每层每个 token 的旁路矩阵乘。
+#    合并结果按 (基座, 适配器) 的哈希缓存到 MERGED_CACHE_DIR，之后启动直接加载合并好的 safetensors。
+#    合并后不能再通过 /admin/adapters 热加载 / 卸载适配器，需要这个功能时设为 0
+MERGE_WEIGHTS = os.environ.get("MERGE_WEIGHTS", "1") == "1"
+MERGED_CACHE_DIR = os.environ.get("MERGED_CACHE_DIR", "../models/merged_cache")
+
+# 8. CPU 推理配置 (没有 GPU、DEVICE 为 cpu 时生效)
+# 权重精度：bf16 / fp32 (CPU 上 fp16 矩阵乘非常慢甚至不支持)
+CPU_DTYPE = os.environ.get("CPU_DTYPE", "bf16")
+# Linear 层量化：none / int8 (torch 动态量化，激活为 fp32) / int8-weight (torchao 仅权重量化，需安装 torchao)
+CPU_QUANTIZE = os.environ.get("CPU_QUANTIZE", "none")
+# 推理线程数，0 表示使用 torch 默认值 (物理核数)
+CPU_THREADS = _env_int("CPU_THREADS", 0)
+# 是否用 torch.compile 编译模型 forward (首个请求会有较长的编译时间)
+TORCH_COMPILE = os.environ.get("TORCH_COMPILE", "0") == "1"
+
+# 9. 精确匹配回复缓存：角色、历史、采样参数、seed、适配器版本都相同的请求直接回放缓存的回复。
+#    只有结果可复现的请求 (带 seed，或 temperature <= 0 的贪心解码) 才会走缓存；RESPONSE_CACHE_SIZE=0 关闭
+RESPONSE_CACHE_SIZE = _env_int("RESPONSE_CACHE_SIZE", 1024)
+# 缓存条目的有效期 (秒)
+RESPONSE_CACHE_TTL = _env_int("RESPONSE_CACHE_TTL", 600)
+
+# 10. 语义回复缓存：新对话的第一句与已收录的问题足够相似 (余弦相似度 >= 阈值) 时直接返回收录的高质量回复。
+#     默认关闭 (SEMANTIC_CACHE=1 开启)，启动时从训练集收录每段对话的开场问答
+SEMANTIC_CACHE = os.environ.get("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.8))
+# 每个角色最多收录多少条，超出后淘汰最久没有命中的条目
+SEMANTIC_CACHE_CAPACITY = _env_int("SEMANTIC_CACHE_CAPACITY", 1024)
+SEMANTIC_CACHE_SEED = os.environ.get("SEMANTIC_CACHE_SEED", "../data/train_test/train_cleaned.json")
+
+# 11. 投机解码：DRAFT_MODEL_PATH 指向与基座同词表的小模型 (如 Qwen2.5-0.5B-Instruct) 时启用，为空则关闭。
+#     只在批次里只有一条序列 (低负载) 时生效：草稿模型每步先猜 SPECULATIVE_TOKENS 个 token，大模型一次 forward 验证
+DRAFT_MODEL_PATH = os.environ.get("DRAFT_MODEL_PATH", "")
+SPECULATIVE_TOKENS = _env_int("SPECULATIVE_TOKENS", 4)
+
+# 12. 批量生成 (/chat/batch)：单次最多提交多少条，同时交给调度器的最多多少条 (其余按长度排队，避免挤满等待队列)
+BATCH_MAX_ITEMS = _env_int("BATCH_MAX_ITEMS", 1000)
+BATCH_MAX_IN_FLIGHT = _env_int("BATCH_MAX_IN_FLIGHT", 8)
+# 内存中最多保留多少个批量任务的结果 (超出后淘汰最早完成的任务)
+BATCH_MAX_JOBS = _env_int("BATCH_MAX_JOBS", 100)
+
+# 13. 请求追踪：每个请求结束时输出一条 JSON 日志，记录各阶段耗时 (REQUEST_TRACE=0 关闭)
+REQUEST_TRACE = os.environ.get("REQUEST_TRACE", "1") == "1"
+# 追踪日志写入的文件，为空时输出到 stderr
+TRACE_LOG_FILE = os.environ.get("TRACE_LOG_FILE", "")
+# POST /admin/profile 导出的 torch.profiler Chrome trace 保存目录
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "../logs/profiles")
+
+# 14. 多副本部署 (launcher.py + router.py)
+# 模型权重 (合并权重缓存、PEFT 模式的基座、草稿模型) 以 mmap 方式加载：仅 CPU、本地 safetensors，且文件里的 dtype 与推理 dtype
+# 一致时生效 (例如 bf16 保存的基座在 CPU_DTYPE=fp32 时仍走 from_pretrained)；同一台机器上的多个 worker 共享一份物理内存，
+# 单个进程启动时也省掉一次完整的权重拷贝 (页面在第一次 forward 时按需读入)；MMAP_WEIGHTS=0 改回 from_pretrained
+MMAP_WEIGHTS = os.environ.get("MMAP_WEIGHTS", "1") == "1"
+# 路由器转发的 worker 地址，逗号分隔 (launcher.py 启动时自动设置)
+ROUTER_WORKERS = os.environ.get("ROUTER_WORKERS", "http://127.0.0.1:8100")
+# 会话粘性表最多记录多少个会话 (按 LRU 淘汰)，同一会话始终转发到同一个 worker 以命中多轮 KV Cache
+ROUTER_STICKY_SESSIONS = _env_int("ROUTER_STICKY_SESSIONS", 10000)
+
+# 15. WebSocket 会话 (/ws/chat)：服务端保存会话历史，客户端每轮只发送新消息
+# 内存中最多保留多少个会话 (按 LRU 淘汰)，以及多久 (秒) 没有活动的会话视为过期
+SESSION_MAX = _env_int("SESSION_MAX", 1000)
+SESSION_TTL = _env_int("SESSION_TTL", 3600)
+# 一轮生成最多占用会话多久 (秒)：收尾逻辑因为异常没有执行时，超时后自动解除占用，会话不会一直返回 409
+SESSION_BUSY_TIMEOUT = _env_int("SESSION_BUSY_TIMEOUT", 600)
+
+# 16. 会话持久化：SQLite (WAL 模式) 保存全部会话消息 (只追加不修改)，多个 worker 进程共用同一个数据库文件
+CONVERSATION_DB = os.environ.get("CONVERSATION_DB", "../logs/conversations.db")
+# 加载会话历史时最多取最近多少条消息 (之后再按 token 预算截断)，内存中的会话也只保留这么多
+SESSION_HISTORY_LIMIT = _env_int("SESSION_HISTORY_LIMIT", 64)
+
+# 17. 按角色的生成长度：从训练集统计每个角色参考回复的 token 数分布 (GENERATION_PROFILES=0 关闭，统一用 MAX_NEW_TOKENS)
+#     生成超过 GENERATION_SOFT_QUANTILE 分位数后，遇到句末标点就结束；到 GENERATION_HARD_RATIO 倍时强制截断 (不超过 MAX_NEW_TOKENS)
+GENERATION_PROFILES = os.environ.get("GENERATION_PROFILES", "1") == "1"
+GENERATION_PROFILE_DATA = os.environ.get("GENERATION_PROFILE_DATA", "../data/train_test/train_cleaned.json")
+GENERATION_SOFT_QUANTILE = float(os.environ.get("GENERATION_SOFT_QUANTILE", 0.9))
+GENERATION_HARD_RATIO = float(os.environ.get("GENERATION_HARD_RATIO", 2.0))
+
+# 18. 优先级与公平调度：interactive (在线聊天) 总是先于 bulk (批量生成 / 离线评测) 准入，同一优先级内按租户 (没有时按角色) 轮流准入
+# 批次已满时，交互请求暂停最近加入的 bulk 序列 (KV Cache 暂存，名额空出后从断点继续解码)；PREEMPT_BULK=0 关闭
+PREEMPT_BULK = os.environ.get("PREEMPT_BULK", "1") == "1"
+# bulk 序列最多同时占用批次中的多少个名额 (0 表示不限)：批次越小每个 decode step 越快，交互请求的 token 间隔也越短
+BULK_MAX_ACTIVE = _env_int("BULK_MAX_ACTIVE", 0)
+
+# 19. KV Cache 内存预算：准入新请求前按 prompt 长度 + max_new_tokens 预估整个批次的 KV Cache 峰值，超出预算的请求先排队。
+#     KV_MEMORY_BUDGET_MB > 0 为固定预算；= 0 时取模型加载后剩余显存 / 内存的 KV_MEMORY_FRACTION；< 0 不限制。
+#     仍然 OOM 时批次拆成两半重试，不会让整个批次的请求失败；上限临时降到出错时的用量，
+#     之后每连续成功 KV_OOM_RECOVERY_STEPS 个 decode step 翻一倍，直到回到配置的预算
+KV_MEMORY_BUDGET_MB = _env_int("KV_MEMORY_BUDGET_MB", 0)
+KV_MEMORY_FRACTION = float(os.environ.get("KV_MEMORY_FRACTION", 0.8))
+KV_OOM_RECOVERY_STEPS = _env_int("KV_OOM_RECOVERY_STEPS", 64)
+
+# 20. 启动预热：模型加载完成后，每个角色用一句合成的开场白走一遍完整的生成流程 (chat template、prefill、批量 decode)，
+#     预热完成后 /readyz 才返回 200，第一个真实用户不再承担首次调用的开销；WARMUP_TOKENS=0 跳过预热
+WARMUP_TOKENS = _env_int("WARMUP_TOKENS", 8)
+WARMUP_PROMPT = os.environ.get("WARMUP_PROMPT", "你好")
@@ -0,0 +1,93 @@
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+
+from config import CONTEXT_WINDOW
+
+
+# ================= 按 token 预算截断上下文 =================
+class TokenCounter:
+    """
+    统计消息 token 数，并按内容哈希缓存结果：
+    前端每一轮都会重发完整历史，已经数过的消息直接查表，不需要每轮重新 tokenize 全部历史
+    """
+
+    def __init__(self, max_entries=50000):
+        self.tokenizer = None
+        self.max_entries = max_entries
+        self.counts = OrderedDict()
+        self.lock = Lock()
+        # chat template 为每条消息额外添加的 token (<|im_start|>role\n ... <|im_end|>\n)
+        self.message_overhead = 0
+        # add_generation_prompt 追加的 token (<|im_start|>assistant\n)
+        self.generation_overhead = 0
+
+    def setup(self, tokenizer):
+        self.tokenizer = tokenizer
+        system = [{"role": "system", "content": ""}]
+        base = self._template_len(system)
+        self.message_overhead = max(
+            self._template_len(system + [{"role": role, "content": ""}]) - base
+            for role in ("user", "assistant")
+        )
+        self.generation_overhead = self._template_len(system, add_generation_prompt=True) - base
+
+    def _template_len(self, messages, add_generation_prompt=False):
+        text = self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=add_generation_prompt
+        )
+        return len(self.tokenizer(text, add_special_tokens=False).input_ids)
+
+    def count(self, text):
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self.lock:
+            if key in self.counts:
+                self.counts.move_to_end(key)
+                return self.counts[key]
+
+        n = len(self.tokenizer(text, add_special_tokens=False).input_ids)
+        with self.lock:
+            self.counts[key] = n
+            if len(self.counts) > self.max_entries:
+                self.counts.popitem(last=False)
+        return n
+
+    def message_tokens(self, message):
+        return self.count(message["content"]) + self.message_overhead
+
+
+class ContextTooLongError(Exception):
+    pass
+
+
+def truncate_history(system_prompt, messages, max_new_tokens, window=CONTEXT_WINDOW):
+    """
+    按 token 预算截断对话历史：保证 prompt + max_new_tokens 不超过上下文窗口。
+    从最早的消息开始成对 (user + assistant) 丢弃，最后一条用户消息必须保留。
+    """
+    budget = window - max_new_tokens - token_counter.generation_overhead
+    budget -= token_counter.count(system_prompt) + token_counter.message_overhead
+
+    costs = [token_counter.message_tokens(msg) for msg in messages]
+    total = sum(costs)
+    start = 0
+    while total > budget and start < len(messages) - 1:
+        # 成对丢弃最早的一轮，但不能把最后一条消息也丢掉
+        drop = 2 if start + 2 < len(messages) else 1
+        total -= sum(costs[start:start + drop])
+        start += drop
+
+    # 截断后不要以 assistant 消息开头
+    while start < len(messages) - 1 and messages[start]["role"] == "assistant":
+        total -= costs[start]
+        start += 1
+
+    if total > budget:
+        raise ContextTooLongError(
+            f"消息过长：需要 {total} tokens，当前最多允许 {max(budget, 0)} tokens"
+        )
+    return messages[start:]
+
+
+# 全局单例
+token_counter = TokenCounter()
@@ -0,0 +1,266 @@
+"""
+会话持久化 (SQLite，WAL 模式)
+
+    python conversation_store.py export ../data/train_test/collected.json [--min-turns 2]
+
+把数据库里的对话导出成训练数据格式 (每段对话一条 {"messages": [system, user, assistant, ...]})
+"""
+import argparse
+import json
+import os
+import sqlite3
+import time
+from threading import Lock
+
+from config import CONVERSATION_DB
+
+# ================= 会话持久化 =================
+# 所有会话消息写入一个 SQLite 文件，不依赖外部服务：
+# - WAL 模式：读写互不阻塞，多个 worker 进程 (launcher.py) 可以同时读写同一个文件
+# - 消息只追加 (INSERT)，从不修改或删除；“清空历史”也是追加一条 reset 标记，并把会话的 history_start 移到标记之后
+# - (session_id, seq) 唯一索引：按会话分页读取、取最近 N 条都走索引
+# 数据库同时是一份对话日志，可以用本文件的 export 命令整理回 data/ 的训练格式
+
+RESET = "reset"  # 清空历史时追加的标记消息，content 记录标记之前那段对话的角色
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    role TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    history_start INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    UNIQUE (session_id, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated_at);
+"""
+
+
+def _session_dict(row):
+    return {
+        "session_id": row["session_id"],
+        "role": row["role"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+        "messages": row["message_count"],
+        "history_start": row["history_start"],
+    }
+
+
+def _message_dict(row):
+    return {"seq": row["seq"], "role": row["role"], "content": row["content"], "created_at": row["created_at"]}
+
+
+class ConversationStore:
+    def __init__(self, path=CONVERSATION_DB):
+        self.path = path
+        self.lock = Lock()
+        self.conn = None
+
+    def _connect(self):
+        # 第一次用到时才打开 (只调用 /chat/completions 且不带 session_id 的部署不会创建数据库文件)
+        if self.conn is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            # WAL 下 NORMAL 足够安全 (掉电最多丢最后几个事务)，每次提交不必 fsync
+            conn.execute("PRAGMA synchronous=NORMAL")
+            # 其他进程正在写入时等待，而不是直接报 database is locked
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.executescript(SCHEMA)
+            self.conn = conn
+        return self.conn
+
+    def get_session(self, session_id):
+        with self.lock:
+            row = self._connect().execute("SELECT * FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return _session_dict(row) if row else None
+
+    def start_session(self, session_id, role_name):
+        """会话不存在时创建；已存在但角色不同时先追加 reset 标记，旧历史不再参与生成"""
+        now = time.time()
+        with self.lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT * FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+                if row is None:
+                    conn.execute("INSERT INTO sessions (session_id, role, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                                 (session_id, role_name, now, now))
+                elif row["role"] != role_name:
+                    if row["history_start"] < row["message_count"]:
+                        self._append_rows(conn, session_id, row["message_count"],
+                                          [{"role": RESET, "content": row["role"]}], now)
+                    conn.execute("UPDATE sessions SET role = ?, history_start = message_count WHERE session_id = ?",
+                                 (role_name, session_id))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _append_rows(self, conn, session_id, start_seq, messages, now):
+        conn.executemany(
+            "INSERT INTO messages (session_id, seq, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(session_id, start_seq + i, msg["role"], msg["content"], now) for i, msg in enumerate(messages)],
+        )
+        conn.execute("UPDATE sessions SET message_count = message_count + ?, updated_at = ? WHERE session_id = ?",
+                     (len(messages), now, session_id))
+
+    def append(self, session_id, messages):
+        """追加一轮 (或客户端带来的一段) 消息，返回会话的消息总数；会话必须已经 start_session"""
+        if not messages:
+            return None
+        with self.lock:
+            conn = self._connect()
+            # IMMEDIATE：一开始就拿写锁，多个进程同时追加同一个会话时 seq 不会冲突
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT message_count FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+                if row is None:
+                    raise KeyError(session_id)
+                self._append_rows(conn, session_id, row["message_count"], messages, time.time())
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return row["message_count"] + len(messages)
+
+    def reset(self, session_id):
+        """清空会话历史：追加 reset 标记，之后的生成只看到标记之后的消息 (旧消息仍保留在日志里)"""
+        with self.lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT * FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+                # 上次 reset 之后没有新消息时不再重复追加标记
+                if row is not None and row["history_start"] < row["message_count"]:
+                    self._append_rows(conn, session_id, row["message_count"],
+                                      [{"role": RESET, "content": row["role"]}], time.time())
+                    conn.execute("UPDATE sessions SET history_start = message_count WHERE session_id = ?",
+                                 (session_id,))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def history(self, session_id, limit):
+        """当前历史 (最近一次 reset 之后) 的最后 limit 条消息，按时间顺序"""
+        with self.lock:
+            rows = self._connect().execute(
+                "SELECT m.role, m.content FROM messages m JOIN sessions s ON s.session_id = m.session_id "
+                "WHERE m.session_id = ? AND m.seq >= s.history_start ORDER BY m.seq DESC LIMIT ?",
+                (session_id, limit),
+            ).fetchall()
+        return [{"role": row["role"], "content": row["content"]} for row in reversed(rows)]
+
+    def messages(self, session_id, before=None, limit=50):
+        """分页读取完整日志 (含 reset 标记)：从新到旧翻页，before 传上一页返回的 next_before"""
+        with self.lock:
+            rows = self._connect().execute(
+                "SELECT * FROM messages WHERE session_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (session_id, before if before is not None else 1 << 62, limit),
+            ).fetchall()
+        messages = [_message_dict(row) for row in reversed(rows)]
+        next_before = messages[0]["seq"] if len(rows) == limit and messages[0]["seq"] > 0 else None
+        return {"messages": messages, "next_before": next_before}
+
+    def list_sessions(self, before=None, limit=20):
+        """按最近活动时间从新到旧分页，before 传上一页返回的 next_before"""
+        with self.lock:
+            rows = self._connect().execute(
+                "SELECT * FROM sessions WHERE updated_at < ? ORDER BY updated_at DESC LIMIT ?",
+                (before if before is not None else float("inf"), limit),
+            ).fetchall()
+        sessions = [_session_dict(row) for row in rows]
+        next_before = sessions[-1]["updated_at"] if len(rows) == limit else None
+        return {"sessions": sessions, "next_before": next_before}
+
+    def stats(self):
+        with self.lock:
+            conn = self._connect()
+            sessions = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            messages = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        return {"path": self.path, "sessions": sessions, "messages": messages}
+
+    def iter_dialogues(self, min_turns=1):
+        """按 reset 标记切分成一段段对话，产出 (角色, [user/assistant 消息])；只保留以 assistant 结尾的完整轮次"""
+        with self.lock:
+            conn = self._connect()
+            roles = {row["session_id"]: row["role"] for row in conn.execute("SELECT session_id, role FROM sessions")}
+            rows = conn.execute("SELECT session_id, role, content FROM messages ORDER BY session_id, seq").fetchall()
+
+        def finish(role_name, dialogue):
+            while dialogue and dialogue[-1]["role"] != "assistant":
+                dialogue.pop()
+            if role_name is not None and len(dialogue) >= 2 * min_turns:
+                return role_name, dialogue
+            return None
+
+        current, dialogue = None, []
+        for row in rows:
+            if row["session_id"] != current:
+                # 会话的最后一段属于会话当前的角色
+                done = finish(roles.get(current), dialogue)
+                current, dialogue = row["session_id"], []
+            elif row["role"] == RESET:
+                # 被 reset 截断的一段属于标记里记录的角色
+                done = finish(row["content"], dialogue)
+                dialogue = []
+            else:
+                done = None
+            if done:
+                yield done
+            if row["role"] != RESET:
+                dialogue.append({"role": row["role"], "content": row["content"]})
+        done = finish(roles.get(current), dialogue)
+        if done:
+            yield done
+
+
+# 全局单例
+conversation_store = ConversationStore()
+
+
+def export_dialogues(output_path, min_turns=1):
+    """导出成 data/ 下训练集的格式，system 使用每段对话所属角色的默认 Prompt"""
+    from roles import ROLE_PROMPTS
+
+    records = [
+        {"messages": [{"role": "system", "content": ROLE_PROMPTS[role_name]}] + dialogue}
+        for role_name, dialogue in conversation_store.iter_dialogues(min_turns)
+        if role_name in ROLE_PROMPTS
+    ]
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(records, f, ensure_ascii=False, indent=2)
+    return len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="会话数据库工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export = subparsers.add_parser("export", help="导出为训练数据格式 (JSON 列表)")
+    export.add_argument("output")
+    export.add_argument("--min-turns", type=int, default=1, help="至少包含多少轮问答的对话才导出")
+    subparsers.add_parser("stats", help="查看会话数和消息数")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        count = export_dialogues(args.output, args.min_turns)
+        print(f"✅ 已导出 {count} 段对话: {args.output}")
+    else:
+        print(conversation_store.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import torch
+
+from config import CPU_DTYPE, CPU_QUANTIZE, CPU_THREADS, TORCH_COMPILE
+
+
+# ================= CPU 推理配置 =================
+# GPU 上沿用 fp16；CPU 上按 CPU_DTYPE 选择 bf16/fp32，并可选量化 Linear 层、限制线程数、torch.compile
+
+CPU_DTYPES = {"bf16": torch.bfloat16, "fp32": torch.float32}
+QUANTIZE_MODES = ("none", "int8", "int8-weight")
+
+
+def model_dtype(device, cpu_dtype=CPU_DTYPE, quantize=CPU_QUANTIZE):
+    if device != "cpu":
+        return torch.float16
+    if cpu_dtype not in CPU_DTYPES:
+        raise ValueError(f"CPU_DTYPE 只能是 {tuple(CPU_DTYPES)} 之一")
+    if quantize == "int8":
+        # 动态量化的 Linear 只接受 fp32 激活，其余层 (Embedding/Norm) 也只能用 fp32
+        return torch.float32
+    return CPU_DTYPES[cpu_dtype]
+
+
+def setup_threads(num_threads=CPU_THREADS):
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+
+def _is_base_linear(module, name):
+    # LoRA 的 lora_A / lora_B 保持浮点：PEFT 混合批次按 lora_A.weight.dtype 转换输入，量化后无法工作
+    return isinstance(module, torch.nn.Linear) and not any(part.startswith("lora_") for part in name.split("."))
+
+
+def quantize_linear(model, mode=CPU_QUANTIZE):
+    """把模型 (基座部分) 的 nn.Linear 量化为 int8，权重内存约为 fp32 的 1/4、bf16 的 1/2"""
+    if mode not in QUANTIZE_MODES:
+        raise ValueError(f"CPU_QUANTIZE 只能是 {QUANTIZE_MODES} 之一")
+    if mode == "int8":
+        # 权重按 int8 存储，激活在每次矩阵乘前动态量化
+        qconfig_spec = {
+            name: torch.ao.quantization.default_dynamic_qconfig
+            for name, module in model.named_modules()
+            if _is_base_linear(module, name)
+        }
+        # 原地替换 Linear 层：默认 (inplace=False) 会先深拷贝整个模型，启动时的内存峰值翻倍
+        return torch.ao.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+    if mode == "int8-weight":
+        try:
+            from torchao.quantization import quantize_, Int8WeightOnlyConfig
+        except ImportError:
+            raise RuntimeError("CPU_QUANTIZE=int8-weight 需要先安装 torchao: pip install torchao")
+        # 只量化权重，激活保持 bf16/fp32
+        quantize_(model, Int8WeightOnlyConfig(), filter_fn=_is_base_linear)
+    return model
+
+
+def compile_forward(model):
+    """
+    只编译 forward，模型对象本身不变 (peft_config / generation_config 等属性照常访问)。
+    调度器每步的 batch 大小和缓存长度都在变化，使用 dynamic=True 避免反复重新编译
+    """
+    model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
+
+def prepare_cpu_model(model, quantize=CPU_QUANTIZE, compile_model=TORCH_COMPILE):
+    model = quantize_linear(model, quantize)
+    if compile_model:
+        model = compile_forward(model)
+    return model
+
+
+def describe(device, quantize=CPU_QUANTIZE, num_threads=CPU_THREADS, compile_model=TORCH_COMPILE):
+    if device != "cpu":
+        return "GPU (FP16)"
+    dtype = str(model_dtype(device, quantize=quantize)).replace("torch.", "")
+    threads = num_threads if num_threads > 0 else torch.get_num_threads()
+    return f"CPU ({dtype}, quantize={quantize}, threads={threads}, compile={compile_model})"
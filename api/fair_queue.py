@@ -0,0 +1,84 @@
+from collections import OrderedDict, deque
+from queue import Empty, Full
+from threading import Condition
+
+# ================= 优先级与公平排队 =================
+# 调度器的等待队列，分两个优先级：
+# - interactive：在线聊天 (/chat/completions、/ws/chat、默认的 /v1/chat/completions)，总是先于 bulk 准入
+# - bulk：批量生成、离线评测、数据生成，只用交互请求剩下的名额，批次满时还会被交互请求暂停 (见 scheduler.py)
+# 同一优先级内按“公平键”(租户，没有时为角色) 分成多个 FIFO，轮流各取一个：
+# 一个租户一次提交几百条，也不会让其他租户的请求排在它们全部后面。
+# 两个优先级各自有 max_depth 的上限，bulk 堆满不会导致交互请求被 503 拒绝
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PRIORITIES = (INTERACTIVE, BULK)
+
+
+class FairQueue:
+    def __init__(self, max_depth=0):
+        self.max_depth = max_depth  # 每个优先级最多排队多少个 (0 表示不限制)
+        self.condition = Condition()
+        # 优先级 -> 公平键 -> deque；OrderedDict 的顺序即轮转顺序，取过的键移到末尾
+        self.queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self.sizes = {priority: 0 for priority in PRIORITIES}
+
+    @staticmethod
+    def _key(request):
+        return request.tenant or request.role or ""
+
+    def put_nowait(self, request):
+        with self.condition:
+            if self.max_depth and self.sizes[request.priority] >= self.max_depth:
+                raise Full
+            self.queues[request.priority].setdefault(self._key(request), deque()).append(request)
+            self.sizes[request.priority] += 1
+            self.condition.notify()
+
+    def requeue_front(self, request):
+        """放回队首 (不受上限限制)：暂时准入不了的请求下次仍然第一个被取出"""
+        with self.condition:
+            queues = self.queues[request.priority]
+            key = self._key(request)
+            queues.setdefault(key, deque()).appendleft(request)
+            queues.move_to_end(key, last=False)
+            self.sizes[request.priority] += 1
+            self.condition.notify()
+
+    def _pop(self, priority):
+        queues = self.queues[priority]
+        key, items = next(iter(queues.items()))
+        request = items.popleft()
+        if items:
+            queues.move_to_end(key)
+        else:
+            del queues[key]
+        self.sizes[priority] -= 1
+        return request
+
+    def get(self, block=True, timeout=None, priorities=PRIORITIES):
+        """按优先级顺序取出一个请求；priorities 限定只取哪些优先级"""
+        with self.condition:
+            while True:
+                for priority in priorities:
+                    if self.sizes[priority]:
+                        return self._pop(priority)
+                if not block:
+                    raise Empty
+                if not self.condition.wait(timeout):
+                    raise Empty
+                # 被唤醒后再检查一次，之后不再等待
+                block = False
+
+    def has_waiting(self, priority):
+        return self.sizes[priority] > 0
+
+    def qsize(self):
+        return sum(self.sizes.values())
+
+    def status(self):
+        with self.condition:
+            return {
+                priority: {"queued": self.sizes[priority], "tenants": len(self.queues[priority])}
+                for priority in PRIORITIES
+            }
@@ -0,0 +1,86 @@
+import math
+
+from config import MAX_NEW_TOKENS, GENERATION_PROFILES, GENERATION_SOFT_QUANTILE, GENERATION_HARD_RATIO
+from roles import tokenized_roles
+from stopping import ClauseStoppingCriteria
+
+# ================= 按角色的生成长度 =================
+# 训练集里的参考回复大多只有一到三句话，所有请求都按 MAX_NEW_TOKENS (512) 生成既慢又容易越说越长。
+# 启动时取每个角色参考回复的 token 数分布 (角色注册表按 tokenizer 哈希缓存在磁盘上，只在第一次启动时统计)：
+# - 软预算 = GENERATION_SOFT_QUANTILE 分位数：生成超过软预算后，遇到句末标点就结束 (ClauseStoppingCriteria)
+# - 硬预算 = 软预算 x GENERATION_HARD_RATIO (不超过 MAX_NEW_TOKENS)：一直没有句末标点时在这里截断
+# 硬预算同时作为截断历史时给回复预留的 token 数，历史可以多保留几轮
+
+# 软预算的下限，避免样本太少的角色预算过小
+MIN_SOFT_BUDGET = 16
+
+
+def _quantile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+class GenerationProfile:
+    def __init__(self, role_name, lengths, soft_quantile=GENERATION_SOFT_QUANTILE, hard_ratio=GENERATION_HARD_RATIO,
+                 max_new_tokens=MAX_NEW_TOKENS):
+        lengths = sorted(lengths)
+        self.role_name = role_name
+        self.samples = len(lengths)
+        self.p50 = _quantile(lengths, 0.5)
+        self.p90 = _quantile(lengths, 0.9)
+        self.p99 = _quantile(lengths, 0.99)
+        self.soft_budget = min(max(MIN_SOFT_BUDGET, _quantile(lengths, soft_quantile)), max_new_tokens)
+        self.max_new_tokens = min(max_new_tokens, math.ceil(self.soft_budget * hard_ratio))
+
+    def to_dict(self):
+        return {
+            "samples": self.samples,
+            "reply_tokens": {"p50": self.p50, "p90": self.p90, "p99": self.p99},
+            "soft_budget": self.soft_budget,
+            "max_new_tokens": self.max_new_tokens,
+        }
+
+
+class GenerationProfiles:
+    def __init__(self, enabled=GENERATION_PROFILES):
+        self.enabled = enabled
+        self.profiles = {}
+        self.tokenizer = None
+        # 每个 token 是否以句末标点结尾，所有请求共用 (换 tokenizer 时重建)
+        self.memo = {}
+
+    def build(self, tokenizer, path, soft_quantile=GENERATION_SOFT_QUANTILE, hard_ratio=GENERATION_HARD_RATIO):
+        tokenized = tokenized_roles(tokenizer)
+        lengths_by_role = tokenized.reply_lengths(path)
+        tokenized.save()
+        self.tokenizer = tokenizer
+        self.memo = {}
+        self.profiles = {
+            role_name: GenerationProfile(role_name, lengths, soft_quantile, hard_ratio)
+            for role_name, lengths in lengths_by_role.items()
+        }
+        return self.profiles
+
+    def get(self, role_name):
+        return self.profiles.get(role_name) if self.enabled else None
+
+    def max_new_tokens(self, role_name):
+        """该角色一次最多生成的 token 数 (没有统计数据时为 MAX_NEW_TOKENS)"""
+        profile = self.get(role_name)
+        return profile.max_new_tokens if profile is not None else MAX_NEW_TOKENS
+
+    def stopping_criteria(self, role_name, prompt_length):
+        """超过软预算后在句末标点处停止；调用方显式指定了 max_tokens 的请求不要加"""
+        profile = self.get(role_name)
+        if profile is None:
+            return []
+        return [ClauseStoppingCriteria(self.tokenizer, prompt_length, profile.soft_budget, self.memo)]
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "profiles": {role_name: profile.to_dict() for role_name, profile in self.profiles.items()},
+        }
+
+
+# 全局单例
+generation_profiles = GenerationProfiles()
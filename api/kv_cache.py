@@ -0,0 +1,178 @@
+from collections import OrderedDict
+from threading import Lock
+
+import torch
+from transformers import DynamicCache
+
+from config import CONVERSATION_CACHE_MB
+
+
+# ================= KV Cache 工具函数 =================
+# 统一把 transformers 的 Cache 对象和 [(key, value), ...] 张量列表互相转换，
+# 屏蔽不同 transformers 版本的内部结构差异 (key_cache/value_cache vs layers)。
+# 每层张量形状均为 [batch, num_kv_heads, seq_len, head_dim]
+
+
+def cache_to_tensors(cache):
+    """把 Cache 对象转换成 [(key, value), ...] 列表"""
+    if cache is None:
+        return None
+    if isinstance(cache, (tuple, list)):
+        return [(k, v) for k, v in cache]
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def tensors_to_cache(kv):
+    """把 [(key, value), ...] 列表重新包装成 DynamicCache，供 model.forward 使用"""
+    cache = DynamicCache()
+    for layer_idx, (k, v) in enumerate(kv):
+        cache.update(k, v, layer_idx)
+    return cache
+
+
+def kv_seq_len(kv):
+    return kv[0][0].shape[-2] if kv else 0
+
+
+def pad_left(kv, target_len):
+    """在序列维度左侧补零，使缓存长度达到 target_len (配合 attention_mask 的 0 使用)"""
+    cur_len = kv_seq_len(kv)
+    if cur_len >= target_len:
+        return kv
+    padded = []
+    for k, v in kv:
+        pad_shape = list(k.shape)
+        pad_shape[-2] = target_len - cur_len
+        k_pad = torch.zeros(pad_shape, dtype=k.dtype, device=k.device)
+        v_pad = torch.zeros(pad_shape, dtype=v.dtype, device=v.device)
+        padded.append((torch.cat([k_pad, k], dim=-2), torch.cat([v_pad, v], dim=-2)))
+    return padded
+
+
+def concat_batch(kv_a, kv_b):
+    """沿 batch 维拼接两份缓存 (调用前需保证序列长度一致)"""
+    return [
+        (torch.cat([ka, kb], dim=0), torch.cat([va, vb], dim=0))
+        for (ka, va), (kb, vb) in zip(kv_a, kv_b)
+    ]
+
+
+def select_batch(kv, indices):
+    """按 batch 下标挑选若干行"""
+    index = torch.as_tensor(indices, device=kv[0][0].device, dtype=torch.long)
+    return [(k.index_select(0, index), v.index_select(0, index)) for k, v in kv]
+
+
+def crop(kv, num_tokens):
+    """只保留序列维度前 num_tokens 个位置 (返回视图，不拷贝)"""
+    return [(k[:, :, :num_tokens], v[:, :, :num_tokens]) for k, v in kv]
+
+
+def kv_nbytes(kv):
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv)
+
+
+def trim_left(kv, num_tokens):
+    """裁掉序列维度最左侧 num_tokens 列 (所有行都是 padding 时使用)"""
+    if num_tokens <= 0:
+        return kv
+    return [(k[:, :, num_tokens:], v[:, :, num_tokens:]) for k, v in kv]
+
+
+# ================= 预计算前缀 =================
+class CachedPrefix:
+    """
+    一段预先 prefill 好的 token 前缀 (例如某个角色的 system prompt) 及其 KV Cache。
+    生成时以它为起点，只需要 prefill 剩余部分。
+    DynamicCache 追加新 token 时走 torch.cat 生成新张量，不会原地修改这里保存的张量，
+    因此多个请求可以安全地共享同一份前缀。
+    adapter 标记这份 KV 是用哪个适配器 (及版本) 算出来的，换了适配器就不能复用。
+    """
+
+    def __init__(self, token_ids, kv, adapter=None):
+        self.token_ids = list(token_ids)
+        self.kv = kv
+        self.adapter = adapter
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def matches(self, input_ids):
+        # 至少要留一个 token 给 prefill，才能拿到下一个 token 的 logits
+        n = len(self.token_ids)
+        return len(input_ids) > n and list(input_ids[:n]) == self.token_ids
+
+    def common_prefix_len(self, input_ids):
+        """与 input_ids 的最长公共前缀长度 (同样至少给 prefill 留一个 token)"""
+        limit = min(len(self.token_ids), len(input_ids) - 1)
+        n = 0
+        while n < limit and self.token_ids[n] == input_ids[n]:
+            n += 1
+        return n
+
+    def truncated(self, num_tokens):
+        if num_tokens >= len(self.token_ids):
+            return self
+        return CachedPrefix(self.token_ids[:num_tokens], crop(self.kv, num_tokens), adapter=self.adapter)
+
+
+# ================= 多轮对话 KV Cache =================
+class ConversationCache:
+    """
+    按 conversation_id 缓存上一轮对话结束时的 KV Cache (prompt + 已生成的回复)。
+    下一轮请求的完整历史只要以缓存的 token 序列开头，就可以从这里继续，只 prefill 新增的用户消息。
+    - 总显存/内存占用受 budget_bytes 限制，超出时按 LRU 淘汰最久未使用的对话
+    - 调度线程写入、接口线程读取，所有操作加锁
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()  # conversation_id -> (CachedPrefix, nbytes)
+        self.total_bytes = 0
+        self.lock = Lock()
+
+    def put(self, conversation_id, token_ids, kv, adapter=None):
+        nbytes = kv_nbytes(kv)
+        with self.lock:
+            self._remove(conversation_id)
+            if nbytes > self.budget_bytes:
+                return
+            self.entries[conversation_id] = (CachedPrefix(token_ids, kv, adapter=adapter), nbytes)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.budget_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+
+    def lookup(self, conversation_id, input_ids, adapter=None):
+        """
+        校验新请求的 token 序列是否延续了缓存的对话：
+        返回可复用的最长前缀 (CachedPrefix)，完全对不上或适配器已经变化时返回 None
+        """
+        with self.lock:
+            entry = self.entries.get(conversation_id)
+            if entry is None:
+                return None
+            self.entries.move_to_end(conversation_id)
+            prefix = entry[0]
+
+        if prefix.adapter != adapter:
+            return None
+        reuse_len = prefix.common_prefix_len(input_ids)
+        if reuse_len == 0:
+            return None
+        return prefix.truncated(reuse_len)
+
+    def _remove(self, conversation_id):
+        entry = self.entries.pop(conversation_id, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def stats(self):
+        with self.lock:
+            return {"conversations": len(self.entries), "bytes": self.total_bytes, "budget_bytes": self.budget_bytes}
+
+
+# 全局单例
+conversation_cache = ConversationCache(CONVERSATION_CACHE_MB * 1024 * 1024)
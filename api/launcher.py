@@ -0,0 +1,127 @@
+"""
+多副本启动器 (在 api 目录下运行)：启动 N 个 worker 进程 + 一个路由器
+
+    python launcher.py --workers 4 --port 8000
+
+- 先在子进程里准备好合并权重缓存 (MERGED_CACHE_DIR)，之后每个 worker 都以 mmap 方式映射同一个 safetensors 文件，
+  权重在物理内存中只有一份 (需要 MERGE_WEIGHTS=1、CPU 推理、CPU_QUANTIZE=none)
+- 每个 worker 是一个独立的 uvicorn 进程 (端口 worker-port, worker-port+1, ...)，推理线程数默认按 CPU 核数平分
+- 路由器监听 --port，按在途 token 数均衡、会话粘性转发 (见 router.py)
+"""
+import argparse
+import ctypes
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import httpx
+
+API_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def prepare_shared_weights():
+    """在子进程里生成合并权重缓存后退出，避免 N 个 worker 同时合并、同时写缓存"""
+    from model_loader import load_merged_model, BASE_MODEL_PATH, ADAPTER_PATH
+    load_merged_model(BASE_MODEL_PATH, ADAPTER_PATH)
+
+
+def worker_env(num_workers):
+    env = dict(os.environ)
+    env["MMAP_WEIGHTS"] = "1"
+    if not env.get("CPU_THREADS") or env["CPU_THREADS"] == "0":
+        # 多个进程各自用满所有核只会互相抢占，按 worker 数平分
+        env["CPU_THREADS"] = str(max(1, (os.cpu_count() or 1) // num_workers))
+    return env
+
+
+def wait_ready(url, process, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"worker 启动失败: {url} (退出码 {process.returncode})")
+        try:
+            response = httpx.get(url + "/readyz", timeout=2)
+            if response.status_code == 200:
+                return
+            if response.json().get("status") == "failed":
+                raise RuntimeError(f"worker 启动失败: {url} ({response.json().get('error')})")
+        except (httpx.HTTPError, ValueError):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"worker 启动超时: {url}")
+
+
+def _die_with_parent():
+    # Linux：launcher 被强制结束 (kill -9) 时 worker 也随之退出，不会留下占着端口的孤儿进程
+    try:
+        ctypes.CDLL("libc.so.6").prctl(1, signal.SIGTERM)  # PR_SET_PDEATHSIG
+    except (OSError, AttributeError):
+        pass
+
+
+def start_workers(num_workers, host, worker_port, timeout):
+    env = worker_env(num_workers)
+    workers = []
+    for i in range(num_workers):
+        port = worker_port + i
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", host, "--port", str(port), "--log-level", "warning"],
+            cwd=API_DIR,
+            env=env,
+            preexec_fn=_die_with_parent if sys.platform.startswith("linux") else None,
+        )
+        workers.append((f"http://{host}:{port}", process))
+    for url, process in workers:
+        wait_ready(url, process, timeout)
+        print(f"✅ worker 已就绪: {url} (pid={process.pid})")
+    return workers
+
+
+def stop_workers(workers):
+    for _, process in workers:
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+    for _, process in workers:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多副本启动器：N 个 worker + 路由器")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--host", default="127.0.0.1", help="worker 监听地址 (只供路由器访问)")
+    parser.add_argument("--worker-port", type=int, default=8100)
+    parser.add_argument("--router-host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000, help="路由器端口")
+    parser.add_argument("--timeout", type=float, default=600, help="等待每个 worker 加载模型的最长时间 (秒)")
+    args = parser.parse_args()
+
+    if os.environ.get("MERGE_WEIGHTS", "1") == "1":
+        print("🚀 正在准备共享的合并权重...")
+        preparer = multiprocessing.get_context("spawn").Process(target=prepare_shared_weights)
+        preparer.start()
+        preparer.join()
+        if preparer.exitcode != 0:
+            raise SystemExit("合并权重准备失败")
+
+    # uvicorn 退出时会把收到的 SIGTERM 重新抛给进程本身，这里改成正常退出，保证 finally 能结束 worker
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    workers = start_workers(args.workers, args.host, args.worker_port, args.timeout)
+    try:
+        # 路由器在 import 时读取 worker 列表
+        os.environ["ROUTER_WORKERS"] = ",".join(url for url, _ in workers)
+        import uvicorn
+        from router import app
+
+        uvicorn.run(app, host=args.router_host, port=args.port)
+    finally:
+        stop_workers(workers)
+
+
+if __name__ == "__main__":
+    main()
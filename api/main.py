@@ -1,15 +1,33 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Dict
-import torch
-from threading import Thread
-from transformers import TextIteratorStreamer
+from typing import List, Dict, Optional
 from model_loader import model_service, DEVICE
-from fastapi.responses import StreamingResponse
-import json
+from scheduler import generation_scheduler, GenerationRequest, QueueFullError, AdapterInUseError
+from config import MAX_BATCH_SIZE, MAX_NEW_TOKENS, MAX_QUEUE_DEPTH, RETRY_AFTER_SECONDS, ADMIN_TOKEN
+from config import SEMANTIC_CACHE_SEED, SPECULATIVE_TOKENS, BATCH_MAX_ITEMS, GENERATION_PROFILE_DATA
+from config import PREEMPT_BULK, BULK_MAX_ACTIVE, KV_MEMORY_BUDGET_MB, WARMUP_TOKENS, WARMUP_PROMPT
+from batch_jobs import batch_jobs, BatchJob, run_bucketed, result_line
+from roles import ROLE_MAP, ROLE_PROMPTS
+from kv_cache import conversation_cache
+from context import token_counter, truncate_history, ContextTooLongError
+from stopping import DisconnectStoppingCriteria
+from streaming import resolve_pacing, paced_chunks, sse_frame, SSE_DONE, ClosingStreamingResponse
+from response_cache import response_cache, is_deterministic, make_key
+from semantic_cache import semantic_cache
+from metrics import serving_metrics
+from tracing import start_trace, request_profiler, NULL_TRACE
+from openai_compat import OpenAIChatRequest, resolve_role, model_names, completion_id
+from openai_compat import completion_response, completion_chunks, finish_reason
+from sessions import session_store
+from generation_profiles import generation_profiles
+from fair_queue import BULK, PRIORITIES
+from conversation_store import conversation_store
+from startup import startup_progress
+from fastapi.responses import StreamingResponse, Response, JSONResponse
 import asyncio
-import random  # 引入随机库，让延迟更自然
+import json
+import time
 app = FastAPI(title="Qwen Social Chat API")
 
 # 1. 配置 CORS
@@ -21,41 +39,125 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 2. 角色映射表
-ROLE_MAP = {
-    1: "长辈",
-    2: "女友",
-    3: "导师",
-    4: "陌生人",
-    5: "夫妻"
-}
-
-# 3. 角色 Prompt 定义
-ROLE_PROMPTS = {
-    "长辈": "你是一个情商极高的工科学生。你现在的对话对象是你的【长辈】。请保持尊敬、亲切的态度，并使用幽默、搞笑感来活跃气氛。回复要自然，不要太长。",
-    "女友": "你是一个风趣幽默的工科学生。你现在的对话对象是你的【女友】。对话充满中国式幽默却又不失暧昧，适当反转。其他时候要有甜美的感觉。多用口语，少说教。",
-    "导师": "你是一个理工科研究生，情商很高，说话有分寸。你现在的对话对象是你的【导师】。整体风格要：尊敬、专业、礼貌为主，同时可以适度幽默、机智。回复要精炼。",
-    "陌生人": "你是一个机智、得体、有分寸感的工科学生。你现在的对话对象是你的【陌生人】。保持轻松、礼貌的态度，并使用高情商幽默来化解尴尬或拉近距离。",
-    "夫妻": "你是一个情商在线、风趣暖心的伴侣。你现在的对话对象是你的【配偶】。对话充满生活烟火气，兼具幽默调侃与温柔包容。多些关心，少些大道理。"
-}
-
-
-# 4. 请求体数据结构
+# 模型加载期间只开放探针和监控接口，其余请求返回 503 + Retry-After (WebSocket 见 chat_socket)
+STARTUP_OPEN_PATHS = {"/healthz", "/readyz", "/metrics", "/docs", "/openapi.json"}
+
+
+@app.middleware("http")
+async def require_ready(request: Request, call_next):
+    if not startup_progress.ready and request.url.path not in STARTUP_OPEN_PATHS:
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "模型加载中，请稍后重试", "startup": startup_progress.status()},
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
+    return await call_next(request)
+
+
+# 2. 角色映射表与 Prompt 定义见 roles.py (ROLE_MAP / ROLE_PROMPTS)
+
+
+# 3. 请求体数据结构
 class ChatRequest(BaseModel):
     role: int
     messages: List[Dict[str, str]]
     # 新增参数，允许前端微调，没有则使用默认值
     temperature: float = 0.85
     top_p: float = 0.95
+    # 可选的会话 ID：携带时服务端会缓存本轮的 KV Cache，下一轮只需 prefill 新消息
+    conversation_id: Optional[str] = None
+    # SSE 推送节奏：none / human / coalesce，不传则使用服务端配置 SSE_PACING
+    pacing: Optional[str] = None
+    # 采样随机种子：传入后回复可复现，相同请求可以直接命中回复缓存
+    seed: Optional[int] = None
+    # 是否允许投机解码 (服务端加载了草稿模型时生效，不改变生成结果的分布，只降低每个 token 的延迟)
+    speculative: bool = True
+    # 可选的服务端会话 ID：携带时历史从会话存储 (SQLite) 加载，messages 只需包含本轮新增的消息；
+    # 本轮问答在回复结束后写回会话，未传 conversation_id 时同时作为多轮 KV Cache 的 key
+    session_id: Optional[str] = None
 
 
-# 5. 启动加载
-@app.on_event("startup")
-async def startup_event():
-    model_service.load_model()
+# 4. 启动加载：在后台线程进行，服务先开始监听 (/healthz 立即可用，/readyz 在加载和预热完成后返回 200)
+startup_future = None
 
 
-# 6. 核心聊天接口
+@app.on_event("startup")
+async def startup_event():
+    global startup_future
+    # 进程创建到这里主要是 import torch / transformers 的时间
+    startup_progress.record("imports", time.time() - startup_progress.started_at)
+    startup_future = asyncio.get_running_loop().run_in_executor(None, load_and_warmup)
+
+
+def load_and_warmup():
+    try:
+        model_service.load_model()
+        tokenizer, model = model_service.get_model()
+        token_counter.setup(tokenizer)
+        # 调度器线程独占模型，所有请求都通过它进入同一个连续批次
+        generation_scheduler.start(tokenizer, model, DEVICE, max_batch_size=MAX_BATCH_SIZE,
+                                   max_queue_depth=MAX_QUEUE_DEPTH, draft_model=model_service.get_draft_model(),
+                                   speculative_tokens=SPECULATIVE_TOKENS, preempt_bulk=PREEMPT_BULK,
+                                   bulk_max_active=BULK_MAX_ACTIVE, kv_budget_mb=KV_MEMORY_BUDGET_MB,
+                                   adapter_tag=model_service.adapter_tag)
+        if semantic_cache.enabled:
+            with startup_progress.phase("semantic_cache"):
+                count = semantic_cache.load_dataset(SEMANTIC_CACHE_SEED)
+            print(f"✅ 语义回复缓存已收录 {count} 条开场问答")
+        if generation_profiles.enabled:
+            try:
+                with startup_progress.phase("generation_profiles"):
+                    profiles = generation_profiles.build(tokenizer, GENERATION_PROFILE_DATA)
+                print("✅ 角色生成长度: " + ", ".join(
+                    f"{role_name} {profile.soft_budget}/{profile.max_new_tokens}"
+                    for role_name, profile in profiles.items()))
+            except OSError as e:
+                print(f"⚠️ 没有找到训练集，生成长度统一使用 MAX_NEW_TOKENS: {e}")
+        if WARMUP_TOKENS > 0:
+            with startup_progress.phase("warmup"):
+                warmup_roles(tokenizer)
+        startup_progress.mark_ready()
+    except Exception as e:
+        startup_progress.fail(e)
+
+
+def warmup_roles(tokenizer):
+    """
+    每个角色用一句合成的开场白走一遍完整的生成流程：chat template 编译、角色前缀 + prefill、
+    各角色一起 decode (多适配器混合批次)。role 标签记为 warmup，不混进真实请求的监控指标
+    """
+    requests = []
+    for role_name in ROLE_PROMPTS:
+        full_messages = [{"role": "system", "content": ROLE_PROMPTS[role_name]},
+                         {"role": "user", "content": WARMUP_PROMPT}]
+        adapter = model_service.adapter_for_role(role_name)
+        request = GenerationRequest(
+            encode_chat(tokenizer, full_messages),
+            max_new_tokens=WARMUP_TOKENS,
+            prefix=model_service.get_role_prefix(role_name),
+            adapter=adapter,
+            role="warmup",
+            seed=0,
+        )
+        requests.append(generation_scheduler.submit(request))
+    for stream in requests:
+        for _ in stream:
+            pass
+    print(f"✅ 已预热 {len(requests)} 个角色")
+
+
+def encode_chat(tokenizer, full_messages, trace=NULL_TRACE):
+    with trace.span("chat_template"):
+        prompt_text = tokenizer.apply_chat_template(
+            full_messages,
+            tokenize=False,
+            add_generation_prompt=True
+        )
+    with trace.span("tokenize"):
+        return tokenizer(prompt_text, add_special_tokens=False).input_ids
+
+
+# 5. 核心聊天接口
 @app.post("/chat/completions")
 async def chat_completions(request: ChatRequest):
     tokenizer, model = model_service.get_model()
@@ -66,41 +168,96 @@ async def chat_completions(request: ChatRequest):
         raise HTTPException(status_code=400, detail="无效的角色 ID")
 
     system_prompt = ROLE_PROMPTS[role_name]
+    conversation_id = request.conversation_id or request.session_id
+    # 分阶段追踪：请求结束时输出一条带 request_id 的 JSON 日志
+    trace = start_trace("/chat/completions", role=role_name, conversation_id=conversation_id)
+
+    try:
+        pacing = resolve_pacing(request.pacing)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # --- B. 过滤消息 ---
+    # 严格过滤，防止前端传入错误的 system 导致 prompt 污染
+    history = [msg for msg in request.messages if msg['role'] in ['user', 'assistant']]
+
+    # 服务端会话：本轮新增的消息接在存储的历史后面 (会话不存在或换了角色时新建)
+    session = None
+    new_messages = history
+    if request.session_id:
+        with trace.span("session_load"):
+            session = await run_blocking(load_session, request.session_id, role_name)
+        if session.busy:
+            raise HTTPException(status_code=409, detail="该会话正在生成回复")
+        history = session.history() + new_messages
 
     # --- [优化点 1]：上下文截断 (Context Truncation) ---
-    # 如果历史记录太长，模型会“迷失”或显存溢出。保留最近的 N 轮对话效果最好。
-    # 假设保留最近 10 轮 (20条消息)
-    MAX_HISTORY_TURNS = 20
-    recent_messages = request.messages[-MAX_HISTORY_TURNS:] if request.messages else []
-
-    # --- B. 构建完整的对话历史 ---
-    full_messages = [{"role": "system", "content": system_prompt}]
-
-    for msg in recent_messages:
-        # 严格过滤，防止前端传入错误的 system 导致 prompt 污染
-        if msg['role'] in ['user', 'assistant']:
-            full_messages.append(msg)
-
-    print(f"当前角色: {role_name}")
+    # 如果历史记录太长，模型会“迷失”或显存溢出。
+    # 按 token 预算截断 (prompt + max_new_tokens <= CONTEXT_WINDOW)，从最早的一轮开始成对丢弃；
+    # 每条消息的 token 数按内容哈希缓存，不用每轮重新 tokenize 全部历史
+    # 回复长度按角色的参考回复分布设定，截断历史时只需为它预留这么多 token
+    max_new_tokens = generation_profiles.max_new_tokens(role_name)
+    try:
+        with trace.span("truncate"):
+            recent_messages = truncate_history(system_prompt, history, max_new_tokens)
+    except ContextTooLongError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # --- 构建完整的对话历史 ---
+    full_messages = [{"role": "system", "content": system_prompt}] + recent_messages
     #print(full_messages) # 调试时打开
 
+    # 每个角色可以有自己的 LoRA 适配器 (回复缓存、KV 缓存都按适配器版本区分)
+    adapter = model_service.adapter_for_role(role_name)
+    cache_tag = model_service.adapter_tag(adapter)
+
+    # 结果可复现 (带 seed 或贪心解码) 的请求先查回复缓存，命中则不经过模型直接回放
+    cache_key = None
+    if response_cache.enabled:
+        if is_deterministic(request.temperature, request.seed):
+            with trace.span("response_cache"):
+                cache_key = make_key(request.role, recent_messages, request.temperature, request.top_p,
+                                     request.seed, cache_tag)
+                cached_chunks = response_cache.get(cache_key)
+            if cached_chunks is not None:
+                await run_blocking(remember_turn, session, new_messages, "".join(cached_chunks))
+                trace.set(status="response_cache")
+                trace.emit()
+                return StreamingResponse(replay_cached(cached_chunks), media_type="text/event-stream")
+        else:
+            response_cache.record_bypass()
+
+    # 新对话的第一句与收录的开场白足够相似时，直接返回收录的高质量回复
+    # (要求可复现的请求仍然交给模型，保证同一个 seed 每次结果一致)
+    if semantic_cache.enabled and len(recent_messages) == 1 and cache_key is None:
+        with trace.span("semantic_cache"):
+            matched = semantic_cache.lookup(role_name, recent_messages[0]["content"])
+        if matched is not None:
+            await run_blocking(remember_turn, session, new_messages, matched["reply"])
+            trace.set(status="semantic_cache")
+            trace.emit()
+            return StreamingResponse(replay_cached([matched["reply"]]), media_type="text/event-stream")
+
     # --- C. 预处理输入 ---
-    input_ids = tokenizer.apply_chat_template(
-        full_messages,
-        tokenize=True,
-        add_generation_prompt=True,
-        return_tensors="pt"
-    ).to(DEVICE)
+    input_ids = encode_chat(tokenizer, full_messages, trace)
+
+    # 角色 System Prompt 的 KV Cache 在启动时已预计算；
+    # 多轮对话优先复用上一轮结束时的缓存 (需校验本轮历史确实是在上一轮基础上追加的，且适配器版本没变)
+    prefix = model_service.get_role_prefix(role_name)
+    if conversation_id:
+        with trace.span("conversation_cache"):
+            cached = conversation_cache.lookup(conversation_id, input_ids, adapter=cache_tag)
+        if cached is not None and (prefix is None or len(cached) > len(prefix)):
+            prefix = cached
 
-    # --- D. 定义流式生成器 ---
-    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    # 客户端断开 (关闭标签页) 后停止解码，不再为没人接收的请求占用算力
+    disconnect_criteria = DisconnectStoppingCriteria()
 
     # --- [优化点 2]：调整生成参数 (Generation Config) ---
     # 这里的参数直接决定模型是“死板”还是“活泼”
-    generation_kwargs = dict(
+    generation_request = GenerationRequest(
         input_ids=input_ids,
-        streamer=streamer,
-        max_new_tokens=512,
+        max_new_tokens=max_new_tokens,
 
         # 1. Temperature (温度): 调高到 0.8-0.9 会更活泼、更有创造力；调低到 0.5 会更死板准确。
         # 社交闲聊建议 0.85
@@ -112,46 +269,661 @@ async def chat_completions(request: ChatRequest):
         # 3. Top-K (新增): 限制只从概率最高的 K 个词里选，防止生成离谱的词。建议 50。
         top_k=50,
 
-        # 4. Do Sample: 必须为 True 才能让上面的参数生效
-        do_sample=True,
-
-        # 5. Repetition Penalty: 重复惩罚。
+        # 4. Repetition Penalty: 重复惩罚。
         # 如果模型喜欢复读，设为 1.1 或 1.2。如果模型说话不通顺，设回 1.05 或 1.0。
         repetition_penalty=1.1,
 
-        # 6. EOS Token: 确保模型知道什么时候该停嘴 (Qwen 的结束符 ID 通常可以在 tokenizer 中找到)
-        pad_token_id=tokenizer.pad_token_id,
-        eos_token_id=tokenizer.eos_token_id
-    )
+        # 5. EOS Token: 不传则由调度器使用 tokenizer / generation_config 中的结束符
+
+        # 6. 复用已缓存的前缀 KV，只 prefill 剩余部分
+        prefix=prefix,
+        conversation_id=conversation_id,
+        # 超过角色的软预算后，在下一个句末标点处结束，而不是一直说到 max_new_tokens 被硬截断
+        stopping_criteria=[disconnect_criteria] + generation_profiles.stopping_criteria(role_name, len(input_ids)),
+
+        # 7. 角色对应的适配器：不同角色的请求共享基座权重，在同一批次里一起解码
+        adapter=adapter,
+        cache_tag=cache_tag,
+
+        # 8. 随机种子：固定后同样的输入得到同样的回复
+        seed=request.seed,
+
+        # 9. 投机解码：草稿模型先猜几个 token，大模型一次验证
+        speculative=request.speculative,
+
+        # 10. 角色名：监控指标 (/metrics) 按角色和适配器分别统计
+        role=role_name,
 
-    thread = Thread(target=model.generate, kwargs=generation_kwargs)
-    thread.start()
+        # 11. 分阶段追踪：调度器补上排队 / prefill / decode 的耗时
+        trace=trace,
+    )
+    # 管理接口开启了按需剖析时，占用一个剖析名额
+    request_profiler.claim(generation_request)
+
+    # --- D. 提交给连续批处理调度器，拿到该请求专属的输出流 ---
+    # 输出流绑定到当前事件循环，等待 token 时不会阻塞其他连接
+    try:
+        streamer = generation_scheduler.submit(generation_request, loop=asyncio.get_running_loop())
+    except QueueFullError as e:
+        # 队列已满：快速失败，让客户端稍后重试，而不是把请求无限堆积到 OOM
+        trace.set(status="queue_full")
+        trace.emit()
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+    if session is not None:
+        session.busy = True
 
     # --- E. 返回 SSE 流 ---
+    generated_text = ""
+    chunks = []
+    status = "cancelled"
+    stream_start = time.perf_counter()
+
     async def response_generator():
-        generated_text = ""
-        for new_text in streamer:
-            # 清理特殊符号
-            clean_text = new_text.replace("<|im_end|>", "").replace("<|im_start|>", "")
-
-            if clean_text:
-                generated_text += clean_text
-                response_json = {
-                    "role": "assistant",
-                    "content": clean_text
-                }
-                yield f"data: {json.dumps(response_json, ensure_ascii=False)}\n\n"
-                await asyncio.sleep(random.uniform(0.02, 0.05))
-
-                # 2. (可选) 标点符号额外停顿：模拟人类思考/换气
-                if clean_text in [",", "，", ".", "。", "!", "！", "?", "？", "\n"]:
-                    await asyncio.sleep(0.1)
-
-        # 打印完整的生成结果用于后台调试
-        # print(f"AI回复: {generated_text}")
-        yield "data: [DONE]\n\n"
-
-    return StreamingResponse(response_generator(), media_type="text/event-stream")
+        nonlocal generated_text, status, stream_start
+        stream_start = time.perf_counter()
+        try:
+            async for chunk in paced_chunks(streamer, pacing):
+                generated_text += chunk
+                chunks.append(chunk)
+                write_start = time.perf_counter()
+                yield sse_frame(chunk)
+                # yield 之后恢复执行的时间 ≈ 把这一帧交给连接 (SSE flush) 的耗时
+                trace.add_time("sse_write", time.perf_counter() - write_start)
+
+            # 只缓存完整生成的回复 (中途断开时不会走到这里)
+            if cache_key is not None:
+                response_cache.put(cache_key, chunks)
+
+            # 打印完整的生成结果用于后台调试
+            # print(f"AI回复: {generated_text}")
+            yield SSE_DONE
+            status = "ok"
+        except Exception as e:
+            status = f"error: {e}"
+            raise
+
+    async def finish_stream():
+        # 响应结束时调用一次，包括客户端在开始读取响应体之前就断开 (此时生成器从未启动)：
+        # 通知调度器停止解码，否则会一直为没人接收的请求解码
+        disconnect_criteria.cancel()
+        if session is not None:
+            try:
+                # 中途断开时已生成的部分也写回会话，与 WebSocket 通道的取消行为一致
+                await run_blocking(remember_turn, session, new_messages, generated_text)
+            finally:
+                session.busy = False
+        trace.add_span("stream", stream_start, time.perf_counter())
+        trace.set(status=status, frames=len(chunks), pacing=pacing)
+        trace.emit()
+
+    return ClosingStreamingResponse(response_generator(), finish_stream, media_type="text/event-stream")
+
+
+def load_session(session_id, role_name):
+    """按 session_id 取服务端会话，不存在或换了角色时新建 (读写 SQLite，需在线程池中调用)"""
+    session = session_store.get(session_id)
+    if session is None or session.role_name != role_name:
+        session = session_store.create(role_name, session_id=session_id)
+    return session
+
+
+async def run_blocking(fn, *args):
+    """
+    会话存储的读写是同步的 SQLite 操作 (写锁被占用时最多等 busy_timeout)，放到线程池执行，
+    不阻塞事件循环上其他请求的流式输出
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+def remember_turn(session, new_messages, reply):
+    """把本轮新增的消息和回复追加到服务端会话 (没有会话或没有生成内容时跳过)"""
+    if session is not None and reply:
+        session.append_messages(new_messages + [{"role": "assistant", "content": reply}])
+
+
+async def replay_cached(chunks):
+    for chunk in chunks:
+        yield sse_frame(chunk)
+    yield SSE_DONE
+
+
+# 存活探针：进程能响应就返回 200，附带启动进度
+@app.get("/healthz")
+async def healthz():
+    status = startup_progress.status()
+    return JSONResponse(status_code=500 if status["status"] == "failed" else 200, content=status)
+
+
+# 就绪探针：模型加载、预热完成后才返回 200，launcher / router 据此决定是否转发流量
+@app.get("/readyz")
+async def readyz():
+    status = startup_progress.status()
+    return JSONResponse(status_code=200 if startup_progress.ready else 503, content=status)
+
+
+# 6. 排队情况
+@app.get("/queue")
+async def queue_status():
+    return generation_scheduler.queue_status()
+
+
+# 监控指标 (Prometheus 文本格式)：首 token 延迟、token 间隔、总延迟、token 数、排队/在途请求数、冷启动耗时
+@app.get("/metrics")
+async def metrics():
+    return Response(content=serving_metrics.render() + startup_progress.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# 每个角色的生成长度 (参考回复的 token 数分布、软预算、硬预算)
+@app.get("/generation-profiles")
+async def generation_profile_status():
+    return generation_profiles.stats()
+
+
+# 缓存命中情况
+@app.get("/cache")
+async def cache_status():
+    return {
+        "response_cache": response_cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "conversation_cache": conversation_cache.stats(),
+    }
+
+
+# 批量生成：离线任务复用已加载的模型，按长度分桶交给连续批处理调度器
+class BatchItem(BaseModel):
+    # 调用方自己的编号，原样带回结果里
+    id: Optional[str] = None
+    role: int
+    messages: List[Dict[str, str]]
+    temperature: float = 0.85
+    top_p: float = 0.95
+    seed: Optional[int] = None
+    max_new_tokens: Optional[int] = None
+
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem]
+    # true: 以 JSONL 流式返回，谁先完成谁先返回；false: 立即返回任务句柄，之后分次查询结果
+    stream: bool = True
+    # 租户：批量条目都以 bulk 优先级调度，同时运行多个批量任务时按租户轮流准入 (不传则按角色轮流)
+    tenant: Optional[str] = None
+
+
+def prepare_batch_item(tokenizer, item, tenant=None):
+    role_name = ROLE_MAP.get(item.role)
+    if not role_name:
+        raise ValueError("无效的角色 ID")
+    # 没有指定 max_new_tokens 时按角色的生成长度，超过软预算后在句末停止
+    max_new_tokens = min(item.max_new_tokens or generation_profiles.max_new_tokens(role_name), MAX_NEW_TOKENS)
+    system_prompt = ROLE_PROMPTS[role_name]
+    history = [msg for msg in item.messages if msg['role'] in ['user', 'assistant']]
+    recent_messages = truncate_history(system_prompt, history, max_new_tokens)
+    input_ids = encode_chat(tokenizer, [{"role": "system", "content": system_prompt}] + recent_messages)
+    adapter = model_service.adapter_for_role(role_name)
+    disconnect_criteria = DisconnectStoppingCriteria()
+    request = GenerationRequest(
+        input_ids=input_ids,
+        max_new_tokens=max_new_tokens,
+        temperature=item.temperature,
+        top_p=item.top_p,
+        top_k=50,
+        repetition_penalty=1.1,
+        prefix=model_service.get_role_prefix(role_name),
+        stopping_criteria=[disconnect_criteria] + (
+            [] if item.max_new_tokens else generation_profiles.stopping_criteria(role_name, len(input_ids))),
+        adapter=adapter,
+        cache_tag=model_service.adapter_tag(adapter),
+        seed=item.seed,
+        role=role_name,
+        # 批量任务只使用在线聊天剩下的名额，批次满时会被交互请求暂停
+        priority=BULK,
+        tenant=tenant,
+    )
+    return request, disconnect_criteria
+
+
+async def batch_results(items, entries, errors):
+    """先返回校验失败的条目，再按完成顺序返回生成结果，每条都带上调用方的 id 和角色"""
+    for result in errors:
+        yield result
+    async for result in run_bucketed(entries):
+        item = items[result["index"]]
+        yield {"id": item.id, "role": item.role, **result}
+
+
+@app.post("/chat/batch")
+async def chat_batch(request: BatchRequest):
+    if len(request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"单次最多 {BATCH_MAX_ITEMS} 条")
+    tokenizer, model = model_service.get_model()
+
+    entries, errors = [], []
+    for index, item in enumerate(request.items):
+        try:
+            entries.append((index, *prepare_batch_item(tokenizer, item, request.tenant)))
+        except (ValueError, ContextTooLongError) as e:
+            errors.append({"id": item.id, "role": item.role, "index": index, "error": str(e)})
+    results = batch_results(request.items, entries, errors)
+
+    if not request.stream:
+        job = batch_jobs.start(BatchJob(len(request.items)), results)
+        return job.status_dict()
+
+    async def jsonl_generator():
+        async for result in results:
+            yield result_line(result)
+
+    return StreamingResponse(jsonl_generator(), media_type="application/x-ndjson")
+
+
+@app.get("/chat/batch/{job_id}")
+async def batch_status(job_id: str):
+    job = batch_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job.status_dict()
+
+
+@app.get("/chat/batch/{job_id}/results")
+async def batch_job_results(job_id: str, offset: int = 0):
+    """返回已完成的结果 (JSONL)，offset 用于增量拉取"""
+    job = batch_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    body = "".join(result_line(result) for result in job.results[offset:])
+    return Response(content=body, media_type="application/x-ndjson")
+
+
+@app.delete("/chat/batch/{job_id}")
+async def cancel_batch(job_id: str):
+    job = batch_jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job.status_dict()
+
+
+# OpenAI 兼容接口：OpenAI SDK 把 base_url 设为 http://<host>:8000/v1 即可调用
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": name, "object": "model", "owned_by": "local"} for name in model_names()]}
+
+
+@app.post("/v1/chat/completions")
+async def openai_chat_completions(request: OpenAIChatRequest):
+    tokenizer, model = model_service.get_model()
+    if not 1 <= request.n <= MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"n 必须在 1 到 {MAX_BATCH_SIZE} 之间")
+    if request.priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"priority 只能是 {PRIORITIES} 之一")
+    try:
+        role_name, system_prompt, history = resolve_role(request.model, request.messages)
+        # 没有指定 max_tokens 时按角色的生成长度，超过软预算后在句末停止
+        max_new_tokens = min(request.max_tokens or generation_profiles.max_new_tokens(role_name), MAX_NEW_TOKENS)
+        recent_messages = truncate_history(system_prompt or "", history, max_new_tokens)
+    except (ValueError, ContextTooLongError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    trace = start_trace("/v1/chat/completions", role=role_name, n=request.n)
+    full_messages = recent_messages
+    if system_prompt is not None:
+        full_messages = [{"role": "system", "content": system_prompt}] + recent_messages
+    input_ids = encode_chat(tokenizer, full_messages, trace)
+
+    adapter = model_service.adapter_for_role(role_name)
+    disconnect_criteria = DisconnectStoppingCriteria()
+    generation_request = GenerationRequest(
+        input_ids=input_ids,
+        max_new_tokens=max_new_tokens,
+        temperature=request.temperature,
+        top_p=request.top_p,
+        top_k=50,
+        repetition_penalty=1.1,
+        # 客户端自带的 system prompt 与角色默认 Prompt 不同时，调度器会发现前缀不匹配，改为完整 prefill
+        prefix=model_service.get_role_prefix(role_name),
+        stopping_criteria=[disconnect_criteria] + (
+            [] if request.max_tokens else generation_profiles.stopping_criteria(role_name, len(input_ids))),
+        adapter=adapter,
+        cache_tag=model_service.adapter_tag(adapter),
+        seed=request.seed,
+        role=role_name,
+        trace=trace,
+        # 离线评测 / 数据生成传 priority=bulk，按 user 字段在租户之间轮流准入
+        priority=request.priority,
+        tenant=request.user,
+    )
+    request_profiler.claim(generation_request)
+    # 其余 n-1 个候选共享这次 prefill；带 seed 时每个候选的种子依次加一，既可复现又互不相同
+    for index in range(1, request.n):
+        generation_request.fork(seed=None if request.seed is None else request.seed + index)
+    requests = [generation_request] + generation_request.forks
+
+    try:
+        generation_scheduler.submit(generation_request, loop=asyncio.get_running_loop())
+    except QueueFullError as e:
+        trace.set(status="queue_full")
+        trace.emit()
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+    streams = [member.stream for member in requests]
+    cid = completion_id()
+    trace.set(completion_id=cid)
+
+    if not request.stream:
+        try:
+            return await completion_response(cid, request.model, requests, streams)
+        finally:
+            disconnect_criteria.cancel()
+            trace.emit()
+
+    include_usage = bool(request.stream_options and request.stream_options.get("include_usage"))
+
+    async def response_generator():
+        async for frame in completion_chunks(cid, request.model, requests, streams, include_usage):
+            yield frame
+
+    def finish_stream():
+        disconnect_criteria.cancel()
+        trace.emit()
+
+    return ClosingStreamingResponse(response_generator(), finish_stream, media_type="text/event-stream")
+
+
+# WebSocket 聊天：会话历史保存在服务端，客户端每轮只发送新的一句话，回复通过同一个连接流式返回
+# 客户端 -> 服务端：
+#   {"type": "start", "role": 1, "session_id": 可选, "history": 可选, "temperature"/"top_p"/"seed"/"pacing": 可选}
+#   {"type": "message", "content": "..."}   {"type": "cancel"}   {"type": "reset"}
+# 服务端 -> 客户端：
+#   {"type": "session", ...}  {"type": "delta", "content": "..."}  {"type": "done", "finish_reason", "usage"}
+#   {"type": "error", "detail": "..."}
+SESSION_SETTINGS = ("temperature", "top_p", "seed", "pacing")
+
+
+def open_session(message):
+    """恢复已有会话 (角色一致时)，否则新建；新建时可以用客户端带来的历史初始化 (例如服务重启后)"""
+    role_name = ROLE_MAP.get(message.get("role"))
+    if not role_name:
+        raise ValueError("无效的角色 ID")
+    settings = {key: message[key] for key in SESSION_SETTINGS if message.get(key) is not None}
+    resolve_pacing(settings.get("pacing"))
+    session_id = message.get("session_id")
+    session = session_store.get(session_id) if session_id else None
+    if session is not None and session.role_name == role_name:
+        session.settings.update(settings)
+        return session
+    history = [
+        {"role": msg["role"], "content": str(msg.get("content", ""))}
+        for msg in message.get("history") or []
+        if isinstance(msg, dict) and msg.get("role") in ("user", "assistant")
+    ]
+    return session_store.create(role_name, session_id=session_id, messages=history, settings=settings)
+
+
+def prepare_session_turn(tokenizer, session, content, trace):
+    settings = session.settings
+    system_prompt = ROLE_PROMPTS[session.role_name]
+    history = session.history() + [{"role": "user", "content": content}]
+    with trace.span("truncate"):
+        recent_messages = truncate_history(system_prompt, history, generation_profiles.max_new_tokens(session.role_name))
+    input_ids = encode_chat(tokenizer, [{"role": "system", "content": system_prompt}] + recent_messages, trace)
+
+    # session_id 同时作为 conversation_id：上一轮结束时的 KV Cache 还在的话，只 prefill 新的这句话
+    adapter = model_service.adapter_for_role(session.role_name)
+    cache_tag = model_service.adapter_tag(adapter)
+    prefix = model_service.get_role_prefix(session.role_name)
+    cached = conversation_cache.lookup(session.session_id, input_ids, adapter=cache_tag)
+    if cached is not None and (prefix is None or len(cached) > len(prefix)):
+        prefix = cached
+
+    stop = DisconnectStoppingCriteria()
+    request = GenerationRequest(
+        input_ids=input_ids,
+        max_new_tokens=generation_profiles.max_new_tokens(session.role_name),
+        temperature=settings.get("temperature", 0.85),
+        top_p=settings.get("top_p", 0.95),
+        top_k=50,
+        repetition_penalty=1.1,
+        prefix=prefix,
+        conversation_id=session.session_id,
+        stopping_criteria=[stop] + generation_profiles.stopping_criteria(session.role_name, len(input_ids)),
+        adapter=adapter,
+        cache_tag=cache_tag,
+        seed=settings.get("seed"),
+        speculative=True,
+        role=session.role_name,
+        trace=trace,
+    )
+    request_profiler.claim(request)
+    return request, stop
+
+
+async def run_session_turn(websocket, session, content, request, stop, trace):
+    """生成一轮回复并逐段推送；被取消时保留已生成的部分，一轮结束后再把问答写入会话"""
+    status = "error"
+    try:
+        try:
+            stream = generation_scheduler.submit(request, loop=asyncio.get_running_loop())
+        except QueueFullError as e:
+            status = "queue_full"
+            await websocket.send_json({"type": "error", "detail": str(e), "retry_after": RETRY_AFTER_SECONDS})
+            return
+
+        reply = ""
+        async for chunk in paced_chunks(stream, resolve_pacing(session.settings.get("pacing"))):
+            reply += chunk
+            await websocket.send_json({"type": "delta", "content": chunk})
+
+        cancelled = stop.disconnected.is_set()
+        if reply:
+            await run_blocking(session.append_turn, content, reply)
+        status = "cancelled" if cancelled else "ok"
+        await websocket.send_json({
+            "type": "done",
+            "finish_reason": "cancelled" if cancelled else finish_reason(request),
+            "usage": {"prompt_tokens": len(request.input_ids), "completion_tokens": request.num_generated},
+        })
+    except Exception as e:
+        # 连接已断开 (发送失败) 或生成出错：停止解码
+        stop.cancel()
+        if not isinstance(e, (WebSocketDisconnect, RuntimeError)):
+            await websocket.send_json({"type": "error", "detail": str(e)})
+    finally:
+        session.busy = False
+        trace.set(status=status)
+        trace.emit()
+
+
+@app.websocket("/ws/chat")
+async def chat_socket(websocket: WebSocket):
+    await websocket.accept()
+    if not startup_progress.ready:
+        # 模型还在加载：1013 (Try Again Later) 告诉客户端稍后重连
+        await websocket.send_json({"type": "error", "detail": "模型加载中，请稍后重试"})
+        await websocket.close(code=1013)
+        return
+    tokenizer, model = model_service.get_model()
+    session = None
+    turn = None  # 正在进行的一轮生成 (asyncio.Task)
+    stop = None
+
+    async def send_error(detail):
+        await websocket.send_json({"type": "error", "detail": detail})
+
+    try:
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+            except ValueError:
+                await send_error("消息必须是 JSON")
+                continue
+            kind = message.get("type") if isinstance(message, dict) else None
+
+            if kind == "cancel":
+                # 生成中途取消：调度器在下一个 decode step 停止，已生成的部分照常返回
+                if stop is not None:
+                    stop.cancel()
+                continue
+            if turn is not None and not turn.done():
+                await send_error("上一轮回复还没有结束，可以先发送 cancel")
+                continue
+
+            if kind == "start":
+                try:
+                    session = await run_blocking(open_session, message)
+                except ValueError as e:
+                    await send_error(str(e))
+                    continue
+                await websocket.send_json({"type": "session", **session.summary()})
+            elif kind == "reset":
+                if session is None:
+                    await send_error("请先发送 start")
+                    continue
+                await run_blocking(session.clear)
+                await websocket.send_json({"type": "session", **session.summary()})
+            elif kind == "message":
+                content = str(message.get("content") or "").strip()
+                if session is None or not content:
+                    await send_error("请先发送 start" if session is None else "消息内容不能为空")
+                    continue
+                if session.busy:
+                    await send_error("该会话正在另一个连接中生成回复")
+                    continue
+                trace = start_trace("/ws/chat", role=session.role_name, session_id=session.session_id)
+                try:
+                    request, stop = prepare_session_turn(tokenizer, session, content, trace)
+                except ContextTooLongError as e:
+                    await send_error(str(e))
+                    continue
+                session.busy = True
+                turn = asyncio.create_task(run_session_turn(websocket, session, content, request, stop, trace))
+            else:
+                await send_error(f"未知的消息类型: {kind}")
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # 客户端断开：停止正在进行的生成
+        if stop is not None:
+            stop.cancel()
+        if turn is not None:
+            await asyncio.gather(turn, return_exceptions=True)
+
+
+# 会话存储：分页查看服务端保存的会话和消息 (换设备时前端可以据此恢复历史)。
+# 查询 SQLite 是同步操作，这几个接口定义为普通函数，由 FastAPI 放到线程池执行
+def _page_limit(limit, maximum):
+    if limit < 1 or limit > maximum:
+        raise HTTPException(status_code=400, detail=f"limit 取值范围为 1 ~ {maximum}")
+    return limit
+
+
+@app.get("/sessions")
+def list_sessions(before: Optional[float] = None, limit: int = 20):
+    """按最近活动时间从新到旧，下一页传 before=上一页的 next_before"""
+    return conversation_store.list_sessions(before, _page_limit(limit, 100))
+
+
+@app.get("/sessions/{session_id}")
+def get_session(session_id: str):
+    session = conversation_store.get_session(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="会话不存在")
+    return session
+
+
+@app.get("/sessions/{session_id}/messages")
+def session_messages(session_id: str, before: Optional[int] = None, limit: int = 50):
+    """从最新的消息往前翻页 (role 为 reset 的条目表示此处清空过历史)"""
+    if conversation_store.get_session(session_id) is None:
+        raise HTTPException(status_code=404, detail="会话不存在")
+    return conversation_store.messages(session_id, before, _page_limit(limit, 200))
+
+
+# 7. 适配器管理 (热加载 / 卸载)
+class AdapterRequest(BaseModel):
+    name: str
+    path: str
+    # 切换到该适配器的角色 ID，与 ChatRequest.role 一致
+    roles: List[int] = []
+
+
+def check_admin_token(x_admin_token: Optional[str] = Header(None)):
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="管理令牌错误")
+
+
+@app.get("/admin/adapters", dependencies=[Depends(check_admin_token)])
+async def list_adapters():
+    return model_service.adapter_status()
+
+
+@app.post("/admin/adapters", dependencies=[Depends(check_admin_token)])
+async def load_adapter(request: AdapterRequest):
+    role_names = [ROLE_MAP.get(role) for role in request.roles]
+    if None in role_names:
+        raise HTTPException(status_code=400, detail="无效的角色 ID")
+
+    def load():
+        # 替换同名适配器会改掉正在生成的序列所用的权重，有序列在用时拒绝
+        generation_scheduler.ensure_adapter_idle(request.name)
+        model_service.load_adapter(request.name, request.path, role_names)
+
+    # 加载会修改模型结构，交给调度线程在两个 decode step 之间执行，正在生成的请求不受影响
+    try:
+        await asyncio.wrap_future(generation_scheduler.run_exclusive(load))
+    except AdapterInUseError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return model_service.adapter_status()
+
+
+@app.delete("/admin/adapters/{name}", dependencies=[Depends(check_admin_token)])
+async def unload_adapter(name: str):
+    def unload():
+        generation_scheduler.ensure_adapter_idle(name)
+        model_service.unload_adapter(name)
+
+    try:
+        await asyncio.wrap_future(generation_scheduler.run_exclusive(unload))
+    except AdapterInUseError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return model_service.adapter_status()
+
+
+# 8. 语义回复缓存：人工收录高质量回复
+class SemanticEntry(BaseModel):
+    role: int
+    question: str
+    reply: str
+
+
+@app.post("/admin/semantic-cache", dependencies=[Depends(check_admin_token)])
+async def add_semantic_entry(entry: SemanticEntry):
+    role_name = ROLE_MAP.get(entry.role)
+    if not role_name:
+        raise HTTPException(status_code=400, detail="无效的角色 ID")
+    semantic_cache.insert(role_name, entry.question, entry.reply)
+    return semantic_cache.stats()
+
+
+# 9. 按需性能剖析：为接下来的 K 个请求挂上 torch.profiler，结束后把 Chrome trace 写入 PROFILE_DIR
+class ProfileRequest(BaseModel):
+    requests: int = 1
+
+
+@app.get("/admin/profile", dependencies=[Depends(check_admin_token)])
+async def profile_status():
+    return request_profiler.status()
+
+
+@app.post("/admin/profile", dependencies=[Depends(check_admin_token)])
+async def arm_profiler(request: ProfileRequest):
+    if request.requests < 1:
+        raise HTTPException(status_code=400, detail="requests 至少为 1")
+    try:
+        return request_profiler.arm(request.requests)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 
 if __name__ == "__main__":
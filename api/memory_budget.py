@@ -0,0 +1,144 @@
+import os
+
+import torch
+
+from config import KV_MEMORY_BUDGET_MB, KV_MEMORY_FRACTION, KV_OOM_RECOVERY_STEPS
+
+# ================= KV Cache 内存预算 =================
+# 连续批处理的批次以左侧 padding 对齐，整个批次的 KV Cache = 行数 x 最长一行的长度 x 每个 token 的字节数，
+# 每个 token 的字节数由模型结构决定：2 (K/V) x 层数 x KV 头数 x head_dim x dtype 字节数。
+# 调度器准入新请求 (或恢复暂停的序列) 前，按“当前长度 + 剩余 max_new_tokens”预估整个批次解码过程中的峰值，
+# 超过预算时先排队，等已有序列结束。预估是上限 (多数回复不到 max_new_tokens 就结束了)；
+# 仍然 OOM 时调度器把批次拆成两半重试 (见 scheduler.py)，同时把上限临时降到出错时的实际用量，
+# 之后每连续成功 KV_OOM_RECOVERY_STEPS 步翻一倍，回到配置的预算 (未配置预算时回到出错那一步的用量) 后取消
+
+MB = 1024 * 1024
+
+
+def is_out_of_memory(error):
+    """GPU 显存不足 (torch.OutOfMemoryError) 或 CPU 内存分配失败"""
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    message = str(error)
+    return isinstance(error, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+
+def release_cached_memory(device):
+    """OOM 之后把 PyTorch 缓存的空闲显存还给驱动，拆分后的批次才有机会重新分配"""
+    if str(device).startswith("cuda"):
+        torch.cuda.empty_cache()
+
+
+def kv_bytes_per_token(model):
+    """按模型配置计算一个 token 在所有层的 K/V 一共占多少字节"""
+    config = model.config
+    if hasattr(config, "get_text_config"):
+        config = config.get_text_config()
+    num_heads = config.num_attention_heads
+    num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+    dtype = getattr(model, "dtype", torch.float32)
+    if not dtype.is_floating_point:
+        # 量化模型的 KV Cache 仍是浮点激活
+        dtype = torch.float32
+    element_size = torch.empty((), dtype=dtype).element_size()
+    return 2 * config.num_hidden_layers * num_kv_heads * head_dim * element_size
+
+
+def available_memory(device):
+    """当前可用的显存 / 物理内存 (字节)，拿不到时返回 None"""
+    if str(device).startswith("cuda"):
+        free, _ = torch.cuda.mem_get_info(torch.device(device))
+        return free
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class MemoryBudget:
+    def __init__(self, recovery_steps=KV_OOM_RECOVERY_STEPS):
+        self.bytes_per_token = 0
+        self.configured_budget = 0  # 配置的批次 KV Cache 上限 (字节)，0 表示不限制
+        # OOM 之后的临时上限 (0 表示没有)，以及取消它的界限和已经连续成功的步数
+        self.oom_cap = 0
+        self.oom_ceiling = 0
+        self.recovery_steps = recovery_steps
+        self.steps_since_oom = 0
+        self.oom_splits = 0
+
+    def configure(self, model, device, budget_mb=KV_MEMORY_BUDGET_MB, fraction=KV_MEMORY_FRACTION):
+        """
+        budget_mb > 0 时直接使用；= 0 时取模型加载后剩余显存 / 内存的 fraction；< 0 时不限制。
+        需要在模型加载完成后调用，自动预算才不会把权重占用的部分算进去
+        """
+        self.bytes_per_token = kv_bytes_per_token(model)
+        if budget_mb > 0:
+            self.configured_budget = budget_mb * MB
+        elif budget_mb == 0:
+            free = available_memory(device)
+            self.configured_budget = int(free * fraction) if free else 0
+        else:
+            self.configured_budget = 0
+        self.oom_cap = 0
+        return self.budget
+
+    @property
+    def enabled(self):
+        return self.configured_budget > 0
+
+    @property
+    def budget(self):
+        """当前生效的上限：配置的预算与 OOM 后的临时上限中较小的一个，0 表示不限制"""
+        limits = [limit for limit in (self.configured_budget, self.oom_cap) if limit > 0]
+        return min(limits) if limits else 0
+
+    def peak_bytes(self, width, remaining):
+        """
+        批次当前缓存长度为 width，各行还要生成 remaining[i] 个 token 时，KV Cache 的峰值。
+        第 k 短的序列结束前，批次里还有 (比它长的行数) 行、缓存长度为 width + remaining[k]，取其中最大值
+        """
+        remaining = sorted(remaining, reverse=True)
+        peak = 0
+        for rows, tokens in enumerate(remaining, start=1):
+            peak = max(peak, rows * (width + tokens))
+        return peak * self.bytes_per_token
+
+    def fits(self, width, remaining):
+        return not self.budget or self.peak_bytes(width, remaining) <= self.budget
+
+    def record_oom(self, bytes_in_use):
+        """
+        实际 OOM 时的用量比预估更可靠：拆分后的重试和暂停序列的恢复先以它为上限。
+        OOM 可能只是一时的 (例如长 prompt 的 prefill)，上限不是永久的，由 record_step 逐步放开
+        """
+        self.oom_splits += 1
+        self.steps_since_oom = 0
+        if bytes_in_use <= 0:
+            return
+        if not self.oom_cap:
+            self.oom_ceiling = self.configured_budget or bytes_in_use
+        self.oom_cap = min(self.oom_cap or bytes_in_use, bytes_in_use)
+
+    def record_step(self):
+        """一次 decode 成功：临时上限每连续成功 recovery_steps 步翻一倍，到达 oom_ceiling 后取消"""
+        if not self.oom_cap:
+            return
+        self.steps_since_oom += 1
+        if self.steps_since_oom < self.recovery_steps:
+            return
+        self.steps_since_oom = 0
+        self.oom_cap *= 2
+        if self.oom_cap >= self.oom_ceiling:
+            self.oom_cap = 0
+
+    def status(self, width=0, remaining=()):
+        return {
+            "enabled": self.enabled,
+            "budget_mb": round(self.budget / MB, 1),
+            "configured_budget_mb": round(self.configured_budget / MB, 1),
+            "oom_cap_mb": round(self.oom_cap / MB, 1),
+            "kv_bytes_per_token": self.bytes_per_token,
+            "projected_peak_mb": round(self.peak_bytes(width, remaining) / MB, 1),
+            "oom_splits": self.oom_splits,
+        }
@@ -0,0 +1,59 @@
+import hashlib
+import os
+import shutil
+
+from config import MERGED_CACHE_DIR
+
+
+# ================= 合并权重磁盘缓存 =================
+# 把 LoRA 合并进基座后保存为 safetensors 分片 (与 upload.py 的保存方式一致)，
+# 目录名取 (基座, 适配器) 的哈希：任意一方变化都会得到新的目录，不会加载到过期的合并结果
+
+# 合并/保存方式变化时调整该版本号，让旧缓存自动失效
+MERGE_FORMAT_VERSION = "1"
+
+
+def _hash_dir(digest, root, by_content):
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if not os.path.isfile(path):
+            continue
+        digest.update(name.encode("utf-8"))
+        if by_content:
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+        else:
+            stat = os.stat(path)
+            digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+
+
+def weights_fingerprint(base_model_path, adapter_path, dtype):
+    """
+    基座权重有几个 GB，每次启动都读一遍太慢，只记录文件名/大小/修改时间；
+    适配器只有几十 MB，直接按内容哈希。合并时的精度 (GPU fp16 / CPU bf16、fp32) 也计入哈希
+    """
+    digest = hashlib.sha256(f"{MERGE_FORMAT_VERSION}:{dtype}".encode("utf-8"))
+    _hash_dir(digest, base_model_path, by_content=False)
+    _hash_dir(digest, adapter_path, by_content=True)
+    return digest.hexdigest()[:16]
+
+
+def merged_checkpoint_dir(base_model_path, adapter_path, dtype, cache_dir=MERGED_CACHE_DIR):
+    return os.path.join(cache_dir, weights_fingerprint(base_model_path, adapter_path, dtype))
+
+
+def save_merged(model, merged_dir):
+    """先写到临时目录再整体改名，保存中途退出不会留下半个 checkpoint"""
+    tmp_dir = merged_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    # 1GB 分片降低保存时的内存峰值
+    model.save_pretrained(tmp_dir, max_shard_size="1GB", safe_serialization=True)
+    try:
+        os.replace(tmp_dir, merged_dir)
+    except OSError:
+        # 另一个进程已经先一步写好了同一份缓存
+        if not os.path.isdir(merged_dir):
+            raise
+        shutil.rmtree(tmp_dir)
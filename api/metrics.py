@@ -0,0 +1,155 @@
+import time
+from threading import Lock
+
+# ================= 服务监控指标 =================
+# GET /metrics 以 Prometheus 文本格式导出 (不依赖 prometheus_client)。
+# 所有指标按角色 (ROLE_MAP 中的角色名)、适配器和优先级 (interactive / bulk) 打标签；时间都从请求提交给调度器开始计算，包含排队时间。
+# 调度线程写入、接口线程读取，统一用一把锁保护
+
+# 延迟类直方图的分桶 (秒)
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 相邻两个 token 之间的间隔 (秒)
+INTER_TOKEN_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0)
+# token 数直方图的分桶
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+LABEL_NAMES = ("role", "adapter", "priority")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, label_names=LABEL_NAMES):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label_names = label_names
+        # labels -> [每个分桶的计数..., 总和, 总数]
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, series):
+                bucket_labels = _format_labels(self.label_names + ("le",), labels + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            inf_labels = _format_labels(self.label_names + ("le",), labels + ("+Inf",))
+            lines.append(f"{self.name}_bucket{inf_labels} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help_text, label_names=LABEL_NAMES):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.series = {}
+
+    def add(self, labels, delta):
+        self.series[labels] = self.series.get(labels, 0) + delta
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for labels, value in sorted(self.series.items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}")
+        return lines
+
+
+def request_labels(request):
+    return (request.role or "none", request.adapter or "default", request.priority)
+
+
+class ServingMetrics:
+    """请求生命周期：queued (提交) -> started (开始 prefill) -> 逐个 token -> finished (正常结束/出错/取消)"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.queue_wait = Histogram("chat_queue_wait_seconds", "提交到开始 prefill 的排队时间", LATENCY_BUCKETS)
+        self.ttft = Histogram("chat_time_to_first_token_seconds", "提交到生成第一个 token 的时间", LATENCY_BUCKETS)
+        self.inter_token = Histogram("chat_inter_token_latency_seconds", "相邻两个 token 的间隔", INTER_TOKEN_BUCKETS)
+        self.latency = Histogram("chat_request_duration_seconds", "提交到生成结束的总时间", LATENCY_BUCKETS)
+        self.prompt_tokens = Histogram("chat_prompt_tokens", "每个请求的 prompt token 数", TOKEN_BUCKETS)
+        self.completion_tokens = Histogram("chat_completion_tokens", "每个请求生成的 token 数", TOKEN_BUCKETS)
+        self.queued = Gauge("chat_requests_queued", "等待调度的请求数")
+        self.in_flight = Gauge("chat_requests_in_flight", "正在 prefill / 解码的请求数")
+
+    def request_queued(self, request):
+        request.submitted_at = time.perf_counter()
+        with self.lock:
+            self.queued.add(request_labels(request), 1)
+
+    def request_rejected(self, request):
+        """等待队列已满，提交失败"""
+        with self.lock:
+            self.queued.add(request_labels(request), -1)
+        request.finished_at = time.perf_counter()
+
+    def request_started(self, request):
+        request.started_at = time.perf_counter()
+        labels = request_labels(request)
+        with self.lock:
+            self.queued.add(labels, -1)
+            self.in_flight.add(labels, 1)
+            self.queue_wait.observe(labels, request.started_at - request.submitted_at)
+
+    def token_generated(self, request):
+        now = time.perf_counter()
+        labels = request_labels(request)
+        with self.lock:
+            if request.first_token_at is None:
+                request.first_token_at = now
+                self.ttft.observe(labels, now - request.submitted_at)
+            else:
+                self.inter_token.observe(labels, now - request.last_token_at)
+        request.last_token_at = now
+
+    def request_finished(self, request):
+        if request.finished_at is not None or request.submitted_at is None:
+            # 已经记录过 (出错后重复通知)，或者没有经过调度器
+            return
+        request.finished_at = time.perf_counter()
+        labels = request_labels(request)
+        with self.lock:
+            if request.started_at is None:
+                self.queued.add(labels, -1)
+                return
+            self.in_flight.add(labels, -1)
+            self.latency.observe(labels, request.finished_at - request.submitted_at)
+            self.prompt_tokens.observe(labels, len(request.input_ids))
+            self.completion_tokens.observe(labels, request.num_generated)
+
+    def render(self):
+        with self.lock:
+            lines = []
+            for metric in (self.queue_wait, self.ttft, self.inter_token, self.latency,
+                           self.prompt_tokens, self.completion_tokens, self.queued, self.in_flight):
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# 全局单例
+serving_metrics = ServingMetrics()
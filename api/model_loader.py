@@ -2,11 +2,105 @@ import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from peft import PeftModel
 import os
+from concurrent.futures import ThreadPoolExecutor
+from kv_cache import CachedPrefix, cache_to_tensors
+from roles import ROLE_PROMPTS, ROLE_KEYS, tokenized_roles
+from config import ROLE_ADAPTER_DIR, MERGE_WEIGHTS, CPU_QUANTIZE, DRAFT_MODEL_PATH, MMAP_WEIGHTS
+from merged_weights import merged_checkpoint_dir, save_merged
+from cpu_profile import model_dtype, setup_threads, prepare_cpu_model, describe
+from shared_weights import load_mmap_model, checkpoint_dtype
+from startup import startup_progress
 
-# 配置路径 (请确保路径正确)
-BASE_MODEL_PATH = "../models/Qwen/Qwen2.5-3B-Instruct"
-ADAPTER_PATH = "../models/qwen_social_finetune_final"
+# 配置路径 (请确保路径正确，也可以用同名环境变量覆盖)
+BASE_MODEL_PATH = os.environ.get("BASE_MODEL_PATH", "../models/Qwen/Qwen2.5-3B-Instruct")
+ADAPTER_PATH = os.environ.get("ADAPTER_PATH", "../models/qwen_social_finetune_final")
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+# 通用适配器的名字 (PEFT 默认名)，不能被卸载或替换
+DEFAULT_ADAPTER = "default"
+# GPU 上自动分配显存；CPU 上全部放在内存里
+DEVICE_MAP = "auto" if DEVICE == "cuda" else "cpu"
+
+
+def load_pretrained(model_path, dtype):
+    """
+    CPU 上 checkpoint 的 dtype 与推理 dtype 一致时直接 mmap 映射 safetensors (MMAP_WEIGHTS=1)，
+    其余情况 (GPU、需要转换 dtype、不是本地 safetensors) 用 from_pretrained 读进内存
+    """
+    if MMAP_WEIGHTS and DEVICE == "cpu" and checkpoint_dtype(model_path) == dtype:
+        print(f"🚀 正在映射模型权重 ({dtype}, mmap): {model_path}...")
+        return load_mmap_model(model_path, dtype)
+    print(f"🚀 正在加载模型权重 ({dtype}): {model_path}...")
+    model = AutoModelForCausalLM.from_pretrained(
+        model_path,
+        dtype=dtype,
+        device_map=DEVICE_MAP,
+        low_cpu_mem_usage=True,
+        trust_remote_code=True
+    )
+    return model.eval()
+
+
+def load_peft_model(base_model_path, adapter_path, dtype=None):
+    dtype = dtype or model_dtype(DEVICE)
+    print(f"🚀 正在加载基座模型 ({dtype})...")
+    base_model = load_pretrained(base_model_path, dtype)
+
+    print(f"🚀 正在注入 LoRA 适配器: {adapter_path}...")
+    model = PeftModel.from_pretrained(
+        base_model,
+        adapter_path,
+        adapter_name=DEFAULT_ADAPTER,
+        dtype=dtype,
+    )
+    return model.eval()
+
+
+def load_merged_model(base_model_path, adapter_path, dtype=None):
+    """
+    合并权重快速路径：LoRA 合并进基座后就是一个普通模型，推理时不再有旁路矩阵乘。
+    第一次启动合并并写入磁盘缓存，之后直接加载合并好的 checkpoint
+    """
+    dtype = dtype or model_dtype(DEVICE)
+    merged_dir = merged_checkpoint_dir(base_model_path, adapter_path, dtype)
+    if os.path.isdir(merged_dir):
+        # CPU 上直接映射合并好的 safetensors：多个 worker 进程共享同一份物理内存
+        print(f"🚀 正在加载已合并的模型: {merged_dir}...")
+        return load_pretrained(merged_dir, dtype)
+
+    model = load_peft_model(base_model_path, adapter_path, dtype)
+    print("🚀 正在合并 LoRA 权重 (Merge and Unload)...")
+    model = model.merge_and_unload()
+    print(f"🚀 正在缓存合并后的模型: {merged_dir}...")
+    save_merged(model, merged_dir)
+    return model.eval()
+
+
+def load_draft_model(draft_model_path, dtype=None):
+    """投机解码用的草稿模型：不挂 LoRA，与基座使用同一个 tokenizer"""
+    dtype = dtype or model_dtype(DEVICE)
+    print(f"🚀 正在加载草稿模型 ({dtype}): {draft_model_path}...")
+    return load_pretrained(draft_model_path, dtype)
+
+
+def prefetch_files(directories, chunk_size=8 * 1024 * 1024):
+    """
+    把目录下的文件顺序读一遍，让它们进入操作系统页缓存：与基座权重的加载同时进行，
+    之后 PEFT 加载适配器时直接从内存读取，不再等磁盘
+    """
+    total = 0
+    for directory in directories:
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, "rb", buffering=0) as f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        break
+                    total += len(chunk)
+    return total
+
 
 class ModelService:
     _instance = None
@@ -16,38 +110,191 @@ class ModelService:
             cls._instance = super(ModelService, cls).__new__(cls)
             cls._instance.model = None
             cls._instance.tokenizer = None
+            cls._instance.role_prefixes = {}
+            # 已加载的适配器：name -> {"path", "version"}
+            cls._instance.adapters = {}
+            cls._instance.adapter_loads = 0
+            # 角色 -> 适配器名，未登记的角色使用 DEFAULT_ADAPTER
+            cls._instance.role_adapters = {}
+            # LoRA 已合并进基座权重 (不再是 PeftModel，不能热加载适配器)
+            cls._instance.merged = False
+            # CPU 模式下 Linear 层已量化 (PEFT 无法再往量化层上注入新的适配器)
+            cls._instance.quantized = False
+            # 投机解码的草稿模型 (未配置 DRAFT_MODEL_PATH 时为 None)
+            cls._instance.draft_model = None
         return cls._instance
 
-    def load_model(self):
+    def load_model(self, base_model_path=BASE_MODEL_PATH, adapter_path=ADAPTER_PATH, merge=MERGE_WEIGHTS,
+                   draft_model_path=DRAFT_MODEL_PATH):
         if self.model is not None:
             return
 
-        print("🚀 正在加载 Tokenizer...")
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            BASE_MODEL_PATH,
-            trust_remote_code=True,
-            padding_side="left"
-        )
-        if self.tokenizer.pad_token is None:
-            self.tokenizer.pad_token = self.tokenizer.eos_token
-
-        print("🚀 正在加载基座模型 (FP16)...")
-        base_model = AutoModelForCausalLM.from_pretrained(
-            BASE_MODEL_PATH,
-            torch_dtype=torch.float16,
-            device_map="auto",
-            trust_remote_code=True
-        )
-
-        print(f"🚀 正在注入 LoRA 适配器: {ADAPTER_PATH}...")
-        self.model = PeftModel.from_pretrained(
-            base_model,
-            ADAPTER_PATH,
-            torch_dtype=torch.float16,
-        )
-        self.model.eval()
+        role_adapter_paths = {
+            role_name: os.path.join(ROLE_ADAPTER_DIR, role_key)
+            for role_name, role_key in ROLE_KEYS.items()
+            if os.path.isdir(os.path.join(ROLE_ADAPTER_DIR, role_key))
+        }
+
+        if DEVICE == "cpu":
+            setup_threads()
+        print(f"🚀 推理设备: {describe(DEVICE)}")
+
+        # 只有一个通用适配器时走合并权重快速路径；有角色专属适配器时需要 PEFT 按行切换适配器
+        self.merged = merge and not role_adapter_paths
+        # tokenizer 和适配器文件的读取与基座权重的加载同时进行 (后者大部分时间在读盘 / 拷贝，会释放 GIL)
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="model-load") as pool:
+            tokenizer_future = pool.submit(self._load_tokenizer, base_model_path)
+            prefetch_future = pool.submit(self._prefetch_adapters, [adapter_path] + list(role_adapter_paths.values()))
+            with startup_progress.phase("weights"):
+                if self.merged:
+                    self.model = load_merged_model(base_model_path, adapter_path)
+                else:
+                    self.model = load_peft_model(base_model_path, adapter_path)
+            self.tokenizer = tokenizer_future.result()
+            prefetch_future.result()
+        self.adapter_loads = 1
+        self.adapters[DEFAULT_ADAPTER] = {"path": adapter_path, "version": self.adapter_loads}
+
+        # 角色专属适配器：只加载 LoRA 权重 (几十 MB)，基座权重全部共享
+        with startup_progress.phase("role_adapters"):
+            for role_name, role_adapter_path in role_adapter_paths.items():
+                print(f"🚀 正在加载角色适配器 [{role_name}]: {role_adapter_path}...")
+                self._load_adapter_weights(ROLE_KEYS[role_name], role_adapter_path)
+                self.role_adapters[role_name] = ROLE_KEYS[role_name]
+
+        if DEVICE == "cpu":
+            # 量化/编译放在所有适配器加载之后做，合并缓存里保存的始终是未量化的权重
+            with startup_progress.phase("prepare_cpu"):
+                self.model = prepare_cpu_model(self.model)
+            self.quantized = CPU_QUANTIZE != "none"
+
+        if draft_model_path:
+            with startup_progress.phase("draft_model"):
+                self.draft_model = load_draft_model(draft_model_path)
+            draft_vocab = self.draft_model.get_input_embeddings().weight.shape[0]
+            target_vocab = self.model.get_input_embeddings().weight.shape[0]
+            if draft_vocab != target_vocab:
+                # 词表不一致时草稿 token 无法直接交给大模型验证
+                print(f"⚠️ 草稿模型词表 ({draft_vocab}) 与基座 ({target_vocab}) 不一致，已关闭投机解码")
+                self.draft_model = None
         print("✅ 模型加载完成！")
 
+        with startup_progress.phase("role_prefixes"):
+            self.build_role_prefixes()
+
+    @staticmethod
+    def _load_tokenizer(base_model_path):
+        with startup_progress.phase("tokenizer"):
+            print("🚀 正在加载 Tokenizer...")
+            tokenizer = AutoTokenizer.from_pretrained(
+                base_model_path,
+                trust_remote_code=True,
+                padding_side="left"
+            )
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            return tokenizer
+
+    @staticmethod
+    def _prefetch_adapters(adapter_paths):
+        with startup_progress.phase("adapter_prefetch"):
+            return prefetch_files([path for path in adapter_paths if os.path.isdir(path)])
+
+    @torch.no_grad()
+    def build_role_prefixes(self, role_names=None):
+        """
+        每个角色的 system prompt 固定不变，启动时预先 prefill 一次并缓存 KV，
+        请求到来时从这份前缀开始生成，只需要 prefill 用户/助手的历史消息。
+        LoRA 会改变 K/V，因此前缀必须用该角色对应的适配器计算，切换适配器后要重新计算。
+        system prompt 的 token id 来自角色注册表 (按 tokenizer 哈希缓存在磁盘上)
+        """
+        print("🚀 正在预计算角色 System Prompt 的 KV Cache...")
+        tokenized = tokenized_roles(self.tokenizer)
+        for role_name in role_names or ROLE_PROMPTS:
+            adapter = self.adapter_for_role(role_name)
+            prefix_ids = tokenized.prompt_ids(role_name)
+            input_ids = torch.tensor([prefix_ids], dtype=torch.long, device=self.model.device)
+            outputs = self.model(input_ids=input_ids, use_cache=True, **self.adapter_kwargs([adapter]))
+            self.role_prefixes[role_name] = CachedPrefix(
+                prefix_ids, cache_to_tensors(outputs.past_key_values), adapter=self.adapter_tag(adapter)
+            )
+        tokenized.save()
+        print(f"✅ 已缓存 {len(role_names or self.role_prefixes)} 个角色前缀")
+
+    def get_role_prefix(self, role_name):
+        return self.role_prefixes.get(role_name)
+
+    # ---------- 多适配器 ----------
+    def adapter_for_role(self, role_name):
+        return self.role_adapters.get(role_name, DEFAULT_ADAPTER)
+
+    def adapter_tag(self, adapter):
+        """适配器名 + 版本号，用来判断缓存的 KV 是否由当前加载的权重计算"""
+        return f"{adapter}@{self.adapters[adapter]['version']}"
+
+    def adapter_kwargs(self, adapters):
+        """
+        只加载了一个适配器时走普通 forward；加载了多个时按行传入 adapter_names，
+        PEFT 会在同一个 batch 里为不同行套用不同的 LoRA 权重 (基座部分仍然一起算)
+        """
+        if self.merged or len(self.model.peft_config) <= 1:
+            return {}
+        return {"adapter_names": list(adapters)}
+
+    def _load_adapter_weights(self, name, path):
+        if name in self.model.peft_config:
+            self.model.delete_adapter(name)
+        self.model.load_adapter(path, adapter_name=name)
+        # 版本号全局递增，卸载后再加载同名适配器也不会和旧缓存撞上
+        self.adapter_loads += 1
+        self.adapters[name] = {"path": path, "version": self.adapter_loads}
+
+    def load_adapter(self, name, path, role_names=()):
+        """
+        热加载 (或替换) 一个适配器并把指定角色切换过去。
+        会修改模型结构，必须在调度线程空闲时调用 (generation_scheduler.run_exclusive)
+        """
+        if name == DEFAULT_ADAPTER:
+            raise ValueError("通用适配器不能被替换")
+        if self.merged:
+            raise ValueError("当前使用合并权重 (MERGE_WEIGHTS=1)，不支持热加载适配器；需要热加载时以 MERGE_WEIGHTS=0 启动")
+        if self.quantized:
+            raise ValueError("Linear 层已量化 (CPU_QUANTIZE)，不支持热加载适配器")
+        if not os.path.isdir(path):
+            raise ValueError(f"适配器目录不存在: {path}")
+        self._load_adapter_weights(name, path)
+        for role_name in role_names:
+            self.role_adapters[role_name] = name
+        # 使用该适配器的角色 (包括替换前就指向它的角色) 都要重新计算前缀
+        affected = [role for role, adapter in self.role_adapters.items() if adapter == name]
+        if affected:
+            self.build_role_prefixes(affected)
+
+    def unload_adapter(self, name):
+        """卸载适配器，原来使用它的角色回退到通用适配器 (同样需要在调度线程空闲时调用)"""
+        if name == DEFAULT_ADAPTER:
+            raise ValueError("通用适配器不能被卸载")
+        if name not in self.adapters:
+            raise ValueError(f"适配器不存在: {name}")
+        affected = [role for role, adapter in self.role_adapters.items() if adapter == name]
+        for role_name in affected:
+            del self.role_adapters[role_name]
+        self.model.delete_adapter(name)
+        del self.adapters[name]
+        if affected:
+            self.build_role_prefixes(affected)
+
+    def adapter_status(self):
+        return {
+            "merged": self.merged,
+            "quantized": self.quantized,
+            "adapters": {name: dict(info) for name, info in self.adapters.items()},
+            "roles": {role_name: self.adapter_for_role(role_name) for role_name in ROLE_PROMPTS},
+        }
+
+    def get_draft_model(self):
+        return self.draft_model
+
     def get_model(self):
         return self.tokenizer, self.model
 
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import time
+import uuid
+from typing import List, Dict, Optional, Union
+
+from pydantic import BaseModel
+
+from roles import ROLE_PROMPTS, ROLE_KEYS, role_of_system_prompt
+from streaming import paced_chunks
+
+# ================= OpenAI 兼容接口 =================
+# /v1/chat/completions 的请求/响应格式与 OpenAI Chat Completions 一致，
+# 用 OpenAI SDK 写的评测脚本 (如 evaluate/model_score.py) 只需把 base_url 指向本服务即可。
+# 角色的确定：model 名带角色后缀 (qwen-social-elder) 或 system 消息里带【长辈】这类标记；
+# 客户端没有传 system 消息时使用该角色的默认 Prompt
+
+MODEL_NAME = "qwen-social"
+ROLE_BY_KEY = {role_key: role_name for role_name, role_key in ROLE_KEYS.items()}
+
+
+class OpenAIChatRequest(BaseModel):
+    model: str = MODEL_NAME
+    messages: List[Dict[str, Union[str, List[Dict[str, str]], None]]]
+    temperature: float = 0.85
+    top_p: float = 0.95
+    # 同一个 prompt 生成 n 个候选回复：只 prefill 一次，KV Cache 复制成 n 行一起解码
+    n: int = 1
+    max_tokens: Optional[int] = None
+    stream: bool = False
+    # stream 时传 {"include_usage": true}，最后多发一帧用量统计
+    stream_options: Optional[Dict[str, bool]] = None
+    seed: Optional[int] = None
+    # 租户标识：同一优先级内按 user 轮流准入 (公平调度)
+    user: Optional[str] = None
+    # 扩展字段 (OpenAI SDK 用 extra_body 传入)：interactive / bulk，离线评测、数据生成请传 bulk
+    priority: str = "interactive"
+
+
+def model_names():
+    return [MODEL_NAME] + [f"{MODEL_NAME}-{role_key}" for role_key in ROLE_KEYS.values()]
+
+
+def message_text(content):
+    """content 可以是字符串，也可以是 [{"type": "text", "text": ...}] 形式的分段"""
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if part.get("type") == "text")
+    return content or ""
+
+
+def resolve_role(model, messages):
+    """
+    返回 (角色名或 None, system prompt, 对话历史)。
+    model 名里的角色优先；没有时从 system 消息的【角色】标记推断；都没有时不套角色 (使用通用适配器)
+    """
+    system_prompt = None
+    history = []
+    for msg in messages:
+        content = message_text(msg.get("content"))
+        if msg.get("role") == "system":
+            # 多条 system 消息合并成一条
+            system_prompt = content if system_prompt is None else system_prompt + "\n" + content
+        elif msg.get("role") in ("user", "assistant"):
+            history.append({"role": msg["role"], "content": content})
+
+    if model.startswith(MODEL_NAME + "-"):
+        role_name = ROLE_BY_KEY.get(model[len(MODEL_NAME) + 1:])
+        if role_name is None:
+            raise ValueError(f"未知的模型: {model}，可选: {model_names()}")
+    else:
+        # 也接受裸的角色标识 (elder)；评测脚本里写死的其他模型名 (如 gpt-4o) 按通用模型处理
+        role_name = ROLE_BY_KEY.get(model)
+
+    if role_name is None and system_prompt is not None:
+        role_name = role_of_system_prompt(system_prompt)
+    if system_prompt is None and role_name is not None:
+        system_prompt = ROLE_PROMPTS[role_name]
+    return role_name, system_prompt, history
+
+
+def completion_id():
+    return f"chatcmpl-{uuid.uuid4().hex}"
+
+
+def finish_reason(request):
+    return "length" if request.num_generated >= request.max_new_tokens else "stop"
+
+
+def usage(requests):
+    # n 个候选共享同一个 prompt，prompt 只计一次 (也只 prefill 了一次)
+    prompt_tokens = len(requests[0].input_ids)
+    completion_tokens = sum(request.num_generated for request in requests)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+async def _collect(stream):
+    text = ""
+    async for piece in paced_chunks(stream, "none"):
+        text += piece
+    return text
+
+
+async def completion_response(cid, model, requests, streams):
+    """非流式：等 n 个候选全部生成完，一次返回"""
+    texts = await asyncio.gather(*(_collect(stream) for stream in streams))
+    return {
+        "id": cid,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": index,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": finish_reason(request),
+            }
+            for index, (request, text) in enumerate(zip(requests, texts))
+        ],
+        "usage": usage(requests),
+    }
+
+
+def _chunk_frame(cid, created, model, choices, usage_info=None):
+    chunk = {"id": cid, "object": "chat.completion.chunk", "created": created, "model": model, "choices": choices}
+    if usage_info is not None:
+        chunk["usage"] = usage_info
+    return "data: " + json.dumps(chunk, ensure_ascii=False) + "\n\n"
+
+
+async def completion_chunks(cid, model, requests, streams, include_usage=False):
+    """
+    流式：n 个候选交错推送，每帧带上 choices[].index。
+    每个候选先发一帧 role，结束时发一帧 finish_reason，最后 (可选) 发用量统计和 [DONE]
+    """
+    created = int(time.time())
+    frames = asyncio.Queue()
+
+    async def pump(index, request, stream):
+        await frames.put({"index": index, "delta": {"role": "assistant", "content": ""}, "finish_reason": None})
+        async for piece in paced_chunks(stream, "none"):
+            await frames.put({"index": index, "delta": {"content": piece}, "finish_reason": None})
+        await frames.put({"index": index, "delta": {}, "finish_reason": finish_reason(request)})
+
+    async def pump_all():
+        try:
+            await asyncio.gather(*(pump(index, request, stream)
+                                   for index, (request, stream) in enumerate(zip(requests, streams))))
+        finally:
+            await frames.put(None)
+
+    task = asyncio.create_task(pump_all())
+    try:
+        while True:
+            choice = await frames.get()
+            if choice is None:
+                break
+            yield _chunk_frame(cid, created, model, [choice])
+        # 生成过程中的异常在这里重新抛出
+        await task
+        if include_usage:
+            yield _chunk_frame(cid, created, model, [], usage(requests))
+        yield "data: [DONE]\n\n"
+    finally:
+        task.cancel()
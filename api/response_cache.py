@@ -0,0 +1,93 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from config import RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL
+
+
+# ================= 精确匹配回复缓存 =================
+def is_deterministic(temperature, seed):
+    """固定 seed 的采样和贪心解码结果可复现，才允许缓存"""
+    return seed is not None or temperature <= 0
+
+
+def _normalize(text):
+    # 去掉首尾空白并合并连续空白，“有对象了吗 ” 和 “有对象了吗” 视为同一句
+    return " ".join(text.split())
+
+
+def make_key(role, messages, temperature, top_p, seed, adapter):
+    payload = {
+        "role": role,
+        "messages": [[msg["role"], _normalize(msg["content"])] for msg in messages],
+        "temperature": temperature,
+        "top_p": top_p,
+        # 贪心解码与 seed 无关
+        "seed": seed if temperature > 0 else None,
+        "adapter": adapter,
+    }
+    text = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class ResponseCache:
+    """
+    key -> 一次完整回复的文本片段列表，命中时按原来的分帧直接回放成 SSE，不经过模型。
+    条目数超过 max_entries 时按 LRU 淘汰，超过 ttl_seconds 的条目视为过期
+    """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()  # key -> (写入时间, [chunk, ...])
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, chunks):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), list(chunks))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def record_bypass(self):
+        with self.lock:
+            self.bypassed += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+# 全局单例
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
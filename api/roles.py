@@ -0,0 +1,12 @@
+import os
+import sys
+
+# ================= 角色定义 =================
+# 角色编号、规范 prompt、英文标识等统一定义在仓库根目录的 role_registry.py，
+# 训练数据处理、本地测试和评估脚本都从那里导入，服务端的 system prompt 与训练数据保持一致。
+# 这里只是接口层 (main.py)、模型加载 (model_loader.py 预计算 system prompt 的 KV Cache) 等模块的导入入口
+
+# 追加在末尾：api 目录下的同名模块 (main.py 等) 仍然优先
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from role_registry import ROLE_MAP, ROLE_PROMPTS, ROLE_KEYS, ROLES, role_of_system_prompt, tokenized_roles  # noqa: E402
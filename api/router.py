@@ -0,0 +1,345 @@
+import asyncio
+import json
+from collections import OrderedDict
+
+import httpx
+from fastapi import FastAPI, Request, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response
+
+from config import ROUTER_WORKERS, ROUTER_STICKY_SESSIONS, MAX_NEW_TOKENS, RETRY_AFTER_SECONDS
+from streaming import ClosingStreamingResponse
+
+# 每隔多少秒检查一次 worker 是否就绪 (GET /readyz：还在加载模型、或被标记为不可用的 worker 就绪后重新参与分配)
+HEALTH_CHECK_SECONDS = 5
+
+# ================= 多副本路由器 =================
+# 放在多个 worker 进程 (各自一份 main.py，权重通过 mmap 共享) 前面的轻量反向代理：
+# - 按“在途 token 数”均衡：每个转发中的请求记 (prompt 估算 token + 最多生成的 token)，选当前最少的 worker
+# - 会话粘性：带 conversation_id / session_id / user 的请求始终转发到同一个 worker，命中它的多轮 KV Cache
+# - /admin/* 广播给所有 worker (适配器、剖析等配置要保持一致)
+# - /ws/* (WebSocket 聊天) 按第一条消息里的 session_id 选 worker，之后双向原样转发
+# 路由器本身不加载模型，由 launcher.py 启动
+
+HOP_HEADERS = {"content-length", "transfer-encoding", "connection", "keep-alive"}
+
+
+def estimate_tokens(payload):
+    """
+    不加载 tokenizer，按字符数粗略估算 prompt token 数 (中文约一字一 token)，再加上本次最多生成的 token。
+    /chat/batch 的消息在 items 里，按每个条目分别估算后求和
+    """
+    items = payload.get("items")
+    if isinstance(items, list):
+        return sum(_estimate_one(item) for item in items if isinstance(item, dict))
+    return _estimate_one(payload)
+
+
+def _estimate_one(payload):
+    messages = payload.get("messages") or []
+    prompt = sum(len(str(msg.get("content") or "")) for msg in messages if isinstance(msg, dict))
+    max_new = payload.get("max_tokens") or payload.get("max_new_tokens") or MAX_NEW_TOKENS
+    return prompt + min(int(max_new), MAX_NEW_TOKENS) * max(int(payload.get("n") or 1), 1)
+
+
+def socket_turn_cost(payload):
+    """WebSocket 的一轮生成：历史在 worker 上，只能按本轮消息 + 最多生成的 token 估算"""
+    return len(str(payload.get("content") or "")) + MAX_NEW_TOKENS
+
+
+def session_key(payload):
+    for field in ("conversation_id", "session_id", "user"):
+        if payload.get(field):
+            return f"{field}:{payload[field]}"
+    return None
+
+
+class Worker:
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.in_flight_tokens = 0
+        self.in_flight_requests = 0
+        self.total_requests = 0
+        self.healthy = True
+
+    def status(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "in_flight_tokens": self.in_flight_tokens,
+            "in_flight_requests": self.in_flight_requests,
+            "total_requests": self.total_requests,
+        }
+
+
+class Router:
+    def __init__(self, urls, sticky_sessions=ROUTER_STICKY_SESSIONS):
+        self.workers = [Worker(url) for url in urls]
+        self.sticky = OrderedDict()  # 会话 -> worker 下标 (LRU)
+        self.sticky_sessions = sticky_sessions
+        self.jobs = OrderedDict()  # 批量任务 id -> worker 下标 (任务状态只保存在创建它的 worker 上)
+        self.client = None
+        self.health_task = None
+
+    def start(self):
+        # 生成可能持续几十秒，不设读超时
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(10.0, read=None))
+
+    async def close(self):
+        await self.client.aclose()
+
+    def pick(self, key=None, exclude=()):
+        """有粘性记录且 worker 健康时沿用；否则选在途 token 最少的健康 worker"""
+        if key is not None and key in self.sticky:
+            index = self.sticky[key]
+            if self.workers[index].healthy and index not in exclude:
+                self.sticky.move_to_end(key)
+                return index
+        candidates = [i for i, worker in enumerate(self.workers) if worker.healthy and i not in exclude]
+        if not candidates:
+            # 全部标记为不健康时仍然尝试一次 (可能只是暂时连不上)
+            candidates = [i for i in range(len(self.workers)) if i not in exclude]
+        if not candidates:
+            return None
+        index = min(candidates, key=lambda i: (self.workers[i].in_flight_tokens, self.workers[i].in_flight_requests))
+        if key is not None:
+            self.sticky[key] = index
+            self.sticky.move_to_end(key)
+            while len(self.sticky) > self.sticky_sessions:
+                self.sticky.popitem(last=False)
+        return index
+
+    async def check_health(self):
+        for worker in self.workers:
+            try:
+                response = await self.client.get(worker.url + "/readyz", timeout=HEALTH_CHECK_SECONDS)
+                worker.healthy = response.status_code == 200
+            except httpx.HTTPError:
+                worker.healthy = False
+
+    async def health_loop(self):
+        while True:
+            await self.check_health()
+            await asyncio.sleep(HEALTH_CHECK_SECONDS)
+
+    def status(self):
+        return {"workers": [worker.status() for worker in self.workers], "sticky_sessions": len(self.sticky)}
+
+
+router = Router([url for url in ROUTER_WORKERS.split(",") if url.strip()])
+app = FastAPI(title="Qwen Social Chat Router")
+
+
+@app.on_event("startup")
+async def startup_event():
+    router.start()
+    router.health_task = asyncio.create_task(router.health_loop())
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    router.health_task.cancel()
+    await router.close()
+
+
+def _forward_headers(headers):
+    return {k: v for k, v in headers.items() if k.lower() not in HOP_HEADERS and k.lower() != "host"}
+
+
+async def _send(index, method, path, query, headers, body):
+    worker = router.workers[index]
+    upstream = router.client.build_request(method, worker.url + path, params=query, headers=headers, content=body)
+    return await router.client.send(upstream, stream=True)
+
+
+@app.get("/router/status")
+async def router_status():
+    return router.status()
+
+
+@app.api_route("/admin/{path:path}", methods=["GET", "POST", "DELETE"])
+async def broadcast_admin(path: str, request: Request):
+    """管理接口广播给所有 worker，返回每个 worker 的结果"""
+    body = await request.body()
+    headers = _forward_headers(request.headers)
+
+    async def call(worker):
+        try:
+            response = await router.client.request(request.method, f"{worker.url}/admin/{path}",
+                                                   params=request.query_params, headers=headers, content=body)
+            return {"worker": worker.url, "status_code": response.status_code, "body": response.json()}
+        except (httpx.HTTPError, ValueError) as e:
+            return {"worker": worker.url, "error": str(e)}
+
+    return await asyncio.gather(*(call(worker) for worker in router.workers))
+
+
+def _socket_url(worker, path):
+    # http://host:port -> ws://host:port，https -> wss
+    return "ws" + worker.url[len("http"):] + path
+
+
+def _parse_message(text):
+    try:
+        message = json.loads(text)
+    except ValueError:
+        return {}
+    return message if isinstance(message, dict) else {}
+
+
+async def _connect_socket(key, path, headers):
+    """按会话选 worker 并建立上游 WebSocket，连不上时换一个 worker，返回 (worker, 上游连接)"""
+    from websockets.asyncio.client import connect
+    from websockets.exceptions import InvalidHandshake
+
+    tried = set()
+    while True:
+        index = router.pick(key, exclude=tried)
+        if index is None:
+            return None, None
+        worker = router.workers[index]
+        try:
+            upstream = await connect(_socket_url(worker, path), additional_headers=headers, open_timeout=10)
+            worker.healthy = True
+            return worker, upstream
+        except (OSError, InvalidHandshake, asyncio.TimeoutError):
+            worker.healthy = False
+            tried.add(index)
+
+
+@app.websocket("/ws/{path:path}")
+async def proxy_socket(websocket: WebSocket, path: str):
+    """
+    WebSocket 聊天的转发。客户端的第一条消息 (start) 带 session_id，按它选 worker 并保持粘性：
+    会话和多轮 KV Cache 在这个 worker 上，与 HTTP 接口携带 session_id 的请求落在同一个 worker。
+    每一轮生成 (message -> done / error) 计入该 worker 的在途 token
+    """
+    await websocket.accept()
+    try:
+        first = await websocket.receive_text()
+    except WebSocketDisconnect:
+        return
+    headers = {k: v for k, v in websocket.headers.items()
+               if k.lower() in ("cookie", "authorization", "x-admin-token", "x-request-id")}
+    worker, upstream = await _connect_socket(session_key(_parse_message(first)), "/ws/" + path, headers)
+    if upstream is None:
+        await websocket.send_json({"type": "error", "detail": "没有可用的 worker", "retry_after": RETRY_AFTER_SECONDS})
+        await websocket.close(code=1013)
+        return
+
+    turns = []  # 进行中的各轮生成计入的 token 数
+    worker.in_flight_requests += 1
+    worker.total_requests += 1
+
+    async def client_to_worker():
+        text = first
+        while True:
+            message = _parse_message(text)
+            if message.get("type") == "message":
+                turns.append(socket_turn_cost(message))
+                worker.in_flight_tokens += turns[-1]
+            await upstream.send(text)
+            try:
+                text = await websocket.receive_text()
+            except WebSocketDisconnect:
+                return
+
+    async def worker_to_client():
+        async for text in upstream:
+            if turns and _parse_message(text).get("type") in ("done", "error"):
+                worker.in_flight_tokens -= turns.pop(0)
+            await websocket.send_text(text)
+
+    tasks = [asyncio.create_task(client_to_worker()), asyncio.create_task(worker_to_client())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # 客户端断开时关闭上游连接，worker 那边随之取消正在进行的生成
+        await upstream.close()
+        worker.in_flight_tokens -= sum(turns)
+        worker.in_flight_requests -= 1
+        try:
+            # worker 主动关闭时把关闭码 (例如模型加载中的 1013) 原样带给客户端
+            await websocket.close(code=upstream.close_code or 1000)
+        except RuntimeError:
+            pass
+
+
+@app.api_route("/{path:path}", methods=["GET", "POST", "DELETE"])
+async def proxy(path: str, request: Request):
+    body = await request.body()
+    path = "/" + path
+    payload = {}
+    if body and request.method == "POST":
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = {}
+    payload = payload if isinstance(payload, dict) else {}
+
+    # 批量任务的查询 / 取消必须回到创建它的 worker
+    job_index = None
+    if path.startswith("/chat/batch/"):
+        job_index = router.jobs.get(path.split("/")[3])
+        if job_index is None:
+            raise HTTPException(status_code=404, detail="任务不存在")
+
+    cost = estimate_tokens(payload) if request.method == "POST" else 0
+    key = session_key(payload)
+    headers = _forward_headers(request.headers)
+    tried = set()
+    while True:
+        index = job_index if job_index is not None else router.pick(key, exclude=tried)
+        if index is None:
+            raise HTTPException(status_code=503, detail="没有可用的 worker",
+                                headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+        worker = router.workers[index]
+        # 发出请求前就计入在途 token：非流式接口要等生成结束才返回响应头
+        worker.in_flight_tokens += cost
+        worker.in_flight_requests += 1
+        try:
+            upstream = await _send(index, request.method, path, request.query_params, headers, body)
+            worker.healthy = True
+            worker.total_requests += 1
+            break
+        except httpx.TransportError:
+            # 连不上 (worker 重启中 / 已退出)：标记后换一个 worker 重试，粘性会话也随之迁移
+            worker.in_flight_tokens -= cost
+            worker.in_flight_requests -= 1
+            worker.healthy = False
+            tried.add(index)
+            if job_index is not None:
+                raise HTTPException(status_code=502, detail=f"worker 不可用: {worker.url}")
+
+    def release():
+        worker.in_flight_tokens -= cost
+        worker.in_flight_requests -= 1
+
+    response_headers = _forward_headers(upstream.headers)
+    media_type = upstream.headers.get("content-type")
+    if path == "/chat/batch" and not payload.get("stream", True):
+        # 非流式批量任务：记下任务 id 属于哪个 worker
+        try:
+            content = await upstream.aread()
+        finally:
+            await upstream.aclose()
+            release()
+        job_id = json.loads(content).get("job_id") if upstream.status_code == 200 else None
+        if job_id:
+            router.jobs[job_id] = index
+            while len(router.jobs) > router.sticky_sessions:
+                router.jobs.popitem(last=False)
+        return Response(content=content, status_code=upstream.status_code, headers=response_headers,
+                        media_type=media_type)
+
+    async def finish_relay():
+        # 客户端断开 (包括还没开始读响应体就断开) 时关闭上游连接，worker 那边随之停止解码
+        try:
+            await upstream.aclose()
+        finally:
+            release()
+
+    return ClosingStreamingResponse(upstream.aiter_raw(), on_close=finish_relay, status_code=upstream.status_code,
+                                    headers=response_headers, media_type=media_type)
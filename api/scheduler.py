@@ -0,0 +1,954 @@
+import asyncio
+import inspect
+import time
+from concurrent.futures import Future
+from collections import deque
+from queue import Queue, Empty, Full
+from threading import Thread
+
+import torch
+
+from metrics import serving_metrics
+from tracing import NULL_TRACE, request_profiler
+from fair_queue import FairQueue, INTERACTIVE, BULK, PRIORITIES
+from memory_budget import MemoryBudget, is_out_of_memory, release_cached_memory
+from kv_cache import (
+    cache_to_tensors,
+    crop,
+    tensors_to_cache,
+    kv_seq_len,
+    pad_left,
+    concat_batch,
+    select_batch,
+    trim_left,
+    kv_nbytes,
+    conversation_cache,
+)
+
+
+# ================= 输出通道 =================
+class TokenStream:
+    """
+    单个请求的输出通道：调度线程写入文本片段，接口层读取。
+    - 绑定了事件循环 (bind_loop) 时，通过 loop.call_soon_threadsafe 投递到 asyncio.Queue，
+      SSE 生成器用 async for 等待，不会阻塞 uvicorn 的事件循环
+    - 未绑定时退化为线程安全的 Queue，可以像 TextIteratorStreamer 一样 for 循环读取 (压测脚本使用)
+    """
+
+    def __init__(self):
+        self.text_queue = Queue()
+        self.stop_signal = None
+        self.loop = None
+        self.async_queue = None
+
+    def bind_loop(self, loop):
+        # 必须在提交给调度器之前调用，保证所有输出都走 asyncio 通道
+        self.loop = loop
+        self.async_queue = asyncio.Queue()
+
+    def _push(self, value):
+        if self.loop is None:
+            self.text_queue.put(value)
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.async_queue.put_nowait, value)
+        except RuntimeError:
+            # 事件循环已关闭 (服务正在退出)，丢弃即可
+            pass
+
+    def put(self, text):
+        self._push(text)
+
+    def end(self):
+        self._push(self.stop_signal)
+
+    def fail(self, error):
+        # 把异常交给消费端抛出，避免请求一直挂起
+        self._push(error)
+
+    def _unwrap(self, value, stop_exception):
+        if value is self.stop_signal:
+            raise stop_exception()
+        if isinstance(value, BaseException):
+            raise value
+        return value
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._unwrap(self.text_queue.get(), StopIteration)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return self._unwrap(await self.async_queue.get(), StopAsyncIteration)
+
+
+# ================= 请求与序列 =================
+class GenerationRequest:
+    """一次生成任务：prompt token + 采样参数"""
+
+    def __init__(self, input_ids, max_new_tokens=512, temperature=0.85, top_p=0.95, top_k=50,
+                 repetition_penalty=1.1, eos_token_ids=None, prefix=None, conversation_id=None,
+                 stopping_criteria=None, adapter=None, cache_tag=None, seed=None, speculative=False, role=None,
+                 trace=None, priority=INTERACTIVE, tenant=None):
+        self.input_ids = list(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.repetition_penalty = repetition_penalty
+        # None 表示使用模型默认的结束符；传入空列表则一直生成到 max_new_tokens (压测用)
+        self.eos_token_ids = eos_token_ids
+        # 可选的预计算前缀 (CachedPrefix)，命中时只 prefill 前缀之后的部分
+        self.prefix = prefix
+        # 非空时，生成结束后把这一轮的 KV Cache 存入 conversation_cache 供下一轮复用
+        self.conversation_id = conversation_id
+        # 额外的停止条件 (StoppingCriteria 接口)，例如客户端断开
+        self.stopping_criteria = list(stopping_criteria or [])
+        # 使用的 LoRA 适配器名 (None 表示模型当前激活的适配器)；不同适配器的请求可以在同一批次里解码
+        self.adapter = adapter
+        # 写入 conversation_cache 时附带的适配器版本标记，下一轮换了适配器就不会误用旧缓存
+        self.cache_tag = cache_tag
+        # 采样随机种子：同一个 seed + 相同输入得到相同的回复 (每条序列独立的随机数生成器，不受同批次其他请求影响)
+        self.seed = seed
+        # 是否允许投机解码 (需要加载草稿模型，且只在批次中只有这一条序列时生效)
+        self.speculative = speculative
+        # 角色名，只用作监控指标的标签
+        self.role = role
+        # 分阶段追踪 (RequestTrace)：调度器记录排队 / prefill / decode 各阶段的时间
+        self.trace = trace or NULL_TRACE
+        # 优先级 (interactive / bulk) 与公平调度用的租户 (为空时按角色轮流)
+        self.priority = priority
+        self.tenant = tenant
+        # 是否被按需剖析选中 (request_profiler.claim)
+        self.profiled = False
+        self.num_generated = 0
+        # 投机解码统计：草稿模型一共猜了多少个 token，其中多少个被大模型接受
+        self.num_drafted = 0
+        self.num_accepted = 0
+        # 共享同一次 prefill 的其他请求 (n 个候选回复)：prompt 只 prefill 一次，KV Cache 复制成 n 行各自采样
+        self.forks = []
+        self.stream = TokenStream()
+        # 各阶段的时间点 (time.perf_counter)，由 serving_metrics 记录
+        self.submitted_at = None
+        self.started_at = None
+        self.prefilled_at = None
+        self.first_token_at = None
+        self.last_token_at = None
+        self.finished_at = None
+
+    @property
+    def group_size(self):
+        return 1 + len(self.forks)
+
+    def fork(self, seed=None):
+        """创建一个共享 prompt 的兄弟请求，参数与本请求相同，只有随机种子不同"""
+        sibling = GenerationRequest(
+            self.input_ids, max_new_tokens=self.max_new_tokens, temperature=self.temperature, top_p=self.top_p,
+            top_k=self.top_k, repetition_penalty=self.repetition_penalty, eos_token_ids=self.eos_token_ids,
+            prefix=self.prefix, stopping_criteria=self.stopping_criteria, adapter=self.adapter,
+            cache_tag=self.cache_tag, seed=seed, speculative=self.speculative, role=self.role,
+            priority=self.priority, tenant=self.tenant,
+        )
+        self.forks.append(sibling)
+        return sibling
+
+
+class _Sequence:
+    """调度器内部维护的一条正在解码的序列"""
+
+    def __init__(self, request, tokenizer, default_eos_ids, device):
+        self.request = request
+        self.tokenizer = tokenizer
+        self.eos_ids = set(default_eos_ids if request.eos_token_ids is None else request.eos_token_ids)
+        # 出现过的 token (prompt + 已生成)，用于重复惩罚：是否出现过用集合判断 (不在设备上比较、不用同步)，
+        # 张量放在按最大长度预先分配的缓冲区里，新 token 写到末尾，seen_ids 是前 len(seen) 个元素的视图
+        unique = torch.unique(torch.tensor(request.input_ids, device=device))
+        self.seen = set(request.input_ids)
+        self.seen_buffer = unique.new_empty(len(unique) + request.max_new_tokens)
+        self.seen_buffer[:len(unique)] = unique
+        self.seen_ids = self.seen_buffer[:len(unique)]
+        # 停止条件的输入 (prompt + 已生成)：同样预先分配，每个 token 只写一个位置，不用每步重建整段
+        self.all_ids = torch.empty((1, len(request.input_ids) + request.max_new_tokens), dtype=torch.long)
+        self.all_ids[0, :len(request.input_ids)] = torch.tensor(request.input_ids, dtype=torch.long)
+        self.generated = []
+        # 已采样但还没送入模型的 token，下一个 decode step 再喂进去
+        self.next_token = None
+        # next_token 的位置编号 (= 当前缓存中真实 token 的数量)
+        self.position = len(request.input_ids)
+        # 增量解码状态，与 TextStreamer 的 token_cache / print_len 一致
+        self.token_cache = []
+        self.print_len = 0
+        self.generator = None
+        if request.seed is not None:
+            self.generator = torch.Generator(device=device).manual_seed(request.seed)
+
+        # 草稿模型的 KV Cache 及其覆盖的 token 数 (input_ids + generated 的前 draft_len 个)
+        self.draft_past = None
+        self.draft_len = 0
+
+        # 被交互请求暂停 (bulk) 时移出批次的 KV Cache，以及暂停的时间点
+        self.paused_kv = None
+        self.paused_at = None
+
+    def sample(self, logits):
+        return sample_token(logits, self.seen_ids, self.request, self.generator)
+
+    def verify(self, logits, draft_token):
+        if draft_token is None:
+            return self.sample(logits), False
+        return verify_draft_token(logits, self.seen_ids, self.request, draft_token, self.generator)
+
+    def should_stop(self):
+        """检查请求上挂的额外停止条件"""
+        criteria = self.request.stopping_criteria
+        if not criteria:
+            return False
+        input_ids = self.all_ids[:, :len(self.request.input_ids) + len(self.generated)]
+        return any(bool(torch.as_tensor(criterion(input_ids, None)).any()) for criterion in criteria)
+
+    def push_token(self, token_id):
+        """记录新 token，返回该序列是否已结束"""
+        if token_id in self.eos_ids:
+            return True
+
+        self.all_ids[0, len(self.request.input_ids) + len(self.generated)] = token_id
+        self.generated.append(token_id)
+        self.request.num_generated = len(self.generated)
+        self.next_token = token_id
+        if token_id not in self.seen:
+            self.seen.add(token_id)
+            self.seen_buffer[len(self.seen) - 1] = token_id
+            self.seen_ids = self.seen_buffer[:len(self.seen)]
+        serving_metrics.token_generated(self.request)
+        start = time.perf_counter()
+        self._emit(token_id)
+        self.request.trace.add_time("detokenize", time.perf_counter() - start)
+        return len(self.generated) >= self.request.max_new_tokens or self.should_stop()
+
+    def _emit(self, token_id):
+        self.token_cache.append(token_id)
+        text = self.tokenizer.decode(self.token_cache, skip_special_tokens=True)
+        if text.endswith("\n"):
+            printable = text[self.print_len:]
+            self.token_cache = []
+            self.print_len = 0
+        elif text.endswith("\ufffd"):
+            # 多字节字符还没解码完整，等下一个 token
+            return
+        else:
+            printable = text[self.print_len:]
+            self.print_len = len(text)
+        if printable:
+            self.request.stream.put(printable)
+
+    def finish(self):
+        if self.token_cache:
+            text = self.tokenizer.decode(self.token_cache, skip_special_tokens=True)
+            if text[self.print_len:]:
+                self.request.stream.put(text[self.print_len:])
+        self._trace_phases()
+        self.request.stream.end()
+        _request_finished(self.request)
+
+    def fail(self, error):
+        self._trace_phases()
+        self.request.stream.fail(error)
+        _request_finished(self.request)
+
+    def _trace_phases(self):
+        # 在通知接口层之前写入，接口层收到结束信号时追踪记录已经完整
+        request = self.request
+        request.trace.add_span("queue", request.submitted_at, request.started_at)
+        request.trace.add_span("prefill", request.started_at, request.prefilled_at)
+        request.trace.add_span("decode", request.prefilled_at, time.perf_counter())
+        request.trace.set(prompt_tokens=len(request.input_ids), completion_tokens=request.num_generated)
+
+
+def _request_finished(request):
+    serving_metrics.request_finished(request)
+    request_profiler.request_finished(request)
+
+
+# ================= 采样 =================
+def adjusted_logits(logits, seen_ids, request):
+    """对单条序列的 logits 做重复惩罚 + temperature/top-k/top-p 处理 (temperature <= 0 时只做重复惩罚)"""
+    # 始终拷贝一份：同一组 logits 可能要给多条序列各自采样 (n>1)，不能原地修改
+    logits = logits.to(torch.float32, copy=True)
+
+    if request.repetition_penalty != 1.0:
+        score = logits[seen_ids]
+        score = torch.where(score < 0, score * request.repetition_penalty, score / request.repetition_penalty)
+        logits[seen_ids] = score
+
+    if request.temperature <= 0:
+        return logits
+
+    logits = logits / request.temperature
+
+    if request.top_k and request.top_k > 0:
+        kth_value = torch.topk(logits, min(request.top_k, logits.shape[-1])).values[-1]
+        logits = logits.masked_fill(logits < kth_value, float("-inf"))
+
+    if request.top_p < 1.0:
+        sorted_logits, sorted_idx = torch.sort(logits, descending=True)
+        sorted_probs = torch.softmax(sorted_logits, dim=-1)
+        # 累计概率超过 top_p 之后的 token 全部屏蔽 (至少保留概率最高的一个)
+        remove = (torch.cumsum(sorted_probs, dim=-1) - sorted_probs) > request.top_p
+        sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+        logits = torch.full_like(logits, float("-inf")).scatter(0, sorted_idx, sorted_logits)
+
+    return logits
+
+
+def sample_token(logits, seen_ids, request, generator=None):
+    """对单条序列的 logits 做重复惩罚 + temperature/top-k/top-p 采样"""
+    logits = adjusted_logits(logits, seen_ids, request)
+    if request.temperature <= 0:
+        return int(torch.argmax(logits).item())
+
+    probs = torch.softmax(logits, dim=-1)
+    return int(torch.multinomial(probs, num_samples=1, generator=generator).item())
+
+
+def verify_draft_token(logits, seen_ids, request, draft_token, generator=None):
+    """
+    投机采样的验证规则。草稿模型按贪心出词 (草稿分布 q 是 one-hot)，
+    因此以 p(draft_token) 的概率接受；拒绝时从去掉 draft_token 后重新归一化的 p 中采样。
+    这样得到的 token 与直接从 p 采样同分布，投机解码不改变生成质量。返回 (token, 是否接受)
+    """
+    logits = adjusted_logits(logits, seen_ids, request)
+    if request.temperature <= 0:
+        token = int(torch.argmax(logits).item())
+        return token, token == draft_token
+
+    probs = torch.softmax(logits, dim=-1)
+    if torch.rand((), generator=generator, device=probs.device) < probs[draft_token]:
+        return draft_token, True
+    probs[draft_token] = 0
+    return int(torch.multinomial(probs, num_samples=1, generator=generator).item()), False
+
+
+def _logits_to_keep_kwargs(model):
+    """prefill 时只计算最后一个位置的 logits，避免 [seq_len, vocab] 的大张量"""
+    base = model.get_base_model() if hasattr(model, "get_base_model") else model
+    params = inspect.signature(base.forward).parameters
+    for name in ("logits_to_keep", "num_logits_to_keep"):
+        if name in params:
+            return {name: 1}
+    return {}
+
+
+def _pad_mask_left(mask, target_len):
+    if mask.shape[1] >= target_len:
+        return mask
+    pad = torch.zeros((mask.shape[0], target_len - mask.shape[1]), dtype=mask.dtype, device=mask.device)
+    return torch.cat([pad, mask], dim=1)
+
+
+# 批次为空时等待新请求的轮询间隔 (秒)，期间可以处理 run_exclusive 提交的管理任务
+IDLE_POLL_SECONDS = 0.05
+
+
+class QueueFullError(Exception):
+    """等待队列已满，调用方应返回 503 并提示稍后重试"""
+    pass
+
+
+class AdapterInUseError(Exception):
+    """适配器正被批次中 (或暂停) 的序列使用，不能替换或卸载，调用方应返回 409"""
+    pass
+
+
+# ================= 连续批处理调度器 =================
+class GenerationScheduler:
+    """
+    连续批处理 (Continuous Batching) 调度器：
+    单独一个线程独占模型，每个 decode step 之前把排队的新请求 prefill 后并入正在运行的批次，
+    已结束的序列立即移出批次，生成的文本通过各自的 TokenStream 推送给 SSE 接口。
+    批次内各序列长度不同，统一采用左侧 padding + attention_mask 对齐。
+    """
+
+    def __init__(self):
+        self.tokenizer = None
+        self.model = None
+        self.device = None
+        self.max_batch_size = 8
+        self.max_queue_depth = 0
+        self.pending = FairQueue()
+        self.paused = deque()  # 被暂停的 bulk 序列 (_Sequence)，先暂停的先恢复
+        self.preempt_bulk = True
+        self.bulk_max_active = 0
+        self.preemptions = 0
+        self.memory = MemoryBudget()  # 批次 KV Cache 的内存预算
+        self.control = Queue()  # run_exclusive 提交的管理任务 (加载/卸载适配器等)
+        self.active = []  # 正在解码的 _Sequence，顺序与缓存的 batch 维一一对应
+        self.past = None  # 整个批次共享的 KV Cache
+        self.attention_mask = None  # [batch, cache_len + 1]，padding 位置为 0
+        self.default_eos_ids = []
+        self.logits_kwargs = {}
+        self.thread = None
+        self.draft_model = None
+        self.speculative_tokens = 4
+        self.draft_logits_kwargs = {}
+        # 投机解码累计统计
+        self.spec_steps = 0
+        self.spec_drafted = 0
+        self.spec_accepted = 0
+
+    def start(self, tokenizer, model, device, max_batch_size=8, max_queue_depth=0, draft_model=None,
+              speculative_tokens=4, preempt_bulk=True, bulk_max_active=0, kv_budget_mb=-1, adapter_tag=None):
+        if self.thread is not None:
+            return
+        self.tokenizer = tokenizer
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        # 等待队列上限 (0 表示不限制，interactive / bulk 各自计算)，超出时 submit 直接拒绝，避免突发流量把请求无限堆积
+        self.max_queue_depth = max_queue_depth
+        self.pending = FairQueue(max_depth=max_queue_depth)
+        self.preempt_bulk = preempt_bulk
+        self.bulk_max_active = bulk_max_active
+        # 在模型加载之后计算，自动预算只算剩余的显存 / 内存
+        self.memory.configure(model, device, kv_budget_mb)
+        self.default_eos_ids = self._collect_eos_ids()
+        self.logits_kwargs = _logits_to_keep_kwargs(model)
+        self.draft_model = draft_model
+        self.speculative_tokens = speculative_tokens
+        if draft_model is not None:
+            self.draft_logits_kwargs = _logits_to_keep_kwargs(draft_model)
+        # 适配器名 -> 当前加载的版本标记 (model_service.adapter_tag)，准入时用来识别排队期间被替换的适配器
+        self.adapter_tag = adapter_tag
+
+        self.thread = Thread(target=self._loop, name="generation-scheduler", daemon=True)
+        self.thread.start()
+        budget = f", KV 预算 {self.memory.budget / 1024 ** 2:.0f} MB" if self.memory.enabled else ""
+        print(f"✅ 生成调度器已启动 (max_batch_size={max_batch_size}{budget})")
+
+    def submit(self, request, loop=None):
+        """提交请求；在 async 接口中调用时传入当前事件循环，输出走 asyncio 通道"""
+        if request.group_size > self.max_batch_size:
+            raise ValueError(f"候选数不能超过 {self.max_batch_size}")
+        if request.priority not in PRIORITIES:
+            raise ValueError(f"priority 只能是 {PRIORITIES} 之一")
+        members = [request] + request.forks
+        for member in members:
+            if loop is not None:
+                member.stream.bind_loop(loop)
+            serving_metrics.request_queued(member)
+        try:
+            self.pending.put_nowait(request)
+        except Full:
+            for member in members:
+                serving_metrics.request_rejected(member)
+                # 在接口层的线程里：只归还剖析名额，profiler 的启停留在调度线程
+                request_profiler.release(member)
+            raise QueueFullError(f"{request.priority} 等待队列已满 ({self.max_queue_depth})")
+        return request.stream
+
+    def run_exclusive(self, fn):
+        """
+        在调度线程的两个 decode step 之间执行 fn (此时没有 forward 在跑)，返回 concurrent.futures.Future。
+        用于热加载/卸载适配器这类会修改模型结构的操作；调度器未启动时直接执行
+        """
+        future = Future()
+        if self.thread is None:
+            self._run_task(fn, future)
+        else:
+            self.control.put((fn, future))
+        return future
+
+    def adapters_in_use(self):
+        return {seq.request.adapter for seq in self.active + list(self.paused)}
+
+    def ensure_adapter_idle(self, name):
+        """
+        替换 / 卸载适配器前检查 (须在调度线程里调用，即 run_exclusive 内)：
+        正在解码或暂停的序列用到它时，换掉权重会让这些序列后半段用另一套权重生成
+        """
+        if name in self.adapters_in_use():
+            raise AdapterInUseError(f"适配器 {name} 正在使用中，请稍后重试")
+
+    def queue_status(self):
+        return {
+            "queued": self.pending.qsize(),
+            "active": len(self.active),
+            "paused": len(self.paused),
+            "preemptions": self.preemptions,
+            "priorities": self.pending.status(),
+            "max_batch_size": self.max_batch_size,
+            "max_queue_depth": self.max_queue_depth,
+            "memory": self.memory.status(*self._batch_shape()),
+            "speculative": self.speculative_status(),
+        }
+
+    def speculative_status(self):
+        return {
+            "enabled": self.draft_model is not None,
+            "draft_tokens": self.speculative_tokens,
+            "steps": self.spec_steps,
+            "drafted": self.spec_drafted,
+            "accepted": self.spec_accepted,
+            "acceptance_rate": self.spec_accepted / self.spec_drafted if self.spec_drafted else 0.0,
+            # 每次大模型 forward 平均产出的 token 数 (不投机时为 1)
+            "tokens_per_step": (self.spec_accepted + self.spec_steps) / self.spec_steps if self.spec_steps else 0.0,
+        }
+
+    def _collect_eos_ids(self):
+        eos_ids = {self.tokenizer.eos_token_id}
+        generation_config = getattr(self.model, "generation_config", None)
+        config_eos = getattr(generation_config, "eos_token_id", None)
+        if isinstance(config_eos, int):
+            eos_ids.add(config_eos)
+        elif config_eos:
+            eos_ids.update(config_eos)
+        eos_ids.discard(None)
+        return sorted(eos_ids)
+
+    # ---------- 主循环 ----------
+    def _loop(self):
+        while True:
+            try:
+                self._run_control()
+                # 批次为空时阻塞等待新请求，否则只做非阻塞的准入检查
+                self._admit_pending(block=not self.active)
+                if self.active:
+                    with request_profiler.region("decode_step"):
+                        self._decode_step()
+                    self.memory.record_step()
+            except Exception as e:
+                if is_out_of_memory(e) and len(self.active) > 1:
+                    # 内存不够时把批次拆成两半，暂停的一半等内存空出来再从断点继续，不让请求失败
+                    self._split_batch(e)
+                    continue
+                # 出错时终止当前批次的所有请求，调度线程本身继续服务后续请求
+                print(f"❌ 调度器异常: {e}")
+                for seq in self.active:
+                    seq.fail(e)
+                self._reset_batch()
+
+    def _run_control(self):
+        while True:
+            try:
+                fn, future = self.control.get_nowait()
+            except Empty:
+                return
+            self._run_task(fn, future)
+
+    @staticmethod
+    def _run_task(fn, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn())
+        except Exception as e:
+            future.set_exception(e)
+
+    def _bulk_slots(self):
+        """bulk 序列还能占用的名额"""
+        free = self.max_batch_size - len(self.active)
+        if self.bulk_max_active:
+            bulk_active = sum(seq.request.priority == BULK for seq in self.active)
+            free = min(free, self.bulk_max_active - bulk_active)
+        return free
+
+    def _batch_shape(self):
+        """当前批次的缓存长度，以及每行最多还要生成多少个 token (用于预估 KV Cache 峰值)"""
+        width = self.attention_mask.shape[1] if self.active else 0
+        return width, [seq.request.max_new_tokens - len(seq.generated) for seq in self.active]
+
+    def _fits_memory(self, num_tokens, max_new_tokens, rows=1):
+        """再加入 rows 条长度为 num_tokens 的序列后，批次的 KV Cache 峰值是否仍在预算内 (批次为空时总是放行)"""
+        if not self.active:
+            return True
+        width, remaining = self._batch_shape()
+        return self.memory.fits(max(width, num_tokens), remaining + [max_new_tokens] * rows)
+
+    def _resume_paused(self):
+        """
+        恢复一条暂停的序列，返回是否恢复了。OOM 拆分出来的交互序列先于新请求恢复；
+        bulk 序列只在没有交互请求等待时恢复 (仍然先于新的 bulk 请求)
+        """
+        interactive_waiting = self.pending.has_waiting(INTERACTIVE)
+        for seq in self.paused:
+            if seq.request.priority == BULK and (interactive_waiting or self._bulk_slots() <= 0):
+                continue
+            if not self._fits_memory(seq.position, seq.request.max_new_tokens - len(seq.generated)):
+                return False
+            self.paused.remove(seq)
+            self._resume(seq)
+            return True
+        return False
+
+    def _admit_pending(self, block):
+        while True:
+            free = self.max_batch_size - len(self.active)
+            if free > 0 and self.paused and self._resume_paused():
+                continue
+            if free <= 0 and not self.pending.has_waiting(INTERACTIVE):
+                break
+            priorities = PRIORITIES if self._bulk_slots() > 0 else (INTERACTIVE,)
+            try:
+                # 空闲时按固定间隔醒来，保证管理任务不会一直等不到执行
+                request = self.pending.get(block=block and not self.active, timeout=IDLE_POLL_SECONDS,
+                                           priorities=priorities)
+            except Empty:
+                break
+            block = False
+            if request.priority == INTERACTIVE and request.group_size > free and self.preempt_bulk:
+                # 批次已满：暂停 bulk 序列给交互请求腾出名额
+                self._preempt(request.group_size - free)
+                free = self.max_batch_size - len(self.active)
+            if self.active and request.group_size > (free if request.priority == INTERACTIVE else self._bulk_slots()):
+                # n 个候选要一起 prefill、一起入批，剩余名额不够时放回队首，等已有序列结束
+                self.pending.requeue_front(request)
+                break
+            fits = self._fits_memory(len(request.input_ids), request.max_new_tokens, request.group_size)
+            while not fits and request.priority == INTERACTIVE and self.preempt_bulk and self._preempt(1):
+                # KV Cache 预算不够：交互请求继续暂停 bulk 序列，直到放得下
+                fits = self._fits_memory(len(request.input_ids), request.max_new_tokens, request.group_size)
+            if not fits:
+                self.pending.requeue_front(request)
+                break
+            try:
+                self._prefill(request)
+            except Exception as e:
+                print(f"❌ Prefill 失败: {e}")
+                for member in [request] + request.forks:
+                    member.stream.fail(e)
+                    _request_finished(member)
+
+    def _preempt(self, needed):
+        """把最近加入批次的 bulk 序列暂停，腾出最多 needed 个名额，返回暂停了几条"""
+        rows = [row for row in reversed(range(len(self.active)))
+                if self.active[row].request.priority == BULK][:needed]
+        if rows:
+            self.preemptions += len(rows)
+            self._pause_rows(rows)
+        return len(rows)
+
+    def _pause_rows(self, rows):
+        """把若干行移出批次，KV Cache 暂存到 CPU，之后由 _resume 从断点继续"""
+        kv = cache_to_tensors(self.past)
+        now = time.perf_counter()
+        for row in rows:
+            seq = self.active[row]
+            num_tokens = seq.position  # 该行缓存中真实 token 的数量 (右对齐，左侧是 padding)
+            seq.paused_kv = [
+                (k[row:row + 1, :, -num_tokens:].to("cpu", copy=True),
+                 v[row:row + 1, :, -num_tokens:].to("cpu", copy=True))
+                for k, v in kv
+            ]
+            seq.paused_at = now
+            self.paused.append(seq)
+        self._remove_rows(rows)
+
+    def _split_batch(self, error):
+        """
+        OOM 恢复：丢掉出错那一步写了一半的 KV，把后加入的一半序列暂停 (KV Cache 移到 CPU)，剩下的一半重试；
+        上限临时降到出错时的实际用量 (之后逐步放开)，暂停的序列等内存空出来再恢复
+        """
+        width = self.attention_mask.shape[1]
+        kv = crop(cache_to_tensors(self.past), width)
+        self.past = tensors_to_cache(kv)
+        self.memory.record_oom(kv_nbytes(kv))
+        rows = list(range(len(self.active) // 2, len(self.active)))
+        print(f"⚠️ 内存不足 ({error})，批次拆分: {len(self.active)} -> {len(self.active) - len(rows)} 条，"
+              f"KV 上限临时降为 {self.memory.budget / 1024 ** 2:.1f} MB")
+        self._pause_rows(rows)
+        release_cached_memory(self.device)
+
+    def _resume(self, seq):
+        """被暂停的序列带着原来的 KV Cache 重新并入批次，从断点继续解码"""
+        kv, seq.paused_kv = seq.paused_kv, None
+        seq.request.trace.add_span("paused", seq.paused_at, time.perf_counter())
+        if seq.should_stop():
+            # 暂停期间客户端已经断开 / 取消
+            seq.finish()
+            return
+        if self._adapter_missing(seq.request.adapter):
+            seq.fail(ValueError(f"适配器不存在: {seq.request.adapter}"))
+            return
+        self._join_batch(seq, [(k.to(self.device), v.to(self.device)) for k, v in kv])
+
+    def _refresh_adapter_tag(self, request):
+        """
+        排队期间适配器被替换 (卸载后同名重新加载)：前缀 KV 是用旧权重算的，不能接在新权重后面继续 prefill，
+        丢掉前缀改为完整 prefill；之后写回会话缓存的 KV 也标记为新版本
+        """
+        if self.adapter_tag is None or request.adapter is None:
+            return
+        current = self.adapter_tag(request.adapter)
+        if request.prefix is not None and request.prefix.adapter != current:
+            request.prefix = None
+        for member in [request] + request.forks:
+            member.cache_tag = current
+
+    def _adapter_missing(self, adapter):
+        # 合并权重的模型没有 peft_config，不做检查
+        peft_config = getattr(self.model, "peft_config", None)
+        return adapter is not None and peft_config is not None and adapter not in peft_config
+
+    @torch.no_grad()
+    def _prefill(self, request):
+        seqs = []
+        for member in [request] + request.forks:
+            serving_metrics.request_started(member)
+            request_profiler.request_started(member)
+            seq = _Sequence(member, self.tokenizer, self.default_eos_ids, self.device)
+            if seq.should_stop():
+                # 排队期间客户端已经断开，直接丢弃
+                seq.finish()
+            else:
+                seqs.append(seq)
+        if not seqs:
+            return
+        if self._adapter_missing(request.adapter):
+            # 排队期间适配器被卸载了
+            raise ValueError(f"适配器不存在: {request.adapter}")
+        self._refresh_adapter_tag(request)
+
+        with request_profiler.region("prefill"):
+            outputs = self._prefill_with_retry(request)
+        prefilled_at = time.perf_counter()
+        for seq in seqs:
+            seq.request.prefilled_at = prefilled_at
+
+        # n 个候选共享这一次 prefill：同一份 logits 各自采样第一个 token，KV Cache 复制成 n 行并入批次
+        logits = outputs.logits[0, -1, :]
+        kv = cache_to_tensors(outputs.past_key_values)
+        for seq in seqs:
+            if seq.push_token(seq.sample(logits)):
+                seq.finish()
+            else:
+                self._join_batch(seq, kv)
+
+    def _prefill_with_retry(self, request):
+        """prefill 时 OOM：拆分正在解码的批次腾出内存后重试，批次已经空了仍然 OOM 才失败"""
+        while True:
+            try:
+                return self._prefill_forward(request)
+            except Exception as e:
+                if not is_out_of_memory(e) or not self.active:
+                    raise
+                self._split_batch(e)
+
+    def _prefill_forward(self, request):
+        adapter_kwargs = self._adapter_kwargs([request])
+        prefix = request.prefix
+        if prefix is not None and prefix.matches(request.input_ids):
+            # 从前缀 (角色 System Prompt / 上一轮对话) 的 KV Cache 继续，只 prefill 剩余部分
+            request.trace.set(cached_tokens=len(prefix))
+            input_ids = torch.tensor([request.input_ids[len(prefix):]], dtype=torch.long, device=self.device)
+            position_ids = torch.arange(len(prefix), len(request.input_ids), device=self.device).unsqueeze(0)
+            outputs = self.model(
+                input_ids=input_ids,
+                position_ids=position_ids,
+                past_key_values=tensors_to_cache(prefix.kv),
+                use_cache=True,
+                **self.logits_kwargs,
+                **adapter_kwargs
+            )
+        else:
+            input_ids = torch.tensor([request.input_ids], dtype=torch.long, device=self.device)
+            outputs = self.model(input_ids=input_ids, use_cache=True, **self.logits_kwargs, **adapter_kwargs)
+        return outputs
+
+    def _adapter_kwargs(self, requests):
+        """加载了多个适配器时，按行告诉 PEFT 每条序列用哪个适配器 (混合批次)"""
+        peft_config = getattr(self.model, "peft_config", None)
+        if not peft_config or len(peft_config) <= 1:
+            return {}
+        default = self.model.active_adapter
+        return {"adapter_names": [request.adapter or default for request in requests]}
+
+    def _join_batch(self, seq, kv):
+        mask = torch.ones((1, kv_seq_len(kv)), dtype=torch.long, device=self.device)
+        if not self.active:
+            self.active = [seq]
+            self.past = tensors_to_cache(kv)
+            self.attention_mask = mask
+            return
+
+        batch_kv = cache_to_tensors(self.past)
+        target_len = max(kv_seq_len(batch_kv), kv_seq_len(kv))
+        batch_kv = pad_left(batch_kv, target_len)
+        kv = pad_left(kv, target_len)
+        self.past = tensors_to_cache(concat_batch(batch_kv, kv))
+        self.attention_mask = torch.cat(
+            [_pad_mask_left(self.attention_mask, target_len), _pad_mask_left(mask, target_len)], dim=0
+        )
+        self.active.append(seq)
+
+    @torch.no_grad()
+    def _decode_step(self):
+        if len(self.active) == 1 and self._can_speculate(self.active[0]):
+            self._speculative_step(self.active[0])
+            return
+
+        batch_size = len(self.active)
+        input_ids = torch.tensor([[seq.next_token] for seq in self.active], dtype=torch.long, device=self.device)
+        position_ids = torch.tensor([[seq.position] for seq in self.active], dtype=torch.long, device=self.device)
+        # forward 成功后才更新 self.attention_mask，OOM 时批次状态保持不变，拆分后可以直接重试
+        attention_mask = torch.cat([self.attention_mask, self.attention_mask.new_ones((batch_size, 1))], dim=1)
+
+        start = time.perf_counter()
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.past,
+            use_cache=True,
+            **self._adapter_kwargs([seq.request for seq in self.active])
+        )
+        forward_seconds = time.perf_counter() - start
+        for seq in self.active:
+            # 批次内的序列共同等待这一次 forward，每条都记上完整耗时
+            seq.request.trace.add_time("decode_forward", forward_seconds)
+        past = outputs.past_key_values
+        self.past = tensors_to_cache(past) if isinstance(past, (tuple, list)) else past
+        self.attention_mask = attention_mask
+
+        logits = outputs.logits[:, -1, :]
+        finished_rows = []
+        for row, seq in enumerate(self.active):
+            seq.position += 1
+            if seq.push_token(seq.sample(logits[row])):
+                finished_rows.append(row)
+
+        if finished_rows:
+            self._retire(finished_rows)
+
+    # ---------- 投机解码 ----------
+    def _can_speculate(self, seq):
+        # 批次里有多条序列时，一次 forward 已经同时推进了所有序列，投机反而会拖慢整体吞吐；
+        # 只剩一条序列 (低负载) 时，每个 token 的延迟才是瓶颈。
+        # 带 seed 的采样请求不投机：验证时多消耗一次随机数，同一个 seed 的输出会随服务负载 (是否投机) 变化，
+        # 破坏可复现性 (回复缓存依赖它)；贪心解码的验证不用随机数，不受影响
+        request = seq.request
+        if request.seed is not None and request.temperature > 0:
+            return False
+        return (self.draft_model is not None and request.speculative
+                and request.max_new_tokens - len(seq.generated) > 1)
+
+    def _draft(self, seq, num_tokens):
+        """草稿模型贪心地往后猜 num_tokens 个 token (先补上它还没看过的 token)"""
+        all_ids = seq.request.input_ids + seq.generated
+        feed = all_ids[seq.draft_len:]
+        past = seq.draft_past
+        tokens = []
+        for i in range(num_tokens):
+            input_ids = torch.tensor([feed], dtype=torch.long, device=self.device)
+            outputs = self.draft_model(input_ids=input_ids, past_key_values=past, use_cache=True,
+                                       **self.draft_logits_kwargs)
+            past = outputs.past_key_values
+            token = int(torch.argmax(outputs.logits[0, -1, :]).item())
+            tokens.append(token)
+            feed = [token]
+        # 最后一个草稿 token 没有喂给草稿模型
+        seq.draft_past = past
+        seq.draft_len = len(all_ids) + num_tokens - 1
+        return tokens
+
+    @torch.no_grad()
+    def _speculative_step(self, seq):
+        """草稿模型猜 k 个 token，大模型一次 forward 验证 k+1 个位置，一步最多产出 k+1 个 token"""
+        k = min(self.speculative_tokens, seq.request.max_new_tokens - len(seq.generated))
+        num_ids = len(seq.request.input_ids) + len(seq.generated)
+        start_time = time.perf_counter()
+        draft_tokens = self._draft(seq, k)
+        seq.request.trace.add_time("draft", time.perf_counter() - start_time)
+
+        start = seq.position
+        cache_len = self.attention_mask.shape[1]
+        input_ids = torch.tensor([[seq.next_token] + draft_tokens], dtype=torch.long, device=self.device)
+        position_ids = torch.arange(start, start + k + 1, device=self.device).unsqueeze(0)
+        attention_mask = torch.cat([self.attention_mask, self.attention_mask.new_ones((1, k + 1))], dim=1)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.past,
+            use_cache=True,
+            **self._adapter_kwargs([seq.request])
+        )
+        seq.request.trace.add_time("decode_forward", time.perf_counter() - start_time)
+        logits = outputs.logits[0]
+
+        # 逐个位置验证：第 j 个位置的 logits 决定第 j 个草稿 token 是否接受；
+        # 全部接受时，最后一个位置的 logits 再额外采样一个 token
+        accepted = 0
+        finished = False
+        for j in range(k + 1):
+            seq.position = start + j + 1
+            token, ok = seq.verify(logits[j], draft_tokens[j] if j < k else None)
+            accepted += ok
+            finished = seq.push_token(token)
+            if finished or not ok:
+                break
+
+        # 丢掉被拒绝位置的 KV，只保留实际喂进去并被采纳的 token
+        keep = cache_len + (seq.position - start)
+        self.past = tensors_to_cache(crop(cache_to_tensors(outputs.past_key_values), keep))
+        self.attention_mask = attention_mask[:, :keep]
+        valid_draft = min(seq.draft_len, num_ids + accepted)
+        if valid_draft < seq.draft_len:
+            seq.draft_past = tensors_to_cache(crop(cache_to_tensors(seq.draft_past), valid_draft))
+            seq.draft_len = valid_draft
+
+        seq.request.num_drafted += k
+        seq.request.num_accepted += accepted
+        self.spec_steps += 1
+        self.spec_drafted += k
+        self.spec_accepted += accepted
+        if finished:
+            self._retire([0])
+
+    def _retire(self, rows):
+        for row in rows:
+            self.active[row].finish()
+            if self.active[row].request.conversation_id is not None:
+                self._save_conversation(row)
+        self._remove_rows(rows)
+
+    def _remove_rows(self, rows):
+        """把若干行移出批次 (结束或被暂停)"""
+        finished = set(rows)
+        keep = [i for i in range(len(self.active)) if i not in finished]
+        if not keep:
+            self._reset_batch()
+            return
+
+        index = torch.tensor(keep, dtype=torch.long, device=self.device)
+        kv = select_batch(cache_to_tensors(self.past), keep)
+        mask = self.attention_mask.index_select(0, index)
+
+        # 长序列退出后，左侧可能出现整列都是 padding 的情况，顺手裁掉
+        offset = int(mask.any(dim=0).nonzero()[0].item())
+        self.past = tensors_to_cache(trim_left(kv, offset))
+        self.attention_mask = mask[:, offset:]
+        self.active = [self.active[i] for i in keep]
+
+    def _save_conversation(self, row):
+        """取出某一行的 KV Cache (去掉左侧 padding) 存入多轮对话缓存"""
+        seq = self.active[row]
+        num_tokens = seq.position  # 该行缓存中真实 token 的数量
+        token_ids = (seq.request.input_ids + seq.generated)[:num_tokens]
+        # clone 成独立的小张量，避免切片视图让整个批次的大缓存无法释放
+        kv = [
+            (k[row:row + 1, :, -num_tokens:].clone(), v[row:row + 1, :, -num_tokens:].clone())
+            for k, v in cache_to_tensors(self.past)
+        ]
+        conversation_cache.put(seq.request.conversation_id, token_ids, kv, adapter=seq.request.cache_tag)
+
+    def _reset_batch(self):
+        self.active = []
+        self.past = None
+        self.attention_mask = None
+
+
+# 全局单例
+generation_scheduler = GenerationScheduler()
@@ -0,0 +1,153 @@
+import json
+import re
+import zlib
+from threading import Lock
+
+import numpy as np
+
+from config import SEMANTIC_CACHE, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_CAPACITY
+from roles import role_of_system_prompt
+
+
+# ================= 文本向量 =================
+# 字符 n-gram 哈希向量 (hashing trick)：不依赖任何模型和网络，向量化一句话只需要几十微秒。
+# 用 crc32 而不是 Python 内置 hash，保证不同进程得到相同的向量
+
+EMBED_DIM = 2048
+NGRAM_SIZES = (1, 2, 3)
+
+# 只保留汉字、字母和数字，标点和语气符号不影响语义匹配
+_KEEP = re.compile(r"[\u4e00-\u9fff0-9a-zA-Z]+")
+
+
+def embed(text):
+    """返回 L2 归一化的 float32 向量，两句话向量的点积即余弦相似度"""
+    vector = np.zeros(EMBED_DIM, dtype=np.float32)
+    for span in _KEEP.findall(text.lower()):
+        for n in NGRAM_SIZES:
+            for i in range(len(span) - n + 1):
+                h = zlib.crc32(span[i:i + n].encode("utf-8"))
+                # 最高位决定符号，减小哈希冲突带来的偏差
+                vector[h % EMBED_DIM] += 1.0 if h & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+# ================= 单个角色的向量索引 =================
+class RoleIndex:
+    """
+    预分配 [capacity, dim] 的矩阵，查询时一次矩阵-向量乘算出与所有条目的相似度。
+    满了之后新条目覆盖最久没有命中的槽位
+    """
+
+    def __init__(self, capacity, dim=EMBED_DIM):
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.questions = [None] * capacity
+        self.replies = [None] * capacity
+        self.last_used = np.zeros(capacity, dtype=np.int64)
+        self.size = 0
+        self.clock = 0
+
+    def __len__(self):
+        return self.size
+
+    def _tick(self):
+        self.clock += 1
+        return self.clock
+
+    def insert(self, question, reply, vector=None):
+        if self.size < len(self.questions):
+            slot = self.size
+            self.size += 1
+        else:
+            slot = int(np.argmin(self.last_used))
+        self.vectors[slot] = embed(question) if vector is None else vector
+        self.questions[slot] = question
+        self.replies[slot] = reply
+        self.last_used[slot] = self._tick()
+
+    def search(self, vector):
+        """返回 (相似度, 槽位)，索引为空时返回 (0.0, -1)"""
+        if self.size == 0:
+            return 0.0, -1
+        scores = self.vectors[:self.size] @ vector
+        slot = int(np.argmax(scores))
+        return float(scores[slot]), slot
+
+    def touch(self, slot):
+        self.last_used[slot] = self._tick()
+
+
+# ================= 语义回复缓存 =================
+class SemanticCache:
+    """按角色分别建索引：同一句话对长辈和对女友的回复完全不同，不能跨角色命中"""
+
+    def __init__(self, threshold, capacity, enabled=True):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.capacity = capacity
+        self.indexes = {}  # role_name -> RoleIndex
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _index(self, role_name):
+        if role_name not in self.indexes:
+            self.indexes[role_name] = RoleIndex(self.capacity)
+        return self.indexes[role_name]
+
+    def insert(self, role_name, question, reply):
+        vector = embed(question)
+        with self.lock:
+            self._index(role_name).insert(question, reply, vector)
+
+    def lookup(self, role_name, question, threshold=None):
+        """命中返回 {"question", "reply", "score"}，否则返回 None"""
+        threshold = self.threshold if threshold is None else threshold
+        vector = embed(question)
+        with self.lock:
+            index = self.indexes.get(role_name)
+            score, slot = index.search(vector) if index is not None else (0.0, -1)
+            if slot < 0 or score < threshold:
+                self.misses += 1
+                return None
+            index.touch(slot)
+            self.hits += 1
+            return {"question": index.questions[slot], "reply": index.replies[slot], "score": score}
+
+    def load_dataset(self, path):
+        """从 OpenAI Chat 格式的数据集 (train_cleaned.json) 收录每段对话的开场问答"""
+        with open(path, "r", encoding="utf-8") as f:
+            samples = json.load(f)
+        count = 0
+        for role_name, question, reply in opening_turns(samples):
+            self.insert(role_name, question, reply)
+            count += 1
+        return count
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "threshold": self.threshold,
+                "entries": {role_name: len(index) for role_name, index in self.indexes.items()},
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def opening_turns(samples):
+    """遍历数据集中每段对话的 (角色, 第一句用户消息, 第一句回复)"""
+    for sample in samples:
+        messages = sample["messages"]
+        if len(messages) < 3 or messages[0]["role"] != "system":
+            continue
+        role_name = role_of_system_prompt(messages[0]["content"])
+        if role_name and messages[1]["role"] == "user" and messages[2]["role"] == "assistant":
+            yield role_name, messages[1]["content"], messages[2]["content"]
+
+
+# 全局单例
+semantic_cache = SemanticCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_CAPACITY, enabled=SEMANTIC_CACHE)
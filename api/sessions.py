@@ -0,0 +1,125 @@
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+
+from config import SESSION_MAX, SESSION_TTL, SESSION_BUSY_TIMEOUT, SESSION_HISTORY_LIMIT
+from conversation_store import conversation_store
+
+# ================= 服务端会话 =================
+# WebSocket 通道 (/ws/chat) 和带 session_id 的 /chat/completions 的会话状态保存在服务端：客户端每轮只发送新的消息，
+# 历史消息、角色、采样参数都按 session_id 记在这里；KV Cache 以 session_id 作为 conversation_id
+# 存在 conversation_cache 中，下一轮只 prefill 新增的消息。
+# 消息持久化在 conversation_store (SQLite)，这里只是最近活跃会话的内存副本：
+# 按 LRU 淘汰 (最多 SESSION_MAX 个)，超过 SESSION_TTL 秒没有活动的会话移出内存，下次用到时从数据库重新加载
+
+
+class ChatSession:
+    def __init__(self, session_id, role_name, settings=None):
+        self.session_id = session_id
+        self.role_name = role_name
+        # 采样参数：temperature / top_p / seed / pacing
+        self.settings = dict(settings or {})
+        # 最近 SESSION_HISTORY_LIMIT 条消息 (完整记录在数据库里)
+        self.messages = []
+        self.last_active = time.time()
+        # 同一个会话同一时间只能有一轮生成 (多个标签页共用一个会话时后来的请求会被拒绝)，记录开始占用的时间
+        self.busy_since = None
+
+    @property
+    def busy(self):
+        return self.busy_since is not None
+
+    @busy.setter
+    def busy(self, value):
+        self.busy_since = time.time() if value else None
+
+    def history(self):
+        return list(self.messages)
+
+    def append_messages(self, messages):
+        """只追加，不修改已有消息：先写数据库，再更新内存副本"""
+        messages = [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+        conversation_store.append(self.session_id, messages)
+        self.messages = (self.messages + messages)[-SESSION_HISTORY_LIMIT:]
+        self.last_active = time.time()
+
+    def append_turn(self, user_content, assistant_content):
+        """一轮结束后一起写入"""
+        self.append_messages([
+            {"role": "user", "content": user_content},
+            {"role": "assistant", "content": assistant_content},
+        ])
+
+    def clear(self):
+        conversation_store.reset(self.session_id)
+        self.messages = []
+        self.last_active = time.time()
+
+    def summary(self):
+        return {"session_id": self.session_id, "role": self.role_name, "messages": len(self.messages)}
+
+
+class SessionStore:
+    def __init__(self, max_sessions=SESSION_MAX, ttl=SESSION_TTL, busy_timeout=SESSION_BUSY_TIMEOUT):
+        self.lock = Lock()
+        self.sessions = OrderedDict()
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.busy_timeout = busy_timeout
+
+    def get(self, session_id):
+        """内存里没有 (或已过期) 时从数据库加载；数据库里也没有时返回 None"""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None and session.busy and time.time() - session.busy_since > self.busy_timeout:
+                # 占用超时：上一轮的收尾没有执行 (例如连接异常中断)，解除占用，避免会话永远 409
+                session.busy = False
+            if session is not None and time.time() - session.last_active > self.ttl and not session.busy:
+                del self.sessions[session_id]
+                session = None
+            if session is not None:
+                self.sessions.move_to_end(session_id)
+                return session
+
+        stored = conversation_store.get_session(session_id)
+        if stored is None:
+            return None
+        session = ChatSession(session_id, stored["role"])
+        session.messages = conversation_store.history(session_id, SESSION_HISTORY_LIMIT)
+        return self._remember(session, prefer_existing=True)
+
+    def create(self, role_name, session_id=None, messages=(), settings=None):
+        """
+        新建会话 (或把已有会话切换到另一个角色，旧历史不再参与生成)；
+        messages 是客户端带来的历史 (例如本地保存的对话)，会一起写入数据库
+        """
+        session = ChatSession(session_id or uuid.uuid4().hex, role_name, settings)
+        conversation_store.start_session(session.session_id, role_name)
+        if messages:
+            session.append_messages(messages)
+        return self._remember(session)
+
+    def _remember(self, session, prefer_existing=False):
+        with self.lock:
+            # 并发从数据库加载同一个会话时以先放进来的为准，保证 busy 标记只有一份
+            if prefer_existing and session.session_id in self.sessions:
+                session = self.sessions[session.session_id]
+            self.sessions[session.session_id] = session
+            self.sessions.move_to_end(session.session_id)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return session
+
+    def delete(self, session_id):
+        """只移出内存 (数据库里的记录保留)"""
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def stats(self):
+        with self.lock:
+            return {"sessions": len(self.sessions), "max_sessions": self.max_sessions, "ttl": self.ttl}
+
+
+# 全局单例
+session_store = SessionStore()
@@ -0,0 +1,90 @@
+import glob
+import json
+import mmap
+import os
+import struct
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+from transformers.initialization import no_init_weights
+
+# ================= 共享只读权重 (mmap) =================
+# transformers 的 from_pretrained 会把 safetensors 读进进程私有内存，N 个 worker 进程就有 N 份权重。
+# 这里直接按 safetensors 的文件布局把权重 mmap 成张量 (MAP_PRIVATE，写时复制)：
+# 推理只读不写，同一台机器上所有进程映射同一个文件，物理页由操作系统页缓存共享，只占一份内存。
+# 要求文件里的 dtype 与推理 dtype 一致 (合并权重缓存按 dtype 分别保存，正好满足)，否则转换时仍会复制
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def mmap_safetensors(path):
+    """返回 {name: tensor}，张量直接指向文件映射，不占用进程私有内存"""
+    with open(path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len))
+        # ACCESS_COPY (MAP_PRIVATE)：页面在进程间共享，只有被写入时才复制 (推理时不会发生)
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = 8 + header_len
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        count = (end - start) // torch.empty((), dtype=dtype).element_size()
+        if count == 0:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensor = torch.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + start)
+        tensors[name] = tensor.view(info["shape"])
+    return tensors
+
+
+def checkpoint_dtype(model_dir):
+    """checkpoint 中浮点权重的 dtype (读文件头，不加载权重)"""
+    for path in sorted(glob.glob(os.path.join(model_dir, "*.safetensors"))):
+        with open(path, "rb") as f:
+            header_len = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_len))
+        for name, info in header.items():
+            if name != "__metadata__" and SAFETENSORS_DTYPES[info["dtype"]].is_floating_point:
+                return SAFETENSORS_DTYPES[info["dtype"]]
+    return None
+
+
+def load_mmap_model(model_dir, dtype):
+    """
+    先按 config 构建不初始化权重的模型 (只分配虚拟内存，不写入不占物理页)，
+    再用 load_state_dict(assign=True) 把参数直接替换成文件映射的张量
+    """
+    state_dict = {}
+    for path in sorted(glob.glob(os.path.join(model_dir, "*.safetensors"))):
+        state_dict.update(mmap_safetensors(path))
+    if not state_dict:
+        raise ValueError(f"目录下没有 safetensors 权重: {model_dir}")
+
+    config = AutoConfig.from_pretrained(model_dir, trust_remote_code=True)
+    with no_init_weights():
+        model = AutoModelForCausalLM.from_config(config, dtype=dtype, trust_remote_code=True)
+    # 共享词表的模型 (tie_word_embeddings) 文件里没有 lm_head，加载后重新绑定
+    missing, unexpected = model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+    missing = [name for name in missing if not (config.tie_word_embeddings and name.startswith("lm_head."))]
+    if missing or unexpected:
+        raise ValueError(f"权重与模型结构不匹配: missing={missing[:5]}, unexpected={unexpected[:5]}")
+    if os.path.isfile(os.path.join(model_dir, "generation_config.json")):
+        # from_config 不会读取 generation_config.json (调度器要用其中的结束符)
+        model.generation_config = GenerationConfig.from_pretrained(model_dir)
+    return model.eval()
@@ -0,0 +1,99 @@
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+from metrics import Gauge
+
+# ================= 启动进度与冷启动耗时 =================
+# 模型在后台线程加载，服务进程一启动就开始监听：
+# - GET /healthz：进程存活就返回 200 (liveness)，附带当前阶段和已完成阶段的耗时
+# - GET /readyz：模型加载、调度器启动、各角色预热全部完成后才返回 200，之前返回 503 (readiness)，
+#   launcher / router / k8s 据此判断能否转发流量
+# 冷启动耗时 = 进程创建到就绪 (包括 import torch)，同时导出到 /metrics，扩容和滚动发布有多快由它决定
+
+
+def process_start_time():
+    """进程的创建时间 (Linux 从 /proc 读取，拿不到时退化为本模块的导入时间)"""
+    try:
+        with open("/proc/self/stat") as f:
+            # comm 字段可能带空格，从最后一个右括号之后开始数，starttime 是第 22 个字段
+            fields = f.read().rsplit(")", 1)[1].split()
+        start_ticks = int(fields[19])
+        with open("/proc/stat") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return boot_time + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration, AttributeError):
+        return time.time()
+
+
+class StartupProgress:
+    def __init__(self):
+        self.lock = Lock()
+        self.started_at = process_start_time()
+        self.phases = {}  # 阶段名 -> 耗时 (秒)，按开始顺序排列
+        self.running = {}  # 正在进行的阶段 -> 开始时间 (加载 tokenizer 与权重等阶段可能同时进行)
+        self.ready_at = None
+        self.error = None
+
+    @contextmanager
+    def phase(self, name):
+        begin = time.time()
+        with self.lock:
+            self.running[name] = begin
+        try:
+            yield
+        finally:
+            with self.lock:
+                del self.running[name]
+                self.phases[name] = time.time() - begin
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.phases[name] = seconds
+
+    @property
+    def ready(self):
+        return self.ready_at is not None
+
+    @property
+    def cold_start_seconds(self):
+        return self.ready_at - self.started_at if self.ready else None
+
+    def mark_ready(self):
+        self.ready_at = time.time()
+        print(f"✅ 服务就绪，冷启动耗时 {self.cold_start_seconds:.1f}s")
+
+    def fail(self, error):
+        self.error = f"{type(error).__name__}: {error}"
+        print(f"❌ 启动失败: {self.error}")
+
+    def status(self):
+        with self.lock:
+            if self.error is not None:
+                state = "failed"
+            else:
+                state = "ready" if self.ready else "loading"
+            return {
+                "status": state,
+                "running": list(self.running),
+                "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+                "elapsed_seconds": round((self.ready_at or time.time()) - self.started_at, 3),
+                "cold_start_seconds": round(self.cold_start_seconds, 3) if self.ready else None,
+                "error": self.error,
+            }
+
+    def render(self):
+        """Prometheus 文本格式，拼在 /metrics 的末尾"""
+        cold_start = Gauge("model_cold_start_seconds", "进程启动到可以接收请求 (/readyz 返回 200) 的时间", ())
+        phases = Gauge("model_startup_phase_seconds", "启动各阶段的耗时", ("phase",))
+        with self.lock:
+            if self.ready:
+                cold_start.add((), self.cold_start_seconds)
+            for name, seconds in self.phases.items():
+                phases.add((name,), seconds)
+        return "\n".join(cold_start.render() + phases.render()) + "\n"
+
+
+# 全局单例
+startup_progress = StartupProgress()
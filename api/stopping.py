@@ -0,0 +1,51 @@
+from threading import Event
+
+from transformers import StoppingCriteria
+
+
+# ================= 停止条件 =================
+# 与 transformers 的 StoppingCriteria 接口一致：既可以交给 model.generate，
+# 也可以挂在 GenerationRequest.stopping_criteria 上，由调度器在每个 decode step 检查
+
+
+class DisconnectStoppingCriteria(StoppingCriteria):
+    """客户端断开连接后停止生成，避免继续为没人接收的请求解码"""
+
+    def __init__(self):
+        self.disconnected = Event()
+
+    def cancel(self):
+        self.disconnected.set()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.disconnected.is_set()
+
+
+# 句末标点 (逗号、顿号不算)：回复在这些字符处结束读起来是完整的
+SENTENCE_ENDINGS = ("。", "！", "？", "!", "?", "~", "～", "…", "\n")
+
+
+class ClauseStoppingCriteria(StoppingCriteria):
+    """
+    生成的 token 数达到软预算后，在下一个句末标点处停止：
+    不会在一句话说到一半时被硬截断，也不会在参考回复早就结束的长度之后继续长篇大论
+    """
+
+    def __init__(self, tokenizer, prompt_length, soft_budget, memo=None):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.soft_budget = soft_budget
+        # token id -> 是否以句末标点结尾 (同一个 tokenizer 的所有请求共用)
+        self.memo = {} if memo is None else memo
+
+    def ends_sentence(self, token_id):
+        ends = self.memo.get(token_id)
+        if ends is None:
+            ends = self.tokenizer.decode([token_id], skip_special_tokens=True).rstrip(" ").endswith(SENTENCE_ENDINGS)
+            self.memo[token_id] = ends
+        return ends
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if input_ids.shape[-1] - self.prompt_length < self.soft_budget:
+            return False
+        return self.ends_sentence(int(input_ids[0, -1]))
@@ -0,0 +1,107 @@
+import asyncio
+import inspect
+import json
+import random
+
+from fastapi.responses import StreamingResponse
+
+from config import SSE_PACING, COALESCE_WINDOW_MS, COALESCE_MAX_CHARS
+
+# ================= SSE 推送节奏 =================
+# none     : 收到多少推多少，每个片段一帧，不做任何等待
+# human    : 旧版“打字机”节奏，服务端每帧随机停顿，标点额外停顿 (会长时间占用连接，不推荐)
+# coalesce : 按时间窗口或分句边界把多个片段合并成一帧 (默认)，打字机效果交给前端
+PACING_MODES = ("none", "human", "coalesce")
+
+# 遇到这些字符结尾时立即推送，保证一句话说完能马上显示
+CLAUSE_BOUNDARIES = (",", "，", ".", "。", "!", "！", "?", "？", "；", ";", "~", "…", "\n")
+
+
+def resolve_pacing(mode):
+    mode = mode or SSE_PACING
+    if mode not in PACING_MODES:
+        raise ValueError(f"pacing 只能是 {PACING_MODES} 之一")
+    return mode
+
+
+def sse_frame(content):
+    # 固定部分直接拼接，只对内容做 json 转义，比每帧 json.dumps 整个 dict 更省
+    return 'data: {"role": "assistant", "content": ' + json.dumps(content, ensure_ascii=False) + '}\n\n'
+
+
+SSE_DONE = "data: [DONE]\n\n"
+
+
+def _clean(text):
+    # 清理特殊符号
+    return text.replace("<|im_end|>", "").replace("<|im_start|>", "")
+
+
+async def paced_chunks(stream, mode):
+    """按指定的推送节奏，把 TokenStream 的输出整理成一帧帧要发送的文本"""
+    if mode == "none":
+        async for new_text in stream:
+            clean_text = _clean(new_text)
+            if clean_text:
+                yield clean_text
+
+    elif mode == "human":
+        async for new_text in stream:
+            clean_text = _clean(new_text)
+            if clean_text:
+                yield clean_text
+                await asyncio.sleep(random.uniform(0.02, 0.05))
+                # 标点符号额外停顿：模拟人类思考/换气
+                if clean_text in CLAUSE_BOUNDARIES:
+                    await asyncio.sleep(0.1)
+
+    else:
+        loop = asyncio.get_running_loop()
+        window = COALESCE_WINDOW_MS / 1000
+        buffer = ""
+        deadline = None
+        while True:
+            # 缓冲区为空时一直等；否则最多等到时间窗口结束
+            timeout = None if not buffer else max(0.0, deadline - loop.time())
+            try:
+                new_text = await asyncio.wait_for(stream.__anext__(), timeout)
+            except asyncio.TimeoutError:
+                yield buffer
+                buffer = ""
+                continue
+            except StopAsyncIteration:
+                break
+
+            clean_text = _clean(new_text)
+            if not clean_text:
+                continue
+            if not buffer:
+                deadline = loop.time() + window
+            buffer += clean_text
+            if buffer.endswith(CLAUSE_BOUNDARIES) or len(buffer) >= COALESCE_MAX_CHARS:
+                yield buffer
+                buffer = ""
+
+        if buffer:
+            yield buffer
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    结束时一定会调用 on_close 的 StreamingResponse。
+    客户端在 Starlette 开始迭代响应体之前就断开时，生成器从未启动，它的 finally 不会执行；
+    收尾 (通知调度器停止解码、解除会话占用、输出追踪日志) 放在这里才不会漏掉；
+    on_close 可以是协程函数 (例如路由器关闭上游连接)
+    """
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            result = self.on_close()
+            if inspect.isawaitable(result):
+                await result
@@ -0,0 +1,131 @@
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
+import pytest
+import torch
+
+# 测试直接导入 api/ 下的模块 (与服务本身一样的扁平导入)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import GenerationRequest, GenerationScheduler  # noqa: E402
+
+# 字符级词表：每个 token 解码成一个字符，流式输出拼起来就是完整回复
+SPECIAL_TOKENS = ["<pad>", "<unk>", "<eos>"]
+CHARS = "abcdefghijklmnopqrstuvwxyz0123456789你我他好是的了不在有人这中大为上个国和"
+
+
+def build_tiny_tokenizer():
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    vocab = {token: i for i, token in enumerate(SPECIAL_TOKENS + list(CHARS))}
+    backend = Tokenizer(models.WordLevel(vocab=vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    backend.decoder = decoders.Fuse()
+    return PreTrainedTokenizerFast(tokenizer_object=backend, pad_token="<pad>", unk_token="<unk>",
+                                   eos_token="<eos>", padding_side="left")
+
+
+def build_tiny_model(tokenizer, num_kv_heads=2):
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+
+    config = Qwen2Config(
+        vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=num_kv_heads, max_position_embeddings=2048,
+        # 较大的初始化范围让 logits 分得更开，贪心解码不会卡在数值上几乎相等的候选之间
+        initializer_range=0.3, pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id,
+    )
+    torch.manual_seed(0)
+    return Qwen2ForCausalLM(config).eval()
+
+
+@pytest.fixture(scope="session")
+def tiny_tokenizer():
+    return build_tiny_tokenizer()
+
+
+@pytest.fixture(scope="session")
+def tiny_model(tiny_tokenizer):
+    return build_tiny_model(tiny_tokenizer)
+
+
+def make_prompts(lengths, seed=0):
+    """长度各不相同的随机 prompt (不含特殊 token)"""
+    generator = torch.Generator().manual_seed(seed)
+    low = len(SPECIAL_TOKENS)
+    high = low + len(CHARS)
+    return [torch.randint(low, high, (length,), generator=generator).tolist() for length in lengths]
+
+
+def greedy_request(input_ids, max_new_tokens=24, **kwargs):
+    # eos_token_ids=[]：随机模型可能很早就生成结束符，测试统一生成到 max_new_tokens
+    kwargs.setdefault("eos_token_ids", [])
+    return GenerationRequest(input_ids, max_new_tokens=max_new_tokens, temperature=0, repetition_penalty=1.0,
+                             **kwargs)
+
+
+@torch.no_grad()
+def reference_greedy(model, tokenizer, input_ids, max_new_tokens):
+    """不用 KV Cache、每步整段重算的贪心解码，作为单请求的参考输出"""
+    ids = list(input_ids)
+    for _ in range(max_new_tokens):
+        logits = model(input_ids=torch.tensor([ids])).logits[0, -1]
+        ids.append(int(torch.argmax(logits).item()))
+    return tokenizer.decode(ids[len(input_ids):], skip_special_tokens=True)
+
+
+class RecordingScheduler(GenerationScheduler):
+    """记录每个 decode step 的批次大小与预估的 KV Cache 峰值，以及每次 OOM 拆分前后的批次大小"""
+
+    def __init__(self):
+        super().__init__()
+        self.step_sizes = []
+        self.step_peaks = []
+        self.splits = []
+
+    def _decode_step(self):
+        self.step_sizes.append(len(self.active))
+        self.step_peaks.append(self.memory.peak_bytes(*self._batch_shape()))
+        super()._decode_step()
+
+    def _split_batch(self, error):
+        before = len(self.active)
+        super()._split_batch(error)
+        self.splits.append((before, len(self.active)))
+
+
+@pytest.fixture
+def make_scheduler(tiny_tokenizer, tiny_model):
+    def make(model=None, **kwargs):
+        scheduler = RecordingScheduler()
+        scheduler.start(tiny_tokenizer, model or tiny_model, "cpu", **kwargs)
+        return scheduler
+
+    return make
+
+
+@contextmanager
+def held(scheduler):
+    """
+    让调度线程停在两个 decode step 之间，期间提交的请求在放开后同一轮准入，保证它们在同一个批次里解码
+    """
+    entered = threading.Event()
+    release = threading.Event()
+
+    def wait():
+        entered.set()
+        release.wait(timeout=30)
+
+    future = scheduler.run_exclusive(wait)
+    entered.wait(timeout=30)
+    try:
+        yield
+    finally:
+        release.set()
+        future.result(timeout=30)
+
+
+def collect(stream):
+    return "".join(stream)
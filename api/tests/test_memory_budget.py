@@ -0,0 +1,103 @@
+import torch
+
+from conftest import build_tiny_model, collect, greedy_request, held, make_prompts
+from memory_budget import MB, MemoryBudget, kv_bytes_per_token
+
+# 4 个 KV 头 x head_dim 16 x 2 层 x K/V x fp32 = 1024 字节/token，1 MB 预算正好是 1024 个 token
+PROMPT_LENGTHS = [120, 90, 150, 100, 130, 110]
+MAX_NEW_TOKENS = 280
+
+
+def test_kv_bytes_per_token(tiny_tokenizer):
+    model = build_tiny_model(tiny_tokenizer, num_kv_heads=4)
+    assert kv_bytes_per_token(model) == 2 * 2 * 4 * 16 * 4
+
+
+def test_budget_caps_active_rows(make_scheduler, tiny_tokenizer):
+    model = build_tiny_model(tiny_tokenizer, num_kv_heads=4)
+    prompts = make_prompts(PROMPT_LENGTHS, seed=6)
+    unconstrained = make_scheduler(model=model, kv_budget_mb=-1)
+    expected = [collect(unconstrained.submit(greedy_request(prompt, MAX_NEW_TOKENS))) for prompt in prompts]
+
+    scheduler = make_scheduler(model=model, kv_budget_mb=1)
+    assert scheduler.memory.budget == MB
+    with held(scheduler):
+        streams = [scheduler.submit(greedy_request(prompt, MAX_NEW_TOKENS)) for prompt in prompts]
+    assert [collect(stream) for stream in streams] == expected
+
+    # 每行峰值约 (150 + 280) 个 token，1024 个 token 的预算最多放下两行
+    assert max(scheduler.step_sizes) == 2
+    assert all(peak <= scheduler.memory.budget for peak in scheduler.step_peaks)
+
+
+class OutOfMemoryOnce:
+    """包一层模型：批次第一次达到 batch_size 行时，forward 抛出 CUDA OOM (其余属性都转给原模型)"""
+
+    def __init__(self, model, batch_size):
+        self.model = model
+        self.batch_size = batch_size
+        self.raised = False
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def __call__(self, **kwargs):
+        if not self.raised and kwargs["input_ids"].shape[0] == self.batch_size:
+            self.raised = True
+            raise torch.cuda.OutOfMemoryError("CUDA out of memory. Tried to allocate 20.00 MiB")
+        return self.model(**kwargs)
+
+
+def test_oom_splits_batch_and_resumes(make_scheduler, tiny_model):
+    prompts = make_prompts([9, 17, 5, 12], seed=7)
+    unconstrained = make_scheduler()
+    expected = [collect(unconstrained.submit(greedy_request(prompt, 40))) for prompt in prompts]
+
+    scheduler = make_scheduler(model=OutOfMemoryOnce(tiny_model, len(prompts)))
+    with held(scheduler):
+        streams = [scheduler.submit(greedy_request(prompt, 40)) for prompt in prompts]
+    # 暂停的一半在另一半结束后从断点继续，输出与没有 OOM 时一致
+    assert [collect(stream) for stream in streams] == expected
+
+    assert scheduler.splits == [(4, 2)]
+    assert scheduler.memory.oom_splits == 1
+    assert not scheduler.paused
+    # 拆分之后批次不再超过两行，恢复的两行重新组成一个批次
+    after = scheduler.step_sizes[scheduler.step_sizes.index(4) + 1:]
+    assert max(after) == 2
+
+
+def test_oom_cap_climbs_back_to_configured_budget():
+    memory = MemoryBudget(recovery_steps=2)
+    memory.configured_budget = 8 * MB
+    memory.record_oom(MB)
+    assert memory.budget == MB
+    caps = []
+    for _ in range(6):
+        memory.record_step()
+        caps.append(memory.budget // MB)
+    assert caps == [1, 2, 2, 4, 4, 8]
+    assert memory.oom_cap == 0
+
+
+def test_budget_recovers_after_oom(make_scheduler, tiny_model):
+    prompts = make_prompts([9, 17, 5, 12], seed=8)
+    unconstrained = make_scheduler()
+    expected = [collect(unconstrained.submit(greedy_request(prompt, 40))) for prompt in prompts]
+
+    # 预算关闭时 OOM 只留下临时上限，不会把预算打开
+    scheduler = make_scheduler(model=OutOfMemoryOnce(tiny_model, len(prompts)), kv_budget_mb=-1)
+    scheduler.memory.recovery_steps = 4
+    with held(scheduler):
+        streams = [scheduler.submit(greedy_request(prompt, 40)) for prompt in prompts]
+    assert [collect(stream) for stream in streams] == expected
+    assert scheduler.splits == [(4, 2)]
+    assert not scheduler.memory.enabled
+    assert scheduler.memory.budget == 0
+
+    # 临时上限取消后，同样的 4 条请求重新在一个批次里解码
+    steps = len(scheduler.step_sizes)
+    with held(scheduler):
+        streams = [scheduler.submit(greedy_request(prompt, 40)) for prompt in prompts]
+    assert [collect(stream) for stream in streams] == expected
+    assert max(scheduler.step_sizes[steps:]) == 4
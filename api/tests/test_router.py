@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+import httpx
+
+import router as router_module
+from router import Router, app
+
+
+class UpstreamStream(httpx.AsyncByteStream):
+    """worker 的 SSE 响应体：记录是否被关闭"""
+
+    def __init__(self):
+        self.closed = False
+
+    async def __aiter__(self):
+        for _ in range(3):
+            yield b"data: {}\n\n"
+
+    async def aclose(self):
+        self.closed = True
+
+
+async def call_app(body, send):
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": "/chat/completions", "raw_path": b"/chat/completions",
+        "query_string": b"", "root_path": "", "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 1), "server": ("127.0.0.1", 8000),
+    }
+    try:
+        await app(scope, receive, send)
+    except Exception:
+        pass
+
+
+def test_stream_released_when_client_leaves_before_body(monkeypatch):
+    stream = UpstreamStream()
+    transport = httpx.MockTransport(
+        lambda request: httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=stream))
+    router = Router(["http://worker"])
+    router.client = httpx.AsyncClient(transport=transport)
+    monkeypatch.setattr(router_module, "router", router)
+
+    async def send(message):
+        # 客户端在响应头发出之前就断开：响应体一次都没有被迭代
+        raise OSError("client disconnected")
+
+    body = json.dumps({"messages": [{"role": "user", "content": "hi"}], "max_new_tokens": 64}).encode()
+    asyncio.run(call_app(body, send))
+
+    worker = router.workers[0]
+    assert worker.total_requests == 1
+    assert worker.in_flight_tokens == 0
+    assert worker.in_flight_requests == 0
+    assert stream.closed
+
+
+def test_stream_relayed_and_released(monkeypatch):
+    stream = UpstreamStream()
+    transport = httpx.MockTransport(
+        lambda request: httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=stream))
+    router = Router(["http://worker"])
+    router.client = httpx.AsyncClient(transport=transport)
+    monkeypatch.setattr(router_module, "router", router)
+
+    received = []
+
+    async def send(message):
+        received.append(message)
+
+    body = json.dumps({"messages": [{"role": "user", "content": "hi"}]}).encode()
+    asyncio.run(call_app(body, send))
+
+    assert received[0]["status"] == 200
+    assert b"".join(message.get("body", b"") for message in received[1:]) == b"data: {}\n\n" * 3
+    assert router.workers[0].in_flight_requests == 0
+    assert stream.closed
@@ -0,0 +1,185 @@
+import time
+
+import pytest
+import torch
+
+import scheduler as scheduler_module
+from conftest import build_tiny_model, collect, greedy_request, held, make_prompts, reference_greedy
+from kv_cache import CachedPrefix, cache_to_tensors
+from scheduler import QueueFullError
+from stopping import DisconnectStoppingCriteria
+from tracing import RequestProfiler
+
+# 长度差别很大的 prompt：批次里短的序列左侧有大段 padding
+PROMPT_LENGTHS = [3, 11, 26, 7]
+MAX_NEW_TOKENS = 24
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise TimeoutError("等待调度器状态超时")
+        time.sleep(0.01)
+
+
+def test_single_request_matches_full_recompute(make_scheduler, tiny_model, tiny_tokenizer):
+    scheduler = make_scheduler()
+    prompt = make_prompts([9])[0]
+    stream = scheduler.submit(greedy_request(prompt, MAX_NEW_TOKENS))
+    assert collect(stream) == reference_greedy(tiny_model, tiny_tokenizer, prompt, MAX_NEW_TOKENS)
+
+
+def test_batched_greedy_matches_single_requests(make_scheduler):
+    prompts = make_prompts(PROMPT_LENGTHS)
+    single = make_scheduler()
+    expected = [collect(single.submit(greedy_request(prompt, MAX_NEW_TOKENS))) for prompt in prompts]
+
+    batched = make_scheduler()
+    with held(batched):
+        streams = [batched.submit(greedy_request(prompt, MAX_NEW_TOKENS)) for prompt in prompts]
+    assert [collect(stream) for stream in streams] == expected
+    # 四个请求确实在同一个 (左侧 padding 对齐的) 批次里解码
+    assert max(batched.step_sizes) == len(prompts)
+
+
+def test_request_joining_a_running_batch_matches_single(make_scheduler):
+    prompts = make_prompts([5, 19], seed=1)
+    single = make_scheduler()
+    expected = [collect(single.submit(greedy_request(prompt, 40))) for prompt in prompts]
+
+    scheduler = make_scheduler()
+    first = scheduler.submit(greedy_request(prompts[0], 40))
+    wait_until(lambda: len(scheduler.step_sizes) >= 5)
+    # 第二条在第一条解码到一半时并入批次，缓存长度不同，需要重新左侧对齐
+    second = scheduler.submit(greedy_request(prompts[1], 40))
+    assert [collect(first), collect(second)] == expected
+    assert 2 in scheduler.step_sizes
+
+
+def test_finished_sequence_leaves_the_batch(make_scheduler):
+    short, long = make_prompts([4, 4], seed=2)
+    scheduler = make_scheduler()
+    with held(scheduler):
+        short_stream = scheduler.submit(greedy_request(short, 3))
+        long_stream = scheduler.submit(greedy_request(long, 60))
+    collect(short_stream)
+    wait_until(lambda: len(scheduler.active) == 1)
+    assert scheduler.active[0].request.max_new_tokens == 60
+    assert scheduler.attention_mask.shape[0] == 1
+    collect(long_stream)
+    wait_until(lambda: not scheduler.active)
+    assert scheduler.past is None
+
+
+def test_cancelled_sequence_leaves_the_batch(make_scheduler):
+    kept, cancelled = make_prompts([6, 8], seed=3)
+    disconnect = DisconnectStoppingCriteria()
+    scheduler = make_scheduler()
+    with held(scheduler):
+        kept_stream = scheduler.submit(greedy_request(kept, 200))
+        cancelled_request = greedy_request(cancelled, 2000, stopping_criteria=[disconnect])
+        cancelled_stream = scheduler.submit(cancelled_request)
+    wait_until(lambda: len(scheduler.step_sizes) >= 3)
+    disconnect.cancel()
+    collect(cancelled_stream)
+    assert cancelled_request.num_generated < 2000
+    # 流的结束信号先于移出批次发出，等调度线程完成这一步
+    wait_until(lambda: all(seq.request is not cancelled_request for seq in scheduler.active))
+    collect(kept_stream)
+    wait_until(lambda: not scheduler.active)
+
+
+def test_seeded_sampling_is_independent_of_speculation(make_scheduler, tiny_model):
+    prompt = make_prompts([7], seed=5)[0]
+
+    def sampled(scheduler):
+        request = greedy_request(prompt, MAX_NEW_TOKENS, seed=123, speculative=True)
+        request.temperature = 0.9
+        return collect(scheduler.submit(request))
+
+    # 草稿模型用小模型自己 (词表相同)；带 seed 的采样请求不投机，输出与没有草稿模型时一致
+    speculative = make_scheduler(draft_model=tiny_model)
+    assert sampled(speculative) == sampled(make_scheduler())
+    assert speculative.spec_steps == 0
+
+
+@torch.no_grad()
+def test_prefix_from_replaced_adapter_is_not_reused(make_scheduler, tiny_model, tiny_tokenizer):
+    # “旧权重”算出来的前缀 KV：同结构的模型，权重被改过 (相当于适配器被同名替换之前的版本)
+    old_model = build_tiny_model(tiny_tokenizer)
+    for param in old_model.parameters():
+        param.mul_(1.5)
+    prompt = make_prompts([20], seed=9)[0]
+    outputs = old_model(input_ids=torch.tensor([prompt[:8]]), use_cache=True)
+    stale = CachedPrefix(prompt[:8], cache_to_tensors(outputs.past_key_values), adapter="role@1")
+    expected = reference_greedy(tiny_model, tiny_tokenizer, prompt, MAX_NEW_TOKENS)
+
+    versions = {"role": "role@1"}
+    scheduler = make_scheduler(adapter_tag=lambda name: versions[name])
+    # 版本一致时前缀会被复用 (旧 KV 让输出偏离参考结果)，说明下面的对比有意义
+    assert collect(scheduler.submit(greedy_request(prompt, MAX_NEW_TOKENS, prefix=stale, adapter="role"))) != expected
+
+    versions["role"] = "role@2"
+    request = greedy_request(prompt, MAX_NEW_TOKENS, prefix=stale, adapter="role", cache_tag="role@1")
+    assert collect(scheduler.submit(request)) == expected
+    assert request.prefix is None
+    assert request.cache_tag == "role@2"
+
+
+def test_rejected_request_returns_its_profile_slot(make_scheduler, monkeypatch, tmp_path):
+    profiler = RequestProfiler(output_dir=str(tmp_path))
+    monkeypatch.setattr(scheduler_module, "request_profiler", profiler)
+    scheduler = make_scheduler(max_queue_depth=1)
+    prompts = make_prompts([6, 6, 6], seed=10)
+    profiler.arm(1)
+
+    with held(scheduler):
+        queued = scheduler.submit(greedy_request(prompts[0], 4))
+        rejected = greedy_request(prompts[1], 4)
+        profiler.claim(rejected)
+        with pytest.raises(QueueFullError):
+            scheduler.submit(rejected)
+        # 被拒绝的请求从没进入调度线程：名额还回去，profiler 没有在接口线程里启动或停止
+        assert profiler.status() == {"remaining": 1, "outstanding": 0, "running": False, "traces": []}
+    collect(queued)
+
+    # 名额由下一个真正进入调度器的请求使用，trace 在调度线程里导出
+    request = greedy_request(prompts[2], 4)
+    profiler.claim(request)
+    collect(scheduler.submit(request))
+    wait_until(lambda: profiler.status()["traces"])
+    assert not profiler.status()["running"]
+
+
+class RecordingCriteria:
+    """记录每次被调用时看到的 input_ids (prompt + 已生成)"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.calls.append(input_ids[0].tolist())
+        return False
+
+
+@torch.no_grad()
+def test_repetition_penalty_and_stopping_inputs_match_full_recompute(make_scheduler, tiny_model, tiny_tokenizer):
+    prompt = make_prompts([12], seed=11)[0]
+    criteria = RecordingCriteria()
+    request = greedy_request(prompt, MAX_NEW_TOKENS, stopping_criteria=[criteria])
+    request.repetition_penalty = 1.3
+    scheduler = make_scheduler()
+    text = collect(scheduler.submit(request))
+
+    # 参考：每步整段重算，对 prompt + 已生成中出现过的 token 做同样的重复惩罚
+    ids = list(prompt)
+    for _ in range(MAX_NEW_TOKENS):
+        logits = tiny_model(input_ids=torch.tensor([ids])).logits[0, -1]
+        seen = torch.tensor(sorted(set(ids)))
+        score = logits[seen]
+        logits[seen] = torch.where(score < 0, score * 1.3, score / 1.3)
+        ids.append(int(torch.argmax(logits)))
+    assert text == tiny_tokenizer.decode(ids[len(prompt):], skip_special_tokens=True)
+    # 停止条件在准入时和每个新 token 之后 (达到 max_new_tokens 的最后一个除外) 看到完整的 prompt + 已生成
+    assert criteria.calls == [ids[:n] for n in range(len(prompt), len(ids))]
@@ -0,0 +1,55 @@
+import asyncio
+import time
+
+from conftest import greedy_request, held, make_prompts
+from streaming import paced_chunks, sse_frame
+
+MAX_NEW_TOKENS = 150
+# 解码期间事件循环上其他协程的最大等待 (秒)：调度线程阻塞事件循环时会远远超过它
+MAX_LOOP_LAG = 0.1
+
+
+async def consume(stream, index, events):
+    """与 SSE 接口相同的读取方式：async for 等待 TokenStream，逐帧记录到达顺序"""
+    async for chunk in paced_chunks(stream, "none"):
+        sse_frame(chunk)
+        events.append((time.perf_counter(), index))
+
+
+async def probe(stop, lags):
+    """每 5ms 醒来一次，记录实际比预期晚了多久"""
+    while not stop.is_set():
+        begin = time.perf_counter()
+        await asyncio.sleep(0.005)
+        lags.append(time.perf_counter() - begin - 0.005)
+
+
+async def run_streams(scheduler, prompts):
+    loop = asyncio.get_running_loop()
+    events, lags = [], []
+    with held(scheduler):
+        streams = [scheduler.submit(greedy_request(prompt, MAX_NEW_TOKENS), loop=loop) for prompt in prompts]
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(stop, lags))
+    await asyncio.gather(*[consume(stream, i, events) for i, stream in enumerate(streams)])
+    stop.set()
+    await probe_task
+    return events, lags
+
+
+def test_streams_interleave_and_loop_stays_responsive(make_scheduler):
+    scheduler = make_scheduler()
+    events, lags = asyncio.run(run_streams(scheduler, make_prompts([5, 13], seed=4)))
+
+    order = [index for _, index in sorted(events)]
+    assert set(order) == {0, 1}
+    first = {i: min(t for t, j in events if j == i) for i in (0, 1)}
+    last = {i: max(t for t, j in events if j == i) for i in (0, 1)}
+    # 每个流的第一帧都早于另一个流的最后一帧，并且两个流的帧交替到达，而不是一个流结束后另一个才开始
+    assert first[0] < last[1] and first[1] < last[0]
+    switches = sum(1 for a, b in zip(order, order[1:]) if a != b)
+    assert switches >= MAX_NEW_TOKENS // 2
+
+    # 解码期间事件循环一直在处理其他协程
+    assert len(lags) >= 5
+    assert max(lags) < MAX_LOOP_LAG
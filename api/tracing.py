@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from threading import Lock
+
+import torch
+
+from config import REQUEST_TRACE, TRACE_LOG_FILE, PROFILE_DIR
+
+# ================= 请求分阶段追踪 =================
+# 每个请求一条 JSON 日志 (带 request_id)，记录各阶段的起止时间：
+#   接口层：校验 / 截断 / 查缓存 / chat template / tokenize / 提交 / SSE 推送
+#   调度器：排队 / prefill (含拷贝到设备) / decode，以及 decode 期间累计的 forward 与增量解码 (detokenize) 耗时
+# 按需性能剖析：管理接口为接下来 K 个请求挂上 torch.profiler，全部结束后导出 Chrome trace
+
+trace_logger = logging.getLogger("qwen_social.trace")
+trace_logger.setLevel(logging.INFO)
+trace_logger.propagate = False
+if not trace_logger.handlers:
+    _handler = logging.FileHandler(TRACE_LOG_FILE, encoding="utf-8") if TRACE_LOG_FILE \
+        else logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_logger.addHandler(_handler)
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+class RequestTrace:
+    """一个请求的追踪记录：span 是 (名字, 开始, 结束) 的 perf_counter 时间点，totals 是按名字累加的耗时"""
+
+    def __init__(self, endpoint, **fields):
+        self.request_id = uuid.uuid4().hex[:16]
+        self.endpoint = endpoint
+        self.fields = dict(fields)
+        self.start = time.perf_counter()
+        self.spans = []
+        self.totals = {}
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start, time.perf_counter()))
+
+    def add_span(self, name, start, end):
+        if start is not None and end is not None:
+            self.spans.append((name, start, end))
+
+    def add_time(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def to_dict(self):
+        return {
+            "request_id": self.request_id,
+            "endpoint": self.endpoint,
+            **self.fields,
+            "total_ms": _ms(time.perf_counter() - self.start),
+            "spans": [
+                {"name": name, "start_ms": _ms(start - self.start), "duration_ms": _ms(end - start)}
+                for name, start, end in sorted(self.spans, key=lambda span: span[1])
+            ],
+            "totals_ms": {name: _ms(seconds) for name, seconds in self.totals.items()},
+        }
+
+    def emit(self):
+        trace_logger.info(json.dumps(self.to_dict(), ensure_ascii=False))
+
+
+class _NullTrace:
+    """关闭追踪 (REQUEST_TRACE=0) 或不需要追踪的请求 (批量生成、n>1 的兄弟序列) 使用，所有操作都是空操作"""
+    request_id = None
+
+    def span(self, name):
+        return nullcontext()
+
+    def add_span(self, name, start, end):
+        pass
+
+    def add_time(self, name, seconds):
+        pass
+
+    def set(self, **fields):
+        pass
+
+    def emit(self):
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+
+def start_trace(endpoint, **fields):
+    return RequestTrace(endpoint, **fields) if REQUEST_TRACE else NULL_TRACE
+
+
+# ================= 按需 torch.profiler =================
+class RequestProfiler:
+    """
+    arm(K) 之后，接下来进入调度器的 K 个请求被标记为需要剖析：
+    第一个被标记的请求开始 prefill 时启动 torch.profiler (在调度线程里，覆盖同批次的所有计算)，
+    被标记的请求全部结束后停止并导出 Chrome trace (chrome://tracing 或 Perfetto 打开)
+    """
+
+    def __init__(self, output_dir=PROFILE_DIR):
+        self.lock = Lock()
+        self.output_dir = output_dir
+        self.remaining = 0  # 还要标记多少个请求
+        self.outstanding = 0  # 已标记但还没结束的请求
+        self.profiler = None
+        self.traces = []  # 已导出的 trace 文件
+
+    def arm(self, num_requests):
+        with self.lock:
+            if self.remaining or self.outstanding:
+                raise ValueError("上一轮剖析还没有结束")
+            self.remaining = num_requests
+        return self.status()
+
+    def claim(self, request):
+        """接口层提交请求前调用：还有名额时把这个请求标记为需要剖析"""
+        with self.lock:
+            if not self.remaining:
+                return
+            self.remaining -= 1
+            self.outstanding += 1
+        request.profiled = True
+
+    def request_started(self, request):
+        # 只在调度线程调用
+        if request.profiled and self.profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.profiler.__enter__()
+            print("🔍 torch.profiler 已启动")
+
+    def release(self, request):
+        """
+        被标记的请求没能进入调度器 (例如队列已满)：把名额还给下一个请求。
+        不碰 profiler，它只在调度线程里启动和停止
+        """
+        if not request.profiled:
+            return
+        request.profiled = False
+        with self.lock:
+            self.outstanding -= 1
+            self.remaining += 1
+
+    def request_finished(self, request):
+        # 只在调度线程调用 (可能停止 profiler)
+        if not request.profiled:
+            return
+        request.profiled = False
+        with self.lock:
+            self.outstanding -= 1
+            done = not self.remaining and not self.outstanding
+        if done and self.profiler is not None:
+            self._export()
+
+    def region(self, name):
+        """调度器在 prefill / decode step 外面包一层，剖析时在 trace 里显示为一段"""
+        if self.profiler is None:
+            return nullcontext()
+        return torch.profiler.record_function(name)
+
+    def _export(self):
+        profiler, self.profiler = self.profiler, None
+        profiler.__exit__(None, None, None)
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"trace_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}.json")
+        profiler.export_chrome_trace(path)
+        self.traces.append(path)
+        print(f"🔍 Chrome trace 已导出: {path}")
+
+    def status(self):
+        with self.lock:
+            return {
+                "remaining": self.remaining,
+                "outstanding": self.outstanding,
+                "running": self.profiler is not None,
+                "traces": list(self.traces),
+            }
+
+
+# 全局单例
+request_profiler = RequestProfiler()
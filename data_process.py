@@ -2,67 +2,14 @@ import json
 import os
 import random  # 引入随机库
 
+from role_registry import ROLES, system_prompt
+
 # ================= 配置区域 =================
 
-# 1. 定义不同角色的“人设基调”
-ROLE_SYSTEM_PROMPTS = {
-    '长辈对话数据': (
-        "你是一个情商极高的工科学生。你现在的对话对象是你的【长辈】。"
-        "请保持尊敬、亲切的态度，并使用幽默、搞笑感来活跃气氛，"
-        "对于关心和询问要耐心回答，对于催促或压力要巧妙化解。也可以直接怼回去。"
-    ),
-    '女友对话数据': (
-        "你是一个风趣幽默的工科学生。你现在的对话对象是你的【女友】。"
-        "对话充满中国式幽默却又不失暧昧，适当反转。"
-        "对于一些无理要求可以适当怼她，其他时候要有甜美的感觉。"
-    ),
-    '导师对话数据': (
-        "你是一个理工科研究生，情商很高，说话有分寸。你现在的对话对象是你的【导师】。"
-        "整体风格要：尊敬、专业、礼貌为主，同时可以适度幽默、机智，缓解科研和催稿带来的压力。"
-        "面对导师的关心和提问，要耐心、具体地回答，体现你有认真思考和实际行动。"
-        "面对催论文、催进度、批评指正时，先诚恳认领问题，再用轻松但不油腻的方式化解，"
-        "可以自嘲、可以用技术类比（比如项目迭代、系统优化），但不要撒娇卖萌，也不要搞暧昧。"
-        "记得多称呼“老师”，学会复述导师的建议并给出自己的下一步计划，"
-        "既不卑微，也不过度顶嘴；如果要“怼回去”，要用高情商方式，比如用事实、数据或幽默反转，"
-        "既守住学生的姿态，又不失风度。"
-    ),
-    '陌生人对话数据': (
-        "你是一个机智、得体、有分寸感的工科学生。你现在的对话对象是你的【陌生人】。"
-        "保持轻松、礼貌的态度，并使用高情商幽默来化解尴尬或拉近距离，"
-        "对于冒犯或尴尬的问题要机智回应、保护隐私；对于无心的小误会要用幽默展现善意。"
-        "当感觉投缘时，可以适度分享，用共同话题建立连接。"
-        "当感觉不安全或对方意图不当时，礼貌地结束对话并离开。"
-    ),
-    '夫妻对话数据': (
-        "你是一个情商在线、风趣暖心的伴侣。你现在的对话对象是你的【配偶】。"
-        "对话充满生活烟火气，兼具幽默调侃与温柔包容，偶尔互怼却不伤人。"
-        "对于日常琐事多换位思考，对于矛盾巧妙化解，对于关心加倍回应，用轻松语气传递爱意。"
-    )
-}
+# 1. 角色的“人设基调”与原始数据文件统一定义在 role_registry.py (推理服务、测试与评估脚本共用同一份 prompt)
 
 # 2. 输入文件列表
-pri_data_list = [
-    {
-        'name': '长辈对话数据',
-        'file': './data/elder_chat_list.json',
-    },
-    {
-        'name': '女友对话数据',
-        'file': './data/girl_chat_list.json',
-    },
-    {
-        'name': '导师对话数据',
-        'file': './data/teacher_chat_list.json',
-    },
-    {
-        'name': '陌生人对话数据',
-        'file': './data/stranger_chat_list.json',
-    },
-    {
-        'name': '夫妻对话数据',
-        'file': './data/wife_chat_list.json',
-    }
-]
+pri_data_list = [{'name': role.name, 'file': role.chat_file} for role in ROLES]
 
 # 3. 输出文件配置
 OUTPUT_DIR = './data/train_test/'
@@ -73,7 +20,7 @@ TEST_FILE = os.path.join(OUTPUT_DIR, 'test.json')  # 纠正为 test.json，比
 # ================= 核心处理逻辑 =================
 
 
-def process_single_file(input_path, dataset_name):
+def process_single_file(input_path, role_name):
     """
     读取原始JSON，转换为 OpenAI 格式
     """
@@ -81,18 +28,17 @@ def process_single_file(input_path, dataset_name):
         print(f"[跳过] 找不到文件: {input_path}")
         return []
 
-    base_system_prompt = ROLE_SYSTEM_PROMPTS.get(dataset_name, "你是一个乐于助人的助手。")
     dataset_formatted_list = []
 
     try:
         with open(input_path, 'r', encoding='utf-8') as f:
             raw_data = json.load(f)
 
-        print(f"正在处理 [{dataset_name}]... 发现 {len(raw_data)} 条对话")
+        print(f"正在处理 [{role_name}]... 发现 {len(raw_data)} 条对话")
 
         for item in raw_data:
             scene = item.get('scene', '日常聊天')
-            full_system_content = f"{base_system_prompt} 当前话题：【{scene}】。"
+            full_system_content = system_prompt(role_name, scene)
 
             messages = [{"role": "system", "content": full_system_content}]
 
@@ -113,7 +59,7 @@ def process_single_file(input_path, dataset_name):
         return dataset_formatted_list
 
     except Exception as e:
-        print(f"[错误] 处理 {dataset_name} 时发生异常: {str(e)}")
+        print(f"[错误] 处理 {role_name} 时发生异常: {str(e)}")
         return []
 
 
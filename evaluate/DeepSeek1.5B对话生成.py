@@ -3,6 +3,10 @@ import json
 import pandas as pd
 from tqdm import tqdm
 import ollama
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # 仓库根目录，导入 role_registry
+from role_registry import DEFAULT_SYSTEM_PROMPT, ROLE_PROMPTS, ROLES
 
 # ================= 配置区域 =================
 # 确保这个模型名字在你的 cmd 输入 'ollama list' 能看到
@@ -12,21 +16,8 @@ OLLAMA_MODEL_NAME = "deepseek-v3.1:671b-cloud"
 EVAL_DATA_DIR = "D:/program/ai_program/nlp_end_done/evaluate/data/"
 OUTPUT_DIR = "D:/program/ai_program/nlp_end_done/evaluate/results6/"
 
-SCENARIO_FILES = {
-    "长辈": "elder_text.json",
-    "女友": "girl_text.json",
-    "导师": "teacher_text.json",
-    "陌生人": "strange_text.json",
-    "夫妻": "wife_text.json"
-}
-
-ROLE_PROMPTS = {
-    "长辈": "你是一个情商极高的工科学生。你现在的对话对象是你的【长辈】。请保持尊敬、亲切的态度，并使用幽默、搞笑感来活跃气氛。",
-    "女友": "你是一个风趣幽默的工科学生。你现在的对话对象是你的【女友】。对话充满中国式幽默却又不失暧昧，适当反转。其他时候要有甜美的感觉。",
-    "导师": "你是一个理工科研究生，情商很高，说话有分寸。你现在的对话对象是你的【导师】。整体风格要：尊敬、专业、礼貌为主，同时可以适度幽默、机智。",
-    "陌生人": "你是一个机智、得体、有分寸感的工科学生。你现在的对话对象是你的【陌生人】。保持轻松、礼貌的态度，并使用高情商幽默来化解尴尬或拉近距离。",
-    "夫妻": "你是一个情商在线、风趣暖心的伴侣。你现在的对话对象是你的【配偶】。对话充满生活烟火气，兼具幽默调侃与温柔包容。"
-}
+# 角色与 system prompt 统一来自 role_registry，与训练数据一致
+SCENARIO_FILES = {role.name: role.eval_file for role in ROLES}
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
@@ -73,7 +64,7 @@ def main():
             continue
 
         print(f"\n🤖 正在逐轮评估场景 (Ollama): 【{role_name}】...")
-        current_system_prompt = ROLE_PROMPTS.get(role_name, "你是一个乐于助人的助手。")
+        current_system_prompt = ROLE_PROMPTS.get(role_name, DEFAULT_SYSTEM_PROMPT)
 
         with open(file_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
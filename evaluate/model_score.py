@@ -3,6 +3,10 @@ import json
 import os
 from openai import OpenAI
 from tqdm import tqdm
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # 仓库根目录，导入 role_registry
+from role_registry import ROLE_PROMPTS
 
 # ================= 配置区域 =================
 DEEPSEEK_API_KEY = "sk-xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx"
@@ -21,13 +25,7 @@ FILES_TO_EVAL = [
 ]
 
 # 3. 完整的 Prompt 映射 (评分标准)
-ROLE_PROMPTS_MAP = {
-    "长辈": "你是一个情商极高的工科学生。你现在的对话对象是你的【长辈】。请保持尊敬、亲切的态度，并使用幽默、搞笑感来活跃气氛。",
-    "女友": "你是一个风趣幽默的工科学生。你现在的对话对象是你的【女友】。对话充满中国式幽默却又不失暧昧，适当反转。其他时候要有甜美的感觉。",
-    "导师": "你是一个理工科研究生，情商很高，说话有分寸。你现在的对话对象是你的【导师】。整体风格要：尊敬、专业、礼貌为主，同时可以适度幽默、机智。",
-    "陌生人": "你是一个机智、得体、有分寸感的工科学生。你现在的对话对象是你的【陌生人】。保持轻松、礼貌的态度，并使用高情商幽默来化解尴尬或拉近距离。",
-    "夫妻": "你是一个情商在线、风趣暖心的伴侣。你现在的对话对象是你的【配偶】。对话充满生活烟火气，兼具幽默调侃与温柔包容。"
-}
+ROLE_PROMPTS_MAP = ROLE_PROMPTS  # 来自 role_registry，与训练数据一致
 
 
 # ================= 评分逻辑 =================
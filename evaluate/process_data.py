@@ -2,6 +2,10 @@
 
 import json
 import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # 仓库根目录，导入 role_registry
+from role_registry import ROLE_BY_NAME, ROLES, role_of_system_prompt
 
 # 1. 定义文件路径配置
 input_file_path = '../data/train_test/test_cleaned.json'
@@ -12,13 +16,8 @@ if not os.path.exists(output_dir):
     os.makedirs(output_dir)
 
 # 2. 初始化分类容器
-categorized_data = {
-    "elder": [],  # 长辈/亲戚
-    "girl": [],  # 女友
-    "teacher": [],  # 导师
-    "strange": [],  # 陌生人
-    "wife": []  # 夫妻/配偶
-}
+# 按 role_registry 中的 file_key 分类 (elder / girl / teacher / strange / wife)
+categorized_data = {role.file_key: [] for role in ROLES}
 
 # 3. 读取数据
 try:
@@ -38,22 +37,10 @@ for item in text_data:
         # 获取第一条消息（System Prompt）的内容
         system_content = item['messages'][0]['content']
 
-        # 根据关键词进行匹配
-        if "【长辈】" in system_content or "【亲戚】" in system_content:
-            categorized_data["elder"].append(item)
-
-        elif "【女友】" in system_content:
-            categorized_data["girl"].append(item)
-
-        elif "【导师】" in system_content or "【老师】" in system_content:
-            categorized_data["teacher"].append(item)
-
-        elif "【陌生人】" in system_content:
-            categorized_data["strange"].append(item)
-
-        elif "【夫妻】" in system_content or "【配偶】" in system_content or "【妻子】" in system_content:
-            categorized_data["wife"].append(item)
-
+        # 根据 prompt 中的【对象】标记 (含 亲戚 / 老师 / 配偶 / 妻子 等别名) 反查角色
+        role_name = role_of_system_prompt(system_content)
+        if role_name:
+            categorized_data[ROLE_BY_NAME[role_name].file_key].append(item)
         else:
             # 这里的代码用于调试，查看是否有未匹配到的类型
             # print(f"未分类的数据类型: {system_content[:20]}...")
@@ -4,6 +4,10 @@ import torch
 import pandas as pd
 from tqdm import tqdm
 from transformers import AutoModelForCausalLM, AutoTokenizer
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # 仓库根目录，导入 role_registry
+from role_registry import DEFAULT_SYSTEM_PROMPT, ROLE_PROMPTS, ROLES
 
 # from peft import PeftModel # 不需要加载 LoRA 适配器了
 
@@ -13,21 +17,8 @@ BASE_MODEL_PATH = "D:/program/ai_program/nlp_end_done/models/Qwen/Qwen2.5-3B-Ins
 EVAL_DATA_DIR = "D:/program/ai_program/nlp_end_done/evaluate/data/"
 OUTPUT_DIR = "D:/program/ai_program/nlp_end_done/evaluate/results2/"  # 修改为 result2 目录
 
-SCENARIO_FILES = {
-    "长辈": "elder_text.json",
-    "女友": "girl_text.json",
-    "导师": "teacher_text.json",
-    "陌生人": "strange_text.json",
-    "夫妻": "wife_text.json"
-}
-
-ROLE_PROMPTS = {
-    "长辈": "你是一个情商极高的工科学生。你现在的对话对象是你的【长辈】。请保持尊敬、亲切的态度，并使用幽默、搞笑感来活跃气氛。",
-    "女友": "你是一个风趣幽默的工科学生。你现在的对话对象是你的【女友】。对话充满中国式幽默却又不失暧昧，适当反转。其他时候要有甜美的感觉。",
-    "导师": "你是一个理工科研究生，情商很高，说话有分寸。你现在的对话对象是你的【导师】。整体风格要：尊敬、专业、礼貌为主，同时可以适度幽默、机智。",
-    "陌生人": "你是一个机智、得体、有分寸感的工科学生。你现在的对话对象是你的【陌生人】。保持轻松、礼貌的态度，并使用高情商幽默来化解尴尬或拉近距离。",
-    "夫妻": "你是一个情商在线、风趣暖心的伴侣。你现在的对话对象是你的【配偶】。对话充满生活烟火气，兼具幽默调侃与温柔包容。"
-}
+# 角色与 system prompt 统一来自 role_registry，与训练数据一致
+SCENARIO_FILES = {role.name: role.eval_file for role in ROLES}
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
@@ -60,6 +51,25 @@ def format_history_for_excel(messages):
 
 
 def generate_response(model, tokenizer, messages):
+    """
+    显存不够 (对话历史太长) 时从最早的一轮开始丢弃历史重试，不让整个评估中途崩溃。
+    返回 (回复, 丢弃的轮数)：丢弃过历史的回复对应的输入与测试集不同，结果表里要标出来
+    """
+    truncated_turns = 0
+    while True:
+        try:
+            return generate_once(model, tokenizer, messages), truncated_turns
+        except torch.cuda.OutOfMemoryError:
+            torch.cuda.empty_cache()
+            start = 1 if messages[0]['role'] == 'system' else 0
+            if len(messages) - start <= 1:
+                raise
+            print(f"⚠️ 显存不足，丢弃最早一轮历史后重试 (剩余 {len(messages) - start - 2} 条)")
+            messages = messages[:start] + messages[start + 2:]
+            truncated_turns += 1
+
+
+def generate_once(model, tokenizer, messages):
     input_text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
     inputs = tokenizer(input_text, return_tensors="pt").to(model.device)
 
@@ -83,7 +93,7 @@ def main():
         if not os.path.exists(file_path): continue
 
         print(f"\n🤖 正在逐轮评估场景 (原始模型): 【{role_name}】...")
-        current_system_prompt = ROLE_PROMPTS.get(role_name, "你是一个乐于助人的助手。")
+        current_system_prompt = ROLE_PROMPTS.get(role_name, DEFAULT_SYSTEM_PROMPT)
 
         with open(file_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
@@ -116,7 +126,7 @@ def main():
                     reference_answer = messages[i + 1]['content']
 
                     # 4. 模型生成
-                    model_reply = generate_response(model, tokenizer, input_msgs)
+                    model_reply, truncated_turns = generate_response(model, tokenizer, input_msgs)
 
                     # 5. 计算当前是第几轮 (粗略计算)
                     turn_index = (i + 1) // 2
@@ -129,6 +139,8 @@ def main():
                         "当前提问": msg['content'],
                         "【原始模型回复】": model_reply,  # 表头略作区分
                         "【参考回复】": reference_answer,
+                        # 大于 0 时模型实际看到的历史比“对话历史”少了这么多轮 (显存不足)，对比评分时应剔除或单独看待
+                        "截断轮数 (truncated_turns)": truncated_turns,
                         "评分 (1-5)": ""
                     })
 
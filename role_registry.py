@@ -0,0 +1,242 @@
+"""
+角色注册表：五个角色的唯一定义。
+
+训练数据处理 (data_process.py)、推理服务 (api/roles.py)、本地测试 (test.py) 和评估脚本 (evaluate/) 都从这里导入，
+服务端使用的 system prompt 与训练数据完全一致，不会再各抄一份、越改越不一样。
+
+每个角色包括：编号、中文名、英文标识、system prompt 里的【对象】标记、数据文件名、规范 prompt、场景列表 (scene/*.txt)。
+依赖 tokenizer 的产物 (system prompt 的 token id、训练集每条参考回复的 token 数) 按 tokenizer 哈希缓存在 ROLE_CACHE_DIR，
+服务启动时的角色前缀和生成长度预算只需计算一次
+
+    python role_registry.py                                   # 查看角色、场景数与 prompt
+    python role_registry.py --tokenizer ./models/Qwen/Qwen2.5-3B-Instruct   # 预先生成 token 缓存
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENE_DIR = os.path.join(ROOT_DIR, "scene")
+ROLE_CACHE_DIR = os.environ.get("ROLE_CACHE_DIR", os.path.join(ROOT_DIR, "models", "role_cache"))
+
+# 不属于任何角色时使用的通用 prompt
+DEFAULT_SYSTEM_PROMPT = "你是一个乐于助人的助手。"
+
+
+class Role:
+    def __init__(self, role_id, name, key, mark, file_key, chat_file, prompt, aliases=()):
+        self.role_id = role_id  # 前端 / 接口使用的角色编号
+        self.name = name
+        self.key = key  # 英文标识 (角色适配器目录名、OpenAI 接口的模型名后缀)
+        self.mark = mark  # prompt 中“对话对象是你的【...】”的标记，用来从 system prompt 反查角色
+        self.aliases = tuple(aliases)  # 旧数据里出现过的其他标记
+        self.file_key = file_key  # scene/<file_key>_list.txt、evaluate/data/<file_key>_text.json
+        self.chat_file = chat_file  # 原始对话数据 (data_process.py 的输入)
+        self.prompt = prompt
+        self._scenes = None
+
+    @property
+    def scene_file(self):
+        return os.path.join(SCENE_DIR, f"{self.file_key}_list.txt")
+
+    @property
+    def eval_file(self):
+        return f"{self.file_key}_text.json"
+
+    @property
+    def scenes(self):
+        """生成训练数据时使用的话题列表 (scene/*.txt，每行一个)"""
+        if self._scenes is None:
+            try:
+                with open(self.scene_file, "r", encoding="utf-8-sig") as f:
+                    self._scenes = [line.strip() for line in f if line.strip()]
+            except OSError:
+                self._scenes = []
+        return self._scenes
+
+
+# 规范 prompt 即训练数据使用的 prompt，训练样本在末尾额外带有“当前话题：【...】。” (见 system_prompt)
+ROLES = [
+    Role(1, "长辈", "elder", "长辈", "elder", "./data/elder_chat_list.json", (
+        "你是一个情商极高的工科学生。你现在的对话对象是你的【长辈】。"
+        "请保持尊敬、亲切的态度，并使用幽默、搞笑感来活跃气氛，"
+        "对于关心和询问要耐心回答，对于催促或压力要巧妙化解。也可以直接怼回去。"
+    ), aliases=("亲戚",)),
+    Role(2, "女友", "girlfriend", "女友", "girl", "./data/girl_chat_list.json", (
+        "你是一个风趣幽默的工科学生。你现在的对话对象是你的【女友】。"
+        "对话充满中国式幽默却又不失暧昧，适当反转。"
+        "对于一些无理要求可以适当怼她，其他时候要有甜美的感觉。"
+    )),
+    Role(3, "导师", "mentor", "导师", "teacher", "./data/teacher_chat_list.json", (
+        "你是一个理工科研究生，情商很高，说话有分寸。你现在的对话对象是你的【导师】。"
+        "整体风格要：尊敬、专业、礼貌为主，同时可以适度幽默、机智，缓解科研和催稿带来的压力。"
+        "面对导师的关心和提问，要耐心、具体地回答，体现你有认真思考和实际行动。"
+        "面对催论文、催进度、批评指正时，先诚恳认领问题，再用轻松但不油腻的方式化解，"
+        "可以自嘲、可以用技术类比（比如项目迭代、系统优化），但不要撒娇卖萌，也不要搞暧昧。"
+        "记得多称呼“老师”，学会复述导师的建议并给出自己的下一步计划，"
+        "既不卑微，也不过度顶嘴；如果要“怼回去”，要用高情商方式，比如用事实、数据或幽默反转，"
+        "既守住学生的姿态，又不失风度。"
+    ), aliases=("老师",)),
+    Role(4, "陌生人", "stranger", "陌生人", "strange", "./data/stranger_chat_list.json", (
+        "你是一个机智、得体、有分寸感的工科学生。你现在的对话对象是你的【陌生人】。"
+        "保持轻松、礼貌的态度，并使用高情商幽默来化解尴尬或拉近距离，"
+        "对于冒犯或尴尬的问题要机智回应、保护隐私；对于无心的小误会要用幽默展现善意。"
+        "当感觉投缘时，可以适度分享，用共同话题建立连接。"
+        "当感觉不安全或对方意图不当时，礼貌地结束对话并离开。"
+    )),
+    Role(5, "夫妻", "spouse", "配偶", "wife", "./data/wife_chat_list.json", (
+        "你是一个情商在线、风趣暖心的伴侣。你现在的对话对象是你的【配偶】。"
+        "对话充满生活烟火气，兼具幽默调侃与温柔包容，偶尔互怼却不伤人。"
+        "对于日常琐事多换位思考，对于矛盾巧妙化解，对于关心加倍回应，用轻松语气传递爱意。"
+    ), aliases=("夫妻", "妻子")),
+]
+
+ROLE_BY_NAME = {role.name: role for role in ROLES}
+# 角色编号 -> 中文名 / 中文名 -> 规范 prompt / 中文名 -> 英文标识
+ROLE_MAP = {role.role_id: role.name for role in ROLES}
+ROLE_PROMPTS = {role.name: role.prompt for role in ROLES}
+ROLE_KEYS = {role.name: role.key for role in ROLES}
+
+_ROLE_MARK = re.compile(r"对话对象是你的【(.+?)】")
+_ROLE_BY_MARK = {mark: role.name for role in ROLES for mark in (role.mark,) + role.aliases}
+
+
+def system_prompt(role_name, scene=None):
+    """角色的 system prompt；给出话题时与训练样本的格式一致"""
+    role = ROLE_BY_NAME.get(role_name)
+    prompt = role.prompt if role is not None else DEFAULT_SYSTEM_PROMPT
+    return f"{prompt} 当前话题：【{scene}】。" if scene else prompt
+
+
+def role_of_system_prompt(text):
+    """按 system prompt 中“对话对象是你的【...】”反查角色名，识别不了时返回 None"""
+    match = _ROLE_MARK.search(text)
+    return _ROLE_BY_MARK.get(match.group(1)) if match else None
+
+
+# ================= 按 tokenizer 缓存的产物 =================
+def tokenizer_hash(tokenizer):
+    """词表、合并规则、特殊 token 与 chat template 共同决定 token id，任何一项变化都得到不同的哈希"""
+    digest = hashlib.sha256()
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        digest.update(backend.to_str().encode("utf-8"))
+    else:
+        digest.update(json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode("utf-8"))
+    digest.update(str(getattr(tokenizer, "chat_template", None) or "").encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+class TokenizedRoles:
+    """
+    一个 tokenizer 对应 ROLE_CACHE_DIR/<哈希>.json：
+    - prompts：每个角色 system prompt (套用 chat template) 的 token id，prompt 改了自动重算
+    - reply_lengths：训练集每条参考回复的 token 数 (按角色)，数据文件的大小或修改时间变了自动重算
+    """
+
+    def __init__(self, tokenizer, cache_dir=ROLE_CACHE_DIR):
+        self.tokenizer = tokenizer
+        self.tokenizer_hash = tokenizer_hash(tokenizer)
+        self.path = os.path.join(cache_dir, f"{self.tokenizer_hash}.json") if cache_dir else None
+        self.data = {"prompts": {}, "reply_lengths": {}}
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.data.update(json.load(f))
+            except (OSError, ValueError):
+                # 缓存损坏时当作没有缓存，重新计算后覆盖
+                pass
+        self.dirty = False
+
+    def prompt_ids(self, role_name):
+        """角色 system prompt 的 token id (与推理时拼接 chat template 的结果逐个 token 一致，可以直接作为 KV Cache 前缀)"""
+        prompt = ROLE_PROMPTS[role_name]
+        entry = self.data["prompts"].get(role_name)
+        if entry is None or entry["prompt"] != prompt:
+            text = self.tokenizer.apply_chat_template(
+                [{"role": "system", "content": prompt}], tokenize=False, add_generation_prompt=False
+            )
+            entry = {"prompt": prompt, "ids": self.tokenizer(text, add_special_tokens=False).input_ids}
+            self.data["prompts"][role_name] = entry
+            self.dirty = True
+        return list(entry["ids"])
+
+    def reply_lengths(self, data_path):
+        """按角色统计数据集中每条 assistant 回复的 token 数"""
+        stat = os.stat(data_path)
+        key = f"{os.path.abspath(data_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        lengths = self.data["reply_lengths"].get(key)
+        if lengths is None:
+            with open(data_path, "r", encoding="utf-8") as f:
+                samples = json.load(f)
+            replies = {}
+            for sample in samples:
+                messages = sample["messages"]
+                if not messages or messages[0]["role"] != "system":
+                    continue
+                role_name = role_of_system_prompt(messages[0]["content"])
+                if role_name:
+                    replies.setdefault(role_name, []).extend(
+                        msg["content"] for msg in messages if msg["role"] == "assistant")
+            lengths = {
+                role_name: [len(ids) for ids in self.tokenizer(texts, add_special_tokens=False)["input_ids"]]
+                for role_name, texts in replies.items() if texts
+            }
+            # 同一个数据文件只保留最新版本的统计
+            prefix = key.rsplit(":", 2)[0] + ":"
+            for old_key in [k for k in self.data["reply_lengths"] if k.startswith(prefix)]:
+                del self.data["reply_lengths"][old_key]
+            self.data["reply_lengths"][key] = lengths
+            self.dirty = True
+        return lengths
+
+    def save(self):
+        """有新算出的内容时写回磁盘 (先写临时文件再替换，多个进程同时写也不会读到半个文件)"""
+        if not self.dirty or not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+_TOKENIZED = {}
+
+
+def tokenized_roles(tokenizer):
+    """同一个 tokenizer 对象共用一份 TokenizedRoles (哈希只算一次，写回时不会互相覆盖)"""
+    tokenized = _TOKENIZED.get(id(tokenizer))
+    if tokenized is None:
+        # 缓存里持有 tokenizer 的引用，id 不会被其他对象复用
+        tokenized = _TOKENIZED[id(tokenizer)] = TokenizedRoles(tokenizer)
+    return tokenized
+
+
+def main():
+    parser = argparse.ArgumentParser(description="角色注册表")
+    parser.add_argument("--tokenizer", help="tokenizer 路径：预先生成 system prompt 的 token 缓存")
+    parser.add_argument("--data", help="训练集路径：同时缓存参考回复的 token 数")
+    args = parser.parse_args()
+
+    for role in ROLES:
+        print(f"{role.role_id}. {role.name} ({role.key})  场景 {len(role.scenes)} 个  标记【{role.mark}】")
+        print(f"   {role.prompt}")
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+
+        tokenized = tokenized_roles(AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True))
+        for role in ROLES:
+            print(f"{role.name}: system prompt {len(tokenized.prompt_ids(role.name))} tokens")
+        if args.data:
+            lengths = tokenized.reply_lengths(args.data)
+            print("参考回复: " + ", ".join(f"{name} {len(values)} 条" for name, values in lengths.items()))
+        tokenized.save()
+        print(f"✅ 已写入 {tokenized.path}")
+
+
+if __name__ == "__main__":
+    main()
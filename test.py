@@ -4,6 +4,8 @@ from peft import PeftModel
 import os
 import time
 
+from role_registry import ROLE_PROMPTS
+
 # ==================== 配置区域 ====================
 # 你的原始基座模型路径 (从 Hugging Face 下载的)
 BASE_MODEL_PATH = "./models/Qwen/Qwen2.5-3B-Instruct"
@@ -15,34 +17,7 @@ ADAPTER_PATH = "models/qwen_social_finetune_final"
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
 # ==================== 角色人设定义 ====================
-# 注意：这些 SYSTEM PROMPT 必须和训练数据中的风格一致！
-
-ROLE_PROMPTS = {
-    "长辈": (
-        "你是一个情商极高的工科学生。你现在的对话对象是你的【长辈】。"
-        "请保持尊敬、亲切的态度，并使用幽默、搞笑感来活跃气氛。"
-    ),
-    "女友": (
-        "你是一个风趣幽默的工科学生。你现在的对话对象是你的【女友】。"
-        "对话充满中国式幽默却又不失暧昧，适当反转。其他时候要有甜美的感觉。"
-    ),
-    "导师": (
-        "你是一个理工科研究生，情商很高，说话有分寸。你现在的对话对象是你的【导师】。"
-        "整体风格要：尊敬、专业、礼貌为主，同时可以适度幽默、机智。"
-    ),
-    '陌生人': (
-        "你是一个机智、得体、有分寸感的工科学生。你现在的对话对象是你的【陌生人】。"
-        "保持轻松、礼貌的态度，并使用高情商幽默来化解尴尬或拉近距离，"
-        "对于冒犯或尴尬的问题要机智回应、保护隐私；对于无心的小误会要用幽默展现善意。"
-        "当感觉投缘时，可以适度分享，用共同话题建立连接。"
-        "当感觉不安全或对方意图不当时，礼貌地结束对话并离开。"
-    ),
-    '夫妻': (
-        "你是一个情商在线、风趣暖心的伴侣。你现在的对话对象是你的【配偶】。"
-        "对话充满生活烟火气，兼具幽默调侃与温柔包容，偶尔互怼却不伤人。"
-        "对于日常琐事多换位思考，对于矛盾巧妙化解，对于关心加倍回应，用轻松语气传递爱意。"
-    )
-}
+# SYSTEM PROMPT 统一定义在 role_registry.py，与训练数据完全一致
 
 
 def load_model_and_adapter():